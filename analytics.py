@@ -0,0 +1,256 @@
+# coding: utf-8
+
+'''
+使用时长统计 (`/analytics`)
+
+- 按 今日 / 本周 / 本月 / 本年 / 总计 统计每个状态的持续时间, 以及每个设备每个应用的使用时间 (秒)
+- 增量更新: 修改状态时 (`data.write()` 结束前) 结束上一段并开始新的一段, 累加到统计中; 查询时只需加上正在进行的一段
+- 跨 日 / 周 / 月 / 年 的处理同 metrics (按 `env.main.timezone`): 只保留当前周期, 跨周期的一段只计入在当前周期内的部分
+- 每个设备每个周期最多统计 `env.util.analytics_apps` 个应用 (应用名可能是任意的窗口标题), 超出时将时间最短的一项合并到 `OTHER`
+
+保存在状态的 `analytics` 项中 (随状态持久化 / 多进程共享); 修改时只复制变化的周期 / 设备, 日志只写入变化的项 (`ana` 记录, 见 `journal.py`):
+
+```
+{
+    "today_is": "2025-1-22", "week_is": "2025-W4", "month_is": "2025-1", "year_is": "2025",
+    "open": {"status": [状态, 开始时间], "devices": {设备 id: [应用名, 开始时间]}},  // 正在进行的一段 (只有使用中的设备)
+    "status": {"today": {状态: 秒}, "week": {...}, "month": {...}, "year": {...}, "total": {...}},
+    "apps": {"today": {设备 id: {应用名: 秒}}, ...}
+}
+```
+'''
+
+from datetime import datetime, timedelta
+from time import time
+
+import utils as u
+import env as env
+import journal
+
+BUCKETS = journal.ANALYTICS_BUCKETS
+# 超出应用数上限时, 合并的应用计入此项
+OTHER = '(other)'
+
+
+def periods(ts: float) -> dict[str, tuple[str, int]]:
+    '''
+    时间所在的各个周期
+
+    :return: `{bucket: (周期标识, 周期开始的时间戳)}` (`total` 的开始时间为 0)
+    '''
+    now = datetime.fromtimestamp(ts, u.now().tzinfo)
+    tz = now.tzinfo
+
+    def start(year: int, month: int = 1, day: int = 1) -> int:
+        return int(tz.localize(datetime(year, month, day)).timestamp())  # type: ignore - pytz
+
+    iso = now.isocalendar()
+    monday = now.date() - timedelta(days=now.weekday())
+    return {
+        'today': (f'{now.year}-{now.month}-{now.day}', start(now.year, now.month, now.day)),
+        'week': (f'{iso[0]}-W{iso[1]}', start(monday.year, monday.month, monday.day)),
+        'month': (f'{now.year}-{now.month}', start(now.year, now.month)),
+        'year': (str(now.year), start(now.year)),
+        'total': ('', 0)
+    }
+
+
+def empty() -> dict:
+    return {
+        'today_is': '',
+        'week_is': '',
+        'month_is': '',
+        'year_is': '',
+        'open': {'status': None, 'devices': {}},
+        'status': {b: {} for b in BUCKETS},
+        'apps': {b: {} for b in BUCKETS}
+    }
+
+
+def rollover(stats: dict, current: dict[str, tuple[str, int]], cleared: list[str] | None = None) -> dict:
+    '''
+    跨周期时清空对应的统计 (不修改传入的 dict)
+
+    :param current: `periods()` 的返回值
+    :param cleared: 如提供, 清空的周期会添加到此列表中
+    :return: 需要清空时返回新的 dict, 否则返回原 dict
+    '''
+    new = None
+    for bucket in BUCKETS[:-1]:
+        key = f'{bucket}_is'
+        if stats[key] != current[bucket][0]:
+            new = new or {**stats, 'status': dict(stats['status']), 'apps': dict(stats['apps'])}
+            new[key] = current[bucket][0]
+            new['status'][bucket] = {}
+            new['apps'][bucket] = {}
+            if cleared is not None:
+                cleared.append(bucket)
+    return new or stats
+
+
+def writable(stats: dict) -> dict:
+    '''
+    复制顶层及 `open` / `status` / `apps` (之后由 `credit()` 按需复制下层, 不修改传入的 dict)
+    '''
+    return {
+        **stats,
+        'open': {'status': stats['open']['status'], 'devices': dict(stats['open']['devices'])},
+        'status': dict(stats['status']),
+        'apps': dict(stats['apps'])
+    }
+
+
+def credit(stats: dict, current: dict[str, tuple[str, int]], start: int, end: int, status: str | None = None,
+           device: tuple[str, str] | None = None, max_apps: int = 0, changes: dict | None = None):
+    '''
+    将 [start, end] 这一段计入统计 (每个周期只计入在周期内的部分)
+    * `stats` 需为 `writable()` 的返回值: 修改的周期 / 设备先复制再修改, 其他部分仍与旧快照共用
+
+    :param status: 状态 (计入 `status`)
+    :param device: (设备 id, 应用名) (计入 `apps`)
+    :param max_apps: 每个设备每个周期最多的应用数 (0 为不限制)
+    :param changes: 如提供, 记录变化的项 (`{"s": {(周期, 状态): 秒}, "a": {(周期, 设备 id, 应用名): 秒 / None}}`)
+    '''
+    for bucket in BUCKETS:
+        seconds = end - max(start, current[bucket][1])
+        if seconds <= 0:
+            continue
+        if status is not None:
+            counts = stats['status'][bucket] = dict(stats['status'][bucket])
+            counts[status] = counts.get(status, 0) + seconds
+            if changes is not None:
+                changes['s'][(bucket, status)] = counts[status]
+        if device is not None:
+            device_id, app_name = device
+            devices = stats['apps'][bucket] = dict(stats['apps'][bucket])
+            apps = devices[device_id] = dict(devices.get(device_id, {}))
+            apps[app_name] = apps.get(app_name, 0) + seconds
+            if changes is not None:
+                changes['a'][(bucket, device_id, app_name)] = apps[app_name]
+            if max_apps and len(apps) > max_apps + (OTHER in apps):
+                # 超出上限: 时间最短的一项合并到 OTHER
+                name = min((k for k in apps if k != OTHER), key=apps.__getitem__)
+                apps[OTHER] = apps.get(OTHER, 0) + apps.pop(name)
+                if changes is not None:
+                    changes['a'][(bucket, device_id, name)] = None
+                    changes['a'][(bucket, device_id, OTHER)] = apps[OTHER]
+
+
+class Analytics:
+    '''
+    使用时长统计
+
+    :param d: data 实例
+    '''
+
+    def __init__(self, d):
+        self._d = d
+        self.max_apps: int = max(env.util.analytics_apps, 0)
+        d.add_write_hook(self._on_write, key='analytics')
+
+    def _on_write(self, old: dict, data: dict) -> list[dict]:
+        '''
+        (`data.write()` 的 hook, 在写入锁中调用) 状态 / 设备的使用状态或应用名变化时结束上一段, 开始新的一段
+        * 只有使用状态 / 应用名 / 状态变化时才修改 (重复的相同上报不产生更改)
+        * 只复制变化的部分; 返回描述变化的日志记录 (统计尚不存在时为整项)
+
+        :return: 日志记录
+        '''
+        stats: dict | None = data.get('analytics')
+        now = int(time())
+        current = periods(now)
+        cleared: list[str] = []
+        new = rollover(stats or empty(), current, cleared)
+        opened = new['open']
+        target_status = str(data.get('status', 0))
+        devices: dict = data.get('device_status', {})
+        target_devices = {k: str(v.get('app_name', '')) for k, v in devices.items() if v.get('using')}
+        status_changed = opened['status'] is None or opened['status'][0] != target_status
+        devices_changed = {k: v[0] for k, v in opened['devices'].items()} != target_devices
+        if not (status_changed or devices_changed or cleared):
+            return []
+        changes: dict = {'s': {}, 'a': {}}
+        if status_changed or devices_changed:
+            new = writable(new)  # 复制后修改 (旧快照可能仍在被读取)
+            opened = new['open']
+            if status_changed:
+                if opened['status'] is not None:
+                    status, start = opened['status']
+                    credit(new, current, start, now, status=status, changes=changes)
+                opened['status'] = [target_status, now]
+            if devices_changed:
+                for device_id, (app_name, start) in list(opened['devices'].items()):
+                    if target_devices.get(device_id) != app_name:
+                        credit(new, current, start, now, device=(device_id, app_name), max_apps=self.max_apps, changes=changes)
+                        del opened['devices'][device_id]
+                for device_id, app_name in target_devices.items():
+                    if device_id not in opened['devices']:
+                        opened['devices'][device_id] = [app_name, now]
+        data['analytics'] = new
+        if stats is None:
+            return [{'op': 'set', 'k': 'analytics', 'v': new}]
+        record: dict = {'op': 'ana', 'r': {k: v for k, v in new.items() if k not in ('status', 'apps')}}
+        if cleared:
+            record['c'] = cleared
+        if changes['s']:
+            record['s'] = [[*key, seconds] for key, seconds in changes['s'].items()]
+        if changes['a']:
+            record['a'] = [[*key, seconds] for key, seconds in changes['a'].items()]
+        return [record]
+
+    def summary(self, top: int = 10) -> dict:
+        '''
+        当前的统计 (包括正在进行的一段)
+
+        :param top: 每个周期返回使用时间最长的应用数 (所有设备合计)
+        '''
+        stats: dict = self._d.data.get('analytics') or empty()
+        now = int(time())
+        current = periods(now)
+        view = writable(rollover(stats, current))
+        opened = view['open']
+        if opened['status'] is not None:
+            credit(view, current, opened['status'][1], now, status=opened['status'][0])
+        for device_id, (app_name, start) in opened['devices'].items():
+            credit(view, current, start, now, device=(device_id, app_name))
+        top_apps = {}
+        for bucket in BUCKETS:
+            merged: dict[str, int] = {}
+            for apps in view['apps'][bucket].values():
+                for app_name, seconds in apps.items():
+                    if app_name != OTHER:
+                        merged[app_name] = merged.get(app_name, 0) + seconds
+            top_apps[bucket] = sorted(merged.items(), key=lambda i: i[1], reverse=True)[:top]
+        return {
+            'today_is': view['today_is'],
+            'week_is': view['week_is'],
+            'month_is': view['month_is'],
+            'year_is': view['year_is'],
+            'status': view['status'],
+            'apps': view['apps'],
+            'top_apps': top_apps
+        }
+
+    def placeholders(self) -> dict[str, str]:
+        '''
+        `more_text` 中可用的占位符
+
+        - `{awake_today}` / `{awake_week}` / `{awake_month}` / `{awake_year}` / `{awake_total}`: 状态 `0` 的时长 (小时, 一位小数)
+        - `{top_app_today}` / `{top_app_week}` / `{top_app_month}` / `{top_app_year}` / `{top_app_total}`: 使用时间最长的应用
+        '''
+        summary = self.summary(top=1)
+        fields = {}
+        for bucket in BUCKETS:
+            fields[f'awake_{bucket}'] = f"{summary['status'][bucket].get('0', 0) / 3600:.1f}"
+            top_apps = summary['top_apps'][bucket]
+            fields[f'top_app_{bucket}'] = top_apps[0][0] if top_apps else '-'
+        return fields
+
+
+def open_analytics(d) -> Analytics | None:
+    '''
+    按配置创建使用时长统计 (未启用时返回 None)
+    '''
+    if not env.util.analytics:
+        return None
+    return Analytics(d)
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+asgi 模式入口, 与 `server.py` 共用同一个 Flask app 和 data 实例
+
+- `/events` 在事件循环中原生处理: 每个 SSE 客户端只占用一个协程和一个小队列, 不占用线程
+- 其他路由 (包括 `require_secret` 鉴权 / 设备接口 / metrics) 通过线程池转交给 Flask (WSGI) 处理
+
+启动: `python asgi.py` (需要 `pip install uvicorn`), 或使用任意 ASGI 服务器加载 `asgi:application`
+'''
+
+import asyncio
+import io
+import sys
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import env
+import utils as u
+import server
+from server import app, d
+
+# WSGI 请求使用的线程池 (SSE 不占用), 见 `configure()`
+_executor: ThreadPoolExecutor | None = None
+# 事件循环 & 所有 SSE 客户端的队列
+_loop: asyncio.AbstractEventLoop | None = None
+_clients: set[asyncio.Queue] = set()
+
+
+def configure(threads: int):
+    '''
+    设置处理 WSGI 请求的线程数 (需在处理请求之前调用; 未调用时按 `launcher.auto_threads()`)
+    '''
+    global _executor
+    _executor = ThreadPoolExecutor(threads, thread_name_prefix='sleepy-wsgi')
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    if _executor is None:
+        # 直接加载 `asgi:application` (未经 launcher 启动)
+        import launcher
+        configure(launcher.auto_threads())
+    return _executor  # type: ignore
+
+
+# --- Broadcast
+
+def _on_publish(version: int):
+    '''
+    `d.publish()` 的监听函数 (在修改状态的线程中调用), 转交到事件循环中唤醒客户端
+    '''
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_wake_clients, version)
+
+
+def _wake_clients(version: int):
+    '''
+    唤醒所有 SSE 客户端 (在事件循环中调用)
+    * 队列长度为 1, 已有未处理的通知时直接跳过 (客户端总是发送最新版本)
+    '''
+    for queue in _clients:
+        if queue.empty():
+            queue.put_nowait(version)
+
+
+def _setup():
+    '''
+    在事件循环中注册监听函数 (仅一次)
+    '''
+    global _loop
+    if _loop is None:
+        _loop = asyncio.get_running_loop()
+        d.add_listener(_on_publish)
+        u.info(f'[asgi] event loop attached, {len(_clients)} clients.')
+
+
+# --- SSE
+
+async def _wait_disconnect(receive):
+    '''
+    等待客户端断开连接
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def events(scope, receive, send):
+    '''
+    SSE 事件流 (与 `server.events()` 输出相同)
+    - Method: **GET**
+    - `?mode=delta`: 增量模式
+    '''
+    start = perf_counter()
+    delta_mode = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('mode') == ['delta']
+    headers = dict(scope['headers'])
+    client = scope.get('client') or ('', 0)
+    xff = headers.get(b'x-forwarded-for')
+    server.record_request('/events', client[0], xff.decode('latin-1') if xff else None)
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    _clients.add(queue)
+    if server.runtime_metrics:
+        server.runtime_metrics.open_stream()
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),  # 禁用缓存
+                (b'x-accel-buffering', b'no'),  # 禁用 Nginx 缓冲
+                (b'access-control-allow-origin', b'*')  # 允许跨域访问
+            ]
+        })
+        if server.runtime_metrics:
+            server.runtime_metrics.record('/events', 'GET', 200, perf_counter() - start)
+        last_version = None
+        sent = None  # 增量模式下已发送的序号
+        while not disconnected.done():
+            if d.version != last_version:
+                # 事件文本在所有订阅者间共享 (包括 WSGI 模式的订阅者), 每次更改只序列化一次
+                if delta_mode:
+                    last_version = d.version
+                    sent, payloads = server.delta_journal.since(sent)
+                    payload = b''.join(payloads)
+                else:
+                    last_version, payload = d.cached('events', server.build_event_payload)
+                if payload:
+                    await send({'type': 'http.response.body', 'body': payload, 'more_body': True})
+                continue
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=30, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 超时, 发送心跳
+                getter.cancel()
+                await send({
+                    'type': 'http.response.body',
+                    'body': f'event: heartbeat\ndata: {u.nowstr()}\n\n'.encode('utf-8'),
+                    'more_body': True
+                })
+            elif getter not in done:
+                getter.cancel()
+    except OSError:
+        pass
+    finally:
+        _clients.discard(queue)
+        disconnected.cancel()
+        if server.runtime_metrics:
+            server.runtime_metrics.close_stream()
+
+
+# --- WSGI bridge
+
+def _build_environ(scope, body: bytes) -> dict:
+    '''
+    ASGI scope -> WSGI environ
+    '''
+    server_addr = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server_addr[0]),
+        'SERVER_PORT': str(server_addr[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key == 'CONTENT_LENGTH':
+            continue
+        else:
+            key = f'HTTP_{key}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _call_wsgi(environ: dict) -> tuple[int, list, bytes]:
+    '''
+    在线程池中调用 Flask app, 返回 (状态码, 响应头, 响应体)
+    '''
+    started = {}
+
+    def start_response(status: str, headers: list, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+
+async def wsgi(scope, receive, send):
+    '''
+    将请求转交给 Flask app
+    '''
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    environ = _build_environ(scope, b''.join(chunks))
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(_get_executor(), _call_wsgi, environ)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# --- ASGI app
+
+async def application(scope, receive, send):
+    '''
+    ASGI 入口
+    '''
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                _setup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                u.info('[asgi] Server exiting, saving data...')
+                d.flush()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'http':
+        _setup()  # 不支持 lifespan 的服务器
+        if scope['path'] == '/events' and scope['method'] == 'GET':
+            await events(scope, receive, send)
+        else:
+            await wsgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn  # type: ignore - 可选依赖
+    except ImportError:
+        u.error('asgi mode requires uvicorn, please run: pip install uvicorn')
+        exit(1)
+    u.info(f'=============== hi {env.page.user}! ===============')
+    listening = f'{f"[{env.main.host}]" if ":" in env.main.host else env.main.host}:{env.main.port}'
+    u.info(f'Starting ASGI server: {"https" if env.main.https_enabled else "http"}://{listening}')
+    uvicorn.run(
+        application,
+        host=env.main.host,
+        port=env.main.port,
+        ssl_certfile=env.main.ssl_cert if env.main.https_enabled else None,
+        ssl_keyfile=env.main.ssl_key if env.main.https_enabled else None,
+        log_level='debug' if env.main.debug else 'warning',
+        lifespan='on'
+    )
+    u.info('Bye.')
@@ -0,0 +1,355 @@
+# coding: utf-8
+
+'''
+跨节点事件总线: 多个实例 (如负载均衡后的多台服务器) 之间同步状态更改, 每个实例的 SSE 订阅者都能收到其他实例上的修改
+
+- 本地修改 (`data.write()`) 后, 将变化的记录 (格式同 `journal.py`, 不含 metrics) 编号后广播
+- 收到其他节点的更改后应用到本地状态, 并通知本地的 SSE 订阅者
+- 按节点记录已收到的序号: 重复 / 过期的消息直接丢弃; 发现缺口 (丢失消息) 时向该节点请求完整快照
+
+传输方式:
+- `unix`: 同一主机上的多个实例, 每个实例在同一目录下绑定一个 Unix 数据报 socket
+- `redis`: Redis 协议的发布订阅 (可使用 `resp.py` 的替代服务器)
+'''
+
+import json
+import os
+import queue
+import socket
+import threading
+import uuid
+from typing import Callable
+
+import utils as u
+import env as env
+import resp
+import tracing
+
+# 广播的顶层项 (快照 / 过滤记录用; metrics 为各节点独立计数, 不广播)
+KEYS = ('status', 'device_status', 'private_mode', 'last_updated')
+
+
+# --- Transports
+
+class Transport:
+    '''
+    传输方式接口
+    '''
+
+    def open(self, node: str, on_message: Callable[[bytes], None]):
+        '''
+        开始接收消息 (在后台线程中调用 `on_message()`)
+
+        :param node: 本节点标识
+        '''
+        raise NotImplementedError
+
+    def send(self, payload: bytes):
+        '''
+        发送消息给其他所有节点 (尽力而为, 丢失的消息由序号缺口检测处理)
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class UnixTransport(Transport):
+    '''
+    Unix 数据报 socket (同一主机)
+
+    :param path: 所有节点共用的目录, 每个节点在其中绑定 `<节点标识>.sock`
+    '''
+    # 单条消息最大长度
+    MAX_SIZE = 1 << 20
+
+    def __init__(self, path: str):
+        self.path = path
+        self._sock: socket.socket | None = None
+        self._name = ''
+
+    def open(self, node: str, on_message: Callable[[bytes], None]):
+        os.makedirs(self.path, exist_ok=True)
+        self._name = f'{node}.sock'
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(os.path.join(self.path, self._name))
+        self._sock = sock
+        threading.Thread(target=self._receive, args=(sock, on_message), name='sleepy-bus', daemon=True).start()
+
+    def _receive(self, sock: socket.socket, on_message: Callable[[bytes], None]):
+        while True:
+            try:
+                payload = sock.recv(self.MAX_SIZE)
+            except OSError:
+                return  # 已关闭
+            on_message(payload)
+
+    def send(self, payload: bytes):
+        sock = self._sock
+        if sock is None:
+            return
+        for name in os.listdir(self.path):
+            if not name.endswith('.sock') or name == self._name:
+                continue
+            target = os.path.join(self.path, name)
+            try:
+                # 不阻塞: 对方缓冲区已满时丢弃
+                sock.sendto(payload, socket.MSG_DONTWAIT, target)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 节点已退出
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+            except OSError as e:
+                u.warning(f'[bus] Failed to send to {name}: {e}')
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(os.path.join(self.path, self._name))
+            except OSError:
+                pass
+
+
+class PubSubTransport(Transport):
+    '''
+    Redis 协议的发布订阅
+
+    :param url: `redis://[:密码@]主机[:端口][/数据库]`
+    :param channel: 频道名
+    '''
+
+    def __init__(self, url: str, channel: str):
+        self.url = url
+        self.channel = channel
+        self._client = resp.RespClient(url)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def open(self, node: str, on_message: Callable[[bytes], None]):
+        self._closed = threading.Event()
+        threading.Thread(target=self._receive, args=(self._closed, on_message), name='sleepy-bus', daemon=True).start()
+
+    def _receive(self, closed: threading.Event, on_message: Callable[[bytes], None]):
+        '''
+        订阅频道 (断开后重新连接)
+        '''
+        while not closed.is_set():
+            client = resp.RespClient(self.url)
+            try:
+                for payload in client.listen(self.channel):
+                    if closed.is_set():
+                        break
+                    on_message(payload)
+            except Exception as e:
+                if not closed.is_set():
+                    u.warning(f'[bus] Subscription lost: {e}, reconnecting.')
+            finally:
+                client.close()
+            closed.wait(1)
+
+    def send(self, payload: bytes):
+        with self._lock:
+            self._client.execute('PUBLISH', self.channel, payload)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._client.close()
+
+
+# --- Broadcaster
+
+class Broadcaster:
+    '''
+    节点间的更改广播
+
+    消息 (json):
+    - `{"type": "change", "node": 节点, "seq": 序号, "records": [...], "trace": [trace id, span id]}`: 本地更改 (`trace` 仅在此更改被追踪时存在)
+    - `{"type": "resync", "node": 节点, "target": 目标节点}`: 发现缺口, 请求目标节点发送快照
+    - `{"type": "snapshot", "node": 节点, "seq": 当前序号, "records": [...]}`: 完整快照 (`KEYS` 中的项)
+
+    发送在后台线程中进行 (修改状态时只编号并入队, 不等待网络); 队列已满时丢弃更改, 发送完队列中的消息后改为发送一次完整快照
+
+    :param d: data 实例
+    :param transport: 传输方式
+    '''
+    # 发送队列长度
+    QUEUE_SIZE = 1000
+    # 队列中的快照请求 (由发送线程生成快照)
+    _SNAPSHOT = object()
+
+    def __init__(self, d, transport: Transport):
+        self._d = d
+        self.transport = transport
+        self.node = ''
+        self._lock = threading.Lock()  # 保证序号与入队顺序一致
+        self._seq = 0
+        self._last: dict[str, int] = {}  # 各节点已收到的最新序号
+        self._queue: queue.Queue = queue.Queue(self.QUEUE_SIZE)
+        self._resync = False  # 发送完队列后是否需要发送快照
+        self.sent = 0
+        self.received = 0
+        self.gaps = 0
+        self.dropped = 0
+        self.running = False
+
+    def start(self):
+        '''
+        开始广播 / 接收 (每个进程使用新的节点标识; launcher 在每个 worker 中调用)
+        '''
+        if self.running:
+            return
+        self.node = uuid.uuid4().hex[:16]
+        self._seq = 0
+        self._last = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._resync = False
+        threading.Thread(target=self._run, args=(self._queue,), name='sleepy-bus-send', daemon=True).start()
+        self.transport.open(self.node, self._on_message)
+        self._d.add_record_listener(self.emit)
+        self.running = True
+        u.info(f'[bus] Node {self.node} joined ({type(self.transport).__name__}).')
+
+    def stop(self):
+        '''
+        停止 (launcher 主进程不处理请求, 不参与广播)
+        '''
+        if not self.running:
+            return
+        self.running = False
+        self._d.remove_record_listener(self.emit)
+        try:
+            self._queue.put_nowait(None)  # 结束发送线程
+        except queue.Full:
+            pass
+        self.transport.close()
+
+    def _run(self, q: queue.Queue):
+        '''
+        发送线程: 按入队顺序发送; 队列清空后按需发送快照
+        '''
+        while True:
+            message = q.get()
+            if message is None:
+                return
+            if message is not self._SNAPSHOT:
+                self._send(message)
+            if self._resync and q.empty():
+                self._resync = False
+                self._send_snapshot()
+
+    def _send(self, message: dict):
+        try:
+            self.transport.send(u.dumps(message))
+            self.sent += 1
+        except Exception as e:
+            u.warning(f'[bus] Send failed: {e}')
+
+    def emit(self, records: list[dict]):
+        '''
+        广播本地更改 (`data` 的 record 监听函数, 在修改状态的线程中 / 持有写锁时调用, 只入队不发送)
+        '''
+        records = [r for r in records if r['op'] in ('dev', 'del') or (r['op'] == 'set' and r['k'] in KEYS)]
+        if not records:
+            return
+        message = {'type': 'change', 'node': self.node, 'seq': 0, 'records': records}
+        trace = tracing.current_context()
+        if trace:
+            message['trace'] = trace  # 其他节点应用此更改时关联到同一个 trace
+        with self._lock:
+            self._seq += 1
+            message['seq'] = self._seq
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                # 不阻塞写入: 丢弃此更改 (其他节点会发现序号缺口), 并在发送完队列后补发快照
+                self.dropped += 1
+                self._resync = True
+
+    def _request_snapshot(self):
+        '''
+        在已入队的更改之后发送一次快照
+        '''
+        self._resync = True
+        try:
+            self._queue.put_nowait(self._SNAPSHOT)
+        except queue.Full:
+            pass  # 发送线程清空队列后会发送
+
+    def _send_snapshot(self):
+        # 先取序号再取状态: 状态不会比序号旧 (更改在替换状态后才编号)
+        with self._lock:
+            seq = self._seq
+        data = self._d.data
+        self._send({
+            'type': 'snapshot',
+            'node': self.node,
+            'seq': seq,
+            'records': [{'op': 'set', 'k': k, 'v': data[k]} for k in KEYS if k in data]
+        })
+
+    def _on_message(self, payload: bytes):
+        '''
+        处理收到的消息 (在接收线程中调用)
+        '''
+        try:
+            message = json.loads(payload)
+            node = message['node']
+            if node == self.node:
+                return  # 自己发送的消息 (发布订阅会发回给自己)
+            kind = message['type']
+            if kind == 'resync':
+                if message.get('target') == self.node:
+                    self._request_snapshot()
+                return
+            seq: int = message['seq']
+            last = self._last.get(node)
+            self.received += 1
+            if kind == 'snapshot':
+                if last is not None and seq < last:
+                    return  # 比已应用的更改还旧
+            elif last is not None and seq <= last:
+                return  # 重复 / 过期
+            elif seq != (last or 0) + 1:
+                # 缺口: 先应用此更改 (记录均为绝对值), 再请求完整快照
+                self.gaps += 1
+                u.info(f'[bus] Gap from node {node}: expected {(last or 0) + 1}, got {seq}, requesting snapshot.')
+                self._send({'type': 'resync', 'node': self.node, 'target': node})
+            self._last[node] = seq
+            with tracing.resume(message.get('trace'), 'bus.apply', {'bus.node': node, 'bus.seq': seq}, kind=tracing.CONSUMER):
+                self._d.apply_records(message['records'])
+        except Exception as e:
+            u.warning(f'[bus] Bad message: {e}')
+
+    def stats(self) -> dict:
+        return {
+            'node': self.node,
+            'peers': len(self._last),
+            'sent': self.sent,
+            'received': self.received,
+            'gaps': self.gaps,
+            'dropped': self.dropped
+        }
+
+
+def open_bus(d) -> Broadcaster | None:
+    '''
+    按配置创建事件总线 (未启用时返回 None)
+    '''
+    kind = env.bus.type.lower()
+    if not kind:
+        return None
+    if d.storage_shared:
+        u.warning('[bus] Storage backend already shares state between nodes, event bus disabled.')
+        return None
+    if kind == 'unix':
+        return Broadcaster(d, UnixTransport(env.bus.path))
+    if kind == 'redis':
+        return Broadcaster(d, PubSubTransport(env.bus.url, env.bus.channel))
+    u.warning(f'[bus] Unknown bus type {kind}, event bus disabled.')
+    return None
@@ -25,6 +25,19 @@ except ImportError:
     print("警告: PrettyTable 库未安装，将使用简易格式化输出。")
     print("您可以通过 'pip install prettytable' 安装该库以获得更好的显示效果。")
 
+# 可选的二进制编码 (名称 -> (mimetype, 序列化, 反序列化)), 需服务端也安装对应的库
+CODECS = {}
+try:
+    import msgpack # type: ignore - 编辑器忽略未安装警告
+    CODECS['msgpack'] = ('application/msgpack', lambda obj: msgpack.packb(obj, use_bin_type=True), lambda body: msgpack.unpackb(body, raw=False))
+except ImportError:
+    pass
+try:
+    import cbor2 # type: ignore - 编辑器忽略未安装警告
+    CODECS['cbor'] = ('application/cbor', cbor2.dumps, cbor2.loads)
+except ImportError:
+    pass
+
 # --- config start
 # 密钥
 SECRET = ''
@@ -34,17 +47,23 @@ SERVER = 'http://127.0.0.1:9010'
 RETRY = 3
 # 是否显示原始 JSON 响应
 SHOW_RAW_JSON = False
+# 请求 / 响应的编码: json / msgpack / cbor (后两者需安装 msgpack / cbor2, 服务端不支持时自动回退到 json)
+CODEC = 'json'
 # --- config end
 
 
 class SleepyManager:
     """Sleepy API 管理类，封装了所有 API 调用"""
 
-    def __init__(self, server: str, secret: str, retry: int = 3):
+    def __init__(self, server: str, secret: str, retry: int = 3, codec: str = 'json'):
         """初始化 SleepyManager"""
         self.server = server.rstrip('/')
         self.secret = secret
         self.retry = retry
+        if codec != 'json' and codec not in CODECS:
+            print(f"警告: 编码 {codec} 不可用 (未安装对应的库)，将使用 json。")
+            codec = 'json'
+        self.codec = codec
         self._cached_devices = None
         self._cached_status_list = None
 
@@ -64,23 +83,43 @@ class SleepyManager:
         if method.upper() == 'POST' and json_data is not None and 'secret' not in json_data:
             json_data['secret'] = self.secret
 
+        # 使用二进制编码时设置 Content-Type / Accept
+        headers = {}
+        body = None
+        if self.codec in CODECS:
+            mimetype, dumps, _ = CODECS[self.codec]
+            headers['Accept'] = f'{mimetype}, application/json;q=0.5'
+            if json_data is not None:
+                headers['Content-Type'] = mimetype
+                body = dumps(json_data)
+
         for attempt in range(self.retry):
             try:
                 response = requests.request(
                     method=method,
                     url=url,
                     params=params,
-                    json=json_data,
+                    json=json_data if body is None else None,
+                    data=body,
+                    headers=headers,
                     timeout=10
                 )
                 response.raise_for_status()
-                return response.json()
+                return self._decode(response)
             except requests.RequestException as e:
                 if attempt == self.retry - 1:
                     print(f"请求失败 ({attempt + 1}/{self.retry}): {e}")
                     raise
                 print(f"请求失败，正在重试 ({attempt + 1}/{self.retry}): {e}")
 
+    def _decode(self, response: requests.Response) -> Any:
+        """按响应的 Content-Type 解析响应体"""
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        for mimetype, _, loads in CODECS.values():
+            if content_type == mimetype:
+                return loads(response.content)
+        return response.json()
+
     # ------ Read-only APIs ------
 
     def query(self) -> Dict:
@@ -137,6 +176,30 @@ class SleepyManager:
             }
         return result
 
+    def device_batch_set(self, devices: List[Dict], remove: List[str] = None) -> Dict:
+        """批量设置 / 移除设备状态 (服务端只加锁、推送一次)
+
+        devices: [{'id': ..., 'show_name': ..., 'using': ..., 'app_name': ...}, ...]
+        remove: 要移除的设备 ID 列表
+        """
+        data = {
+            'set': devices,
+            'remove': remove or []
+        }
+        result = self._request('POST', 'device/batch_set', json_data=data)
+        # 更新设备缓存
+        if self._cached_devices is not None and result.get('success'):
+            for device in devices:
+                self._cached_devices[device['id']] = {
+                    'show_name': device['show_name'],
+                    'using': device['using'],
+                    'app_name': device['app_name']
+                }
+            for item in result.get('remove', []):
+                if item.get('success'):
+                    self._cached_devices.pop(item['id'], None)
+        return result
+
     def device_remove(self, device_id: str) -> Dict:
         """移除单个设备的状态"""
         result = self._request('GET', 'device/remove', params={'id': device_id})
@@ -630,6 +693,8 @@ def parse_arguments():
                         help=f"API请求重试次数 (默认: {RETRY})")
     parser.add_argument("--raw-json", action="store_true",
                         help="显示原始JSON响应")
+    parser.add_argument("--codec", choices=['json', 'msgpack', 'cbor'], default=CODEC,
+                        help=f"请求/响应编码 (默认: {CODEC})")
 
     # 运行模式
     mode_group = parser.add_mutually_exclusive_group()
@@ -655,7 +720,7 @@ def main():
     args, command_args = parse_arguments()
 
     # 更新全局配置
-    global SERVER, SECRET, RETRY, SHOW_RAW_JSON
+    global SERVER, SECRET, RETRY, SHOW_RAW_JSON, CODEC
     if args.server:
         SERVER = args.server
     if args.secret:
@@ -664,10 +729,12 @@ def main():
         RETRY = args.retry
     if args.raw_json:
         SHOW_RAW_JSON = True
+    if args.codec:
+        CODEC = args.codec
 
     try:
         # 创建管理器实例
-        manager = SleepyManager(SERVER, SECRET, RETRY)
+        manager = SleepyManager(SERVER, SECRET, RETRY, CODEC)
         cli = SleepyManagerCLI(manager)
 
         # 根据参数决定运行模式
@@ -1,15 +1,20 @@
 # coding: utf-8
 
 import os
-import pytz
 import json
 import json5
+import heapq
 import threading
-from time import sleep
-from datetime import datetime
+from contextlib import contextmanager
+from time import sleep, time
+from types import SimpleNamespace
+from typing import Any
 
 import utils as u
 import env as env
+import journal
+import storage
+import tracing
 from setting import metrics_list
 
 
@@ -17,30 +22,119 @@ class data:
     '''
     data 类，存储当前/设备状态
     可用 `.data['xxx']` 直接调取数据 (加载后) *(?)*
+
+    * `.data` 是不可变快照: 读取无需加锁, 但 **不能原地修改**
+    * 修改需在 `write()` 中进行: 修改的是快照的副本, 结束时一次性替换 (其他线程不会读到修改了一半的状态)
     '''
-    data: dict
     preload_data: dict
     data_check_interval: int = 60
 
     def __init__(self):
+        # 当前快照 / 正在修改的副本 (见 `write()`)
+        self._data: dict = {}
+        self._draft: dict | None = None
+        self._draft_owner: int | None = None
+        # 状态版本 (每次更改 +1, 用于 SSE 广播 / 响应缓存)
+        self._version: int = 0
+        self._metrics_version: int = 0
+        self._boot: int = int(time())
+        self._modified: float = time()
+        self._ambiguous_second: int = -1
+        self._event_cond = threading.Condition()
+        self._listeners: list = []
+        self._record_listeners: list = []
+        self._remote_listeners: list = []
+        self._write_hooks: list = []
+        self._cache_lock = threading.Lock()
+        self._cache: dict = {}
+        self._publish_trace: tuple[int, tuple[str, str]] | None = None
+        # 写入锁 (见 `write()`)
+        self._write_lock = threading.RLock()
+        self._write_depth: int = 0
+        # 多进程共享状态 (见 `enable_shared()`)
+        self._shared = None
+        self._shared_seen: int = 0
+        self._metrics_pending: dict = {}
+        # metrics 计数 (见 `record_metrics()`): 统计的路径 / 各线程的计数 / 跨日定时器
+        self._metrics_paths: frozenset[str] = frozenset(metrics_list)
+        self._metrics_local = threading.local()
+        self._metrics_shards: list[_MetricsShard] = []
+        self._metrics_shards_lock = threading.Lock()
+        self._metrics_timer: threading.Timer | None = None
+        # 定时检查线程停止标志
+        self._timer_stop = threading.Event()
+        # 设备心跳检查 (见 `start_heartbeat_check()`)
+        self._hb_stop = threading.Event()
+        self._hb_cond = threading.Condition()
+        self._hb_heap: list[tuple[float, str]] = []
+        self._hb_scheduled: set[str] = set()
+        self._hb_started: float = time()
+        self._hb_ttl: dict[str, int] = {}
+        # 更改计数 (每次修改 +1) / 上次成功保存时的计数, 用于判断是否需要保存
+        self._changes: int = 0
+        self._saved_changes: int = 0
+        self._flush_duration: float = 0.0
+        self._flushed_at: float = 0.0
+        # 自动切换状态的次数 (见 `check_device_status()`)
+        self._auto_switches: int = 0
+        # 存储后端 (见 `storage.py`)
+        self._storage: storage.Storage = storage.open_storage()
+        self._compact_lock = threading.Lock()
+
         with open(u.get_path('data.template.jsonc'), 'r', encoding='utf-8') as file:
             self.preload_data = json5.load(file, encoding='utf-8')
-        if os.path.exists(u.get_path('data.json')):
-            try:
-                self.load()
-            except Exception as e:
-                u.warning(f'Error when loading data: {e}, try re-create')
-                os.remove(u.get_path('data.json'))
-                self.data = self.preload_data
-                self.save()
-                self.load()
+        try:
+            self.load()
+        except Exception as e:
+            u.warning(f'Error when loading data: {e}, try re-create')
+            self._storage.reset()
+            self.data = self.preload_data
+            self.save()
+            self.load()
+        if self._storage.shared:
+            self._storage.subscribe(self._on_remote_change)
+        if self._storage.should_compact():
+            # 上次未正常退出: 将重放的记录写入 data.json (同时丢弃日志中可能只写了一半的最后一行)
+            u.info(f'[storage] Recovered from journal ({getattr(self._storage, "replayed", 0)} records), compacting.')
+            self.compact()
+
+    # --- Snapshot
+
+    @property
+    def data(self) -> dict:
+        '''
+        当前状态快照 (只读)
+        * 在 `write()` 中 (同一线程) 返回正在修改的副本
+        '''
+        draft = self._draft
+        if draft is not None and self._draft_owner == threading.get_ident():
+            return draft
+        return self._data
+
+    @data.setter
+    def data(self, value: dict):
+        '''
+        整体替换状态 (如 `load()`)
+        '''
+        with self._write_lock:
+            if self._draft is not None:
+                self._draft = value
+            self._data = value
+
+    def _set(self, key: str, value, records: list[dict] | None = None):
+        '''
+        替换快照中的一项 (需持有 `_write_lock`)
+        * 在 `write()` 中时修改副本, 否则生成新快照 (只复制顶层)
+
+        :param records: 增量写入的记录 (默认为设置整项), 由定时检查线程提交
+        '''
+        if self._draft is not None:
+            self._draft[key] = value  # 在 write() 结束时计入更改
         else:
-            u.info('Could not find data.json, creating.')
-            try:
-                self.data = self.preload_data
-                self.save()
-            except Exception as e:
-                u.exception(f'Create data.json failed: {e}')
+            self._data = {**self._data, key: value}
+            self._changes += 1
+            if self._storage.incremental and not self._shared:
+                self._storage.append(records or [{'op': 'set', 'k': key, 'v': value}])
 
     # --- Storage functions
 
@@ -49,7 +143,7 @@ class data:
         加载状态
 
         :param ret: 是否返回加载后的 dict (为否则设置 self.data)
-        :param preload: 将会将 data.json 的内容追加到此后
+        :param preload: 将会将保存的内容追加到此后
         '''
         if not preload:
             preload = self.preload_data
@@ -57,17 +151,17 @@ class data:
 
         while attempts > 0:
             try:
-                if not os.path.exists(u.get_path('data.json')):
-                    u.warning('data.json not exist, try re-create')
+                stored = self._storage.load()
+                if stored is None:
+                    u.info(f'Could not find saved data ({self._storage.name}), creating.')
                     self.data = self.preload_data
                     self.save()
-                with open(u.get_path('data.json'), 'r', encoding='utf-8') as file:
-                    Data = json.load(file)
-                    DATA: dict = {**preload, **Data}
-                    if ret:
-                        return DATA
-                    else:
-                        self.data = DATA
+                    stored = {}
+                DATA: dict = {**preload, **stored}
+                if ret:
+                    return DATA
+                else:
+                    self.data = DATA
                 break  # 成功加载数据后跳出循环
             except Exception as e:
                 attempts -= 1
@@ -77,21 +171,205 @@ class data:
                     u.error(f'Load data error: {e}, reached max retry count!')
                     raise
 
-    def save(self):
+    def _persist(self, action, changes: int) -> bool:
         '''
-        保存配置
+        执行一次持久化操作, 并记录耗时 / 已保存的更改计数
+
+        :param action: 无参数的函数 (失败时抛出异常)
+        :param changes: 操作完成后已保存到的更改计数
+        :return: 是否成功
         '''
+        start = time()
         try:
-            with open(u.get_path('data.json'), 'w', encoding='utf-8') as file:
-                json.dump(self.data, file, indent=4, ensure_ascii=False)
+            with tracing.span('storage.flush', {'storage.backend': self._storage.name}):
+                action()
         except Exception as e:
-            u.error(f'Failed to save data.json: {e}')
+            u.error(f'[storage] Failed to save data ({self._storage.name}): {e}')
+            return False
+        self._flushed_at = time()
+        self._flush_duration = self._flushed_at - start
+        self._saved_changes = max(self._saved_changes, changes)
+        return True
+
+    def save(self, snapshot: dict | None = None, changes: int | None = None) -> bool:
+        '''
+        保存完整状态
+
+        :param snapshot: 要保存的快照 (默认为当前状态)
+        :param changes: 快照对应的更改计数 (与 `snapshot` 一起传入)
+        :return: 是否保存成功
+        '''
+        # 先读更改计数再读快照: 保存的内容至少包含到此计数为止的更改
+        if snapshot is None:
+            changes = self._changes
+            snapshot = self.data
+        return self._persist(lambda: self._storage.save(snapshot), changes or 0)
+
+    def compact(self):
+        '''
+        (增量写入时) 压缩: json 后端将当前状态写入 data.json 并清空日志, sqlite 后端合并 WAL
+        * 开始压缩与读取快照在写入锁中进行, 之后的修改写入新日志, 保存时不阻塞修改
+        '''
+        with self._compact_lock:
+            with self._write_lock:
+                snapshot, changes = self._data, self._changes
+                self._storage.begin_compact()
+            self._persist(lambda: self._storage.compact(snapshot), changes)
+
+    def _commit(self, ticket: int | None, changes: int):
+        '''
+        等待增量写入的记录持久化
+        '''
+        self._persist(lambda: self._storage.commit(ticket), changes)
+
+    def persist(self):
+        '''
+        持久化尚未保存的更改 (由定时检查线程调用)
+        * 增量写入时: 提交尚未提交的记录, 需要时压缩
+        * 否则: 保存完整状态
+        '''
+        self.fold_metrics()
+        if self._storage.incremental and not self._shared:
+            self._commit(None, self._changes)
+            if self._storage.should_compact():
+                self.compact()
+        else:
+            self.flush()
+
+    def flush(self):
+        '''
+        保存状态
+        * 共享模式下会先合并其他进程的更改, 并写入本进程尚未保存的 metrics
+        * 增量写入时会压缩
+        '''
+        self.fold_metrics()
+        if self._shared:
+            with self.write(publish=False):
+                pass  # write() 结束时会保存
+        elif self._storage.incremental:
+            self.compact()
+        else:
+            self.save()
+
+    def close_storage(self):
+        '''
+        保存并关闭存储后端 (launcher 在启动多个 worker 前调用)
+        * json 后端之后不再使用日志 (日志只能由一个进程写入), 每次修改直接保存 data.json
+        * sqlite 后端在各 worker 中重新连接
+        '''
+        self.flush()
+        self._storage.close()
+
+    @contextmanager
+    def write(self, publish: bool = True, remote: bool = False):
+        '''
+        修改状态 (上下文管理器), 所有对状态的修改都应在此进行
+        * 共享模式下会先加载其他进程的更改, 结束后保存并通知其他进程
+        * 没有任何修改时不保存 / 通知, 也不调用 `publish()`
+
+        ```
+        with d.write() as data:
+            data['status'] = 1
+        ```
+
+        :param publish: 结束后是否调用 `publish()` (嵌套调用时只由最外层处理)
+        :param remote: 是否为其他节点的更改 (见 `apply_records()`), 不再通知 record 监听函数
+        '''
+        with tracing.span('data.write', {'state.remote': remote}):
+            ticket = None
+            unchanged = False
+            with self._write_lock:
+                outer = self._write_depth == 0
+                shared = self._shared if outer else None
+                if shared:
+                    shared.lock.acquire()
+                self._write_depth += 1
+                try:
+                    if outer:
+                        if shared:
+                            self._sync_locked()
+                        # 复制快照 (顶层 + 第二层 dict, 如 device_status), 在副本上修改
+                        self._draft = {k: dict(v) if isinstance(v, dict) else v for k, v in self._data.items()}
+                        self._draft_owner = threading.get_ident()
+                    yield self._draft
+                    if outer:
+                        owned: set[str] = set()
+                        hook_records: list[dict] = []
+                        for hook, key in self._write_hooks:
+                            try:
+                                result = hook(self._data, self._draft)
+                            except Exception as e:
+                                u.warning(f'[write] Hook error: {e}')
+                                continue
+                            if key is not None:
+                                owned.add(key)
+                                hook_records.extend(result or ())
+                        # 没有任何修改 (如 `expire_devices()` 重新检查后均未过期) 时不替换 / 保存 / 通知
+                        # * 未修改的项与快照为同一对象, 比较的开销很小
+                        unchanged = not hook_records and self._draft == self._data and not (shared and self._metrics_pending)
+                        if not unchanged:
+                            # 一次性替换 (发生异常时丢弃副本, 状态不变)
+                            old, self._data = self._data, self._draft
+                            self._draft = None
+                            self._changes += 1
+                            notify = self._remote_listeners if remote else self._record_listeners
+                            if self._storage.incremental or notify:
+                                records = journal.diff_records(old, self._data, skip=owned) + hook_records
+                            if notify and records:
+                                # 在锁中通知, 保证顺序与修改顺序一致
+                                self._notify_records(records, remote)
+                            if self._storage.incremental:
+                                # 只写入变化的项
+                                changes = self._changes
+                                if shared and self._metrics_pending:
+                                    # 共享模式: 本进程尚未保存的 metrics (已合并到快照中)
+                                    records = records + [{'op': 'set', 'k': 'metrics', 'v': self._data['metrics']}]
+                                ticket = self._storage.append(records)
+                    if shared and not unchanged:
+                        if ticket is not None:
+                            self._commit(ticket, changes)  # 持有跨进程锁时提交
+                            ticket = None
+                        else:
+                            self.save()
+                        self._metrics_pending = {}
+                        shared.version.value += 1
+                        self._shared_seen = shared.version.value
+                finally:
+                    self._write_depth -= 1
+                    if outer:
+                        self._draft = None
+                        self._draft_owner = None
+                    if shared:
+                        shared.lock.release()
+            if ticket is not None:
+                # 释放锁后提交 (组提交: 多个线程同时修改时只 fsync 一次); 持久化后再通知订阅者
+                self._commit(ticket, changes)
+            if publish and outer and not unchanged:
+                self.publish()
+
+    def apply_records(self, records: list[dict]) -> bool:
+        '''
+        应用其他节点的更改 (记录格式同 `journal.py`), 并通知本地的 SSE 订阅者
+
+        :return: 状态是否有变化 (没有变化时不修改)
+        '''
+        current = self.data
+        probe = {k: dict(v) if isinstance(v, dict) else v for k, v in current.items()}
+        for record in records:
+            journal.apply_record(probe, record)
+        if not journal.diff_records(current, probe):
+            return False
+        with self.write(remote=True) as data:
+            for record in records:
+                journal.apply_record(data, record)
+        return True
 
     def dset(self, name, value):
         '''
         设置一个值
         '''
-        self.data[name] = value
+        with self._write_lock:
+            self._set(name, value)
 
     def dget(self, name, default=None):
         '''
@@ -103,26 +381,352 @@ class data:
             gotdata = default
         return gotdata
 
+    # --- Version / Broadcast (SSE) / Cache
+
+    @property
+    def version(self) -> int:
+        '''
+        当前状态版本 (单调递增, 每次 `publish()` +1)
+        '''
+        return self._version
+
+    @property
+    def metrics_version(self) -> int:
+        '''
+        当前 metrics 版本 (每次记录访问 +1)
+        '''
+        return self._metrics_version
+
+    @property
+    def modified(self) -> float:
+        '''
+        状态最后一次更改 (`publish()`) 的时间戳
+        '''
+        return self._modified
+
+    @property
+    def ambiguous_second(self) -> int:
+        '''
+        最近一次发生多次更改的秒 (`Last-Modified` 只精确到秒, 此秒内的不同版本无法区分)
+        '''
+        return self._ambiguous_second
+
+    @property
+    def instance(self) -> str:
+        '''
+        当前进程的标识 (版本号只在同一进程内有意义, 用于生成 ETag 等)
+        '''
+        return f'{os.getpid():x}-{self._boot:x}'
+
+    @property
+    def boot_time(self) -> int:
+        '''
+        进程启动 (创建 data 实例) 的时间戳
+        '''
+        return self._boot
+
+    @property
+    def auto_switches(self) -> int:
+        '''
+        启动后自动切换状态的次数
+        '''
+        return self._auto_switches
+
+    @property
+    def pending_changes(self) -> int:
+        '''
+        上次成功保存后的更改次数 (为 0 即无需保存)
+        '''
+        return self._changes - self._saved_changes
+
+    @property
+    def last_flush_duration(self) -> float:
+        '''
+        上次保存 (或提交) 的耗时 *(秒)*
+        '''
+        return self._flush_duration
+
+    def memory_objects(self) -> dict:
+        '''
+        主要的内存结构 (用于 `/admin/memory` 统计大小)
+        '''
+        data = self.data
+        return {
+            'device_status': data.get('device_status', {}),
+            'metrics': data.get('metrics') or {},
+            'analytics': data.get('analytics') or {},
+            'response_cache': self._cache,
+            'metrics_shards': list(self._metrics_shards),
+            'heartbeat_heap': self._hb_heap
+        }
+
+    def persist_stats(self) -> dict:
+        '''
+        持久化状态 (用于 API 返回)
+        '''
+        return {
+            'backend': self._storage.name,
+            'pending_changes': self.pending_changes,
+            'last_flush_duration': round(self._flush_duration, 6),
+            'last_flush_time': self._flushed_at
+        }
+
+    def publish(self):
+        '''
+        通知所有 SSE 订阅者状态已更改 (在修改状态后调用)
+        * 版本号 +1, 旧版本的缓存随之失效
+        * 内容不会立即序列化, 而是由第一个被唤醒的订阅者生成一次, 其余订阅者复用
+        '''
+        with tracing.span('sse.publish') as span:
+            with self._event_cond:
+                self._version += 1
+                now = time()
+                if int(now) == int(self._modified):
+                    self._ambiguous_second = int(now)  # 先于 `_modified` 设置, 读到新时间时一定能读到此值
+                self._modified = now
+                version = self._version
+                # 订阅者序列化此版本时关联到此次更改的追踪 (见 `publish_trace()`)
+                self._publish_trace = (version, span.context) if span else None
+                self._event_cond.notify_all()
+            if span:
+                span.set('state.version', version)
+            for listener in self._listeners:
+                try:
+                    listener(version)
+                except Exception as e:
+                    u.warning(f'[publish] Listener error: {e}')
+
+    def publish_trace(self, version: int) -> tuple[str, str] | None:
+        '''
+        产生此版本的更改的追踪上下文 (未被采样 / 已有更新的版本时为 None)
+        '''
+        trace = self._publish_trace
+        return trace[1] if trace and trace[0] == version else None
+
+    def add_listener(self, listener):
+        '''
+        添加状态更改监听函数 (在 `publish()` 的调用线程中执行, 需尽快返回)
+
+        :param listener: 接受一个参数 (新版本号) 的函数
+        '''
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        '''
+        移除状态更改监听函数
+        '''
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def add_write_hook(self, hook, key: str | None = None):
+        '''
+        添加修改 hook (在 `write()` 结束前, 替换快照前调用, 可继续修改副本; 如 `analytics.py`)
+
+        :param hook: 接受两个参数 (旧快照, 修改后的副本) 的函数
+        :param key: hook 负责的项: 此项的更改不再整体比较, 由 hook 返回的记录列表描述 (格式同 `journal.py`, 只写入变化的部分)
+        '''
+        self._write_hooks.append((hook, key))
+
+    def add_record_listener(self, listener, remote: bool = False):
+        '''
+        添加更改记录监听函数 (本地修改后在写入锁中调用, 需尽快返回; 用于跨节点广播)
+
+        :param listener: 接受一个参数 (记录列表, 格式同 `journal.py`) 的函数
+        :param remote: 是否同时接收其他进程 / 节点的更改 (`apply_records()` / 重新加载时), 此时监听函数接受两个参数 (记录列表, 是否为其他进程 / 节点的更改)
+        '''
+        self._record_listeners.append(listener)
+        if remote:
+            self._remote_listeners.append(listener)
+
+    def remove_record_listener(self, listener):
+        '''
+        移除更改记录监听函数
+        '''
+        for listeners in (self._record_listeners, self._remote_listeners):
+            try:
+                listeners.remove(listener)
+            except ValueError:
+                pass
+
+    def _notify_records(self, records: list[dict], remote: bool = False):
+        for listener in (self._remote_listeners if remote else self._record_listeners):
+            try:
+                if listener in self._remote_listeners:
+                    listener(records, remote)
+                else:
+                    listener(records)
+            except Exception as e:
+                u.warning(f'[write] Record listener error: {e}')
+
+    def wait_event(self, last_version: int | None, timeout: float) -> int:
+        '''
+        等待状态更改
+
+        :param last_version: 订阅者上次收到的版本 (为 None 则立即返回)
+        :param timeout: 最长等待时间 *(秒)*
+        :return: 当前版本 (与 `last_version` 相同即为超时)
+        '''
+        with self._event_cond:
+            if last_version == self._version:
+                self._event_cond.wait(timeout)
+            return self._version
+
+    def cached(self, key, builder, version: int | None = None) -> tuple[int, Any]:
+        '''
+        获取按版本缓存的内容 (同一版本 + 同一 key 只生成一次)
+
+        :param key: 缓存项名 (如 `('query', ...)`, 可包含视图参数)
+        :param builder: 无参数的生成函数
+        :param version: 缓存所对应的版本 (默认为 `self.version`)
+        :return: (版本, 内容)
+        '''
+        if version is None:
+            version = self._version
+        entry = self._cache.get(key)
+        if entry and entry[0] == version:
+            return entry
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if not (entry and entry[0] == version):
+                # 先读版本再生成, 保证缓存内容不会比其版本号更旧
+                entry = (version, builder())
+                self._cache[key] = entry
+        return entry
+
+    # --- Shared state (multi-process)
+
+    def enable_shared(self, version, lock, interval: float = 0.5):
+        '''
+        启用多进程共享状态 (由 `launcher.py` 在 worker 进程中调用)
+        * 所有进程通过存储后端 (data.json / SQLite) 共享状态, 通过共享内存中的版本号得知其他进程的更改
+        * 修改状态 (`write()`) 时持有跨进程锁, 避免互相覆盖
+
+        :param version: `multiprocessing.Value('q')`, 共享版本号
+        :param lock: `multiprocessing.Lock()`, 跨进程锁
+        :param interval: 后台检查其他进程更改的间隔 *(秒)*, 用于及时唤醒 SSE 订阅者
+        '''
+        self._shared = SimpleNamespace(version=version, lock=lock)
+        self._shared_seen = -1  # 强制首次同步
+        self.sync()
+        self._shared_thread = threading.Thread(target=self._shared_watch, args=(interval,), daemon=True)
+        self._shared_thread.start()
+
+    def sync(self):
+        '''
+        (共享模式) 如其他进程已修改状态, 重新加载
+        * 未修改时开销仅为比较一个共享整数, 可在每个请求前调用
+        '''
+        shared = self._shared
+        if not shared or shared.version.value == self._shared_seen:
+            return
+        with self._write_lock:
+            with shared.lock:
+                changed = self._sync_locked()
+        if changed:
+            self.publish()
+
+    def _sync_locked(self) -> bool:
+        '''
+        (共享模式, 需持有锁) 重新加载保存的状态, 并重新应用本进程尚未保存的 metrics
+
+        :return: 公开状态是否有变化
+        '''
+        shared = self._shared
+        seen = shared.version.value  # type: ignore
+        if seen == self._shared_seen:
+            return False
+        keys = ('status', 'device_status', 'private_mode', 'last_updated')
+        old_data = self._data
+        old = [old_data.get(k) for k in keys]
+        new = self.load(ret=True)
+        if env.util.metrics:
+            metrics = new.get('metrics') or self._empty_metrics()
+            if self._metrics_pending:
+                metrics = self._increase(self._rollover(metrics), self._metrics_pending)
+            new['metrics'] = metrics
+        self.data = new
+        if self._remote_listeners:
+            self._notify_records(journal.diff_records(old_data, new), remote=True)
+        # 刚从文件加载, 只有本进程尚未保存的 metrics 算作待保存的更改
+        self._saved_changes = self._changes - sum(self._metrics_pending.values())
+        self._metrics_version += 1
+        self._shared_seen = seen
+        return old != [new.get(k) for k in keys]
+
+    @property
+    def storage(self) -> storage.Storage:
+        '''
+        存储后端 (见 `storage.py`)
+        '''
+        return self._storage
+
+    @property
+    def storage_shared(self) -> bool:
+        '''
+        存储后端是否已在多个进程 / 节点间共享状态 (如 `redis`), 此时无需 `enable_shared()`
+        '''
+        return self._storage.shared
+
+    def _on_remote_change(self):
+        '''
+        (共享的存储后端) 其他进程 / 节点修改了状态, 重新加载
+        * 先提交本进程尚未提交的记录 (如 metrics), 重新加载后不会丢失
+        '''
+        keys = ('status', 'device_status', 'private_mode', 'last_updated')
+        with self._write_lock:
+            self._commit(None, self._changes)
+            old_data = self._data
+            old = [old_data.get(k) for k in keys]
+            new = self.load(ret=True)
+            self.data = new
+            if self._remote_listeners:
+                self._notify_records(journal.diff_records(old_data, new), remote=True)
+            self._metrics_version += 1
+        if old != [new.get(k) for k in keys]:  # type: ignore
+            self.publish()
+
+    def _shared_watch(self, interval: float):
+        '''
+        (共享模式) 后台线程, 定时检查其他进程的更改
+        '''
+        while True:
+            sleep(interval)
+            try:
+                self.sync()
+            except Exception as e:
+                u.warning(f'[shared] Sync error: {e}')
+
     # --- Metrics
 
+    @staticmethod
+    def _empty_metrics() -> dict:
+        return {
+            'today_is': '',
+            'month_is': '',
+            'year_is': '',
+            'today': {},
+            'month': {},
+            'year': {},
+            'total': {}
+        }
+
     def metrics_init(self):
-        try:
-            self.data['metrics']
-        except KeyError:
-            u.debug('[metrics] Metrics data init')
-            self.data['metrics'] = {
-                'today_is': '',
-                'month_is': '',
-                'year_is': '',
-                'today': {},
-                'month': {},
-                'year': {},
-                'total': {}
-            }
-            self.record_metrics()
+        '''
+        初始化 metrics (需在 `start_timer_check()` 之前调用): 不存在时创建, 并写入当前的 日 / 月 / 年
+        * 日期为空时, 0 点的定时器会误认为已跨月 / 跨年, 清空第一天的 本月 / 本年 统计
+        '''
+        with self._write_lock:
+            if 'metrics' not in self.data:
+                u.debug('[metrics] Metrics data init')
+                self._set('metrics', self._rollover(self._empty_metrics()))
+                self._metrics_version += 1
+                return
+        self.check_metrics_time()  # 已有的统计可能来自之前的日期
 
     def get_metrics_resp(self, json_only: bool = False):
-        now = datetime.now(pytz.timezone(env.main.timezone))
+        now = u.now()
         '''
         if json_only:
             # 仅用于调试
@@ -139,126 +743,444 @@ class data:
             }
         else:
         '''
-        return u.format_dict({
-            'time': f'{now}',
+        # 按 metrics 版本 + 格式缓存序列化结果, 每次请求只拼接当前时间
+        self.fold_metrics()
+        pretty = u.want_pretty()
+        metrics = self.data['metrics']  # 同一快照
+        _, (head, tail) = self.cached(('metrics', pretty), lambda: u.prebuild({
+            'time': u.TIME_PLACEHOLDER,
             'timezone': env.main.timezone,
-            'today_is': self.data['metrics']['today_is'],
-            'month_is': self.data['metrics']['month_is'],
-            'year_is': self.data['metrics']['year_is'],
-            'today': self.data['metrics']['today'],
-            'month': self.data['metrics']['month'],
-            'year': self.data['metrics']['year'],
-            'total': self.data['metrics']['total']
-        })
+            'today_is': metrics['today_is'],
+            'month_is': metrics['month_is'],
+            'year_is': metrics['year_is'],
+            'today': metrics['today'],
+            'month': metrics['month'],
+            'year': metrics['year'],
+            'total': metrics['total']
+        }, pretty=pretty), version=self._metrics_version)
+        return u.json_response(head + u.dumps(f'{now}') + tail)
 
-    def check_metrics_time(self) -> None:
-        '''
-        跨 日 / 月 / 年 检测
+    @staticmethod
+    def _rollover(metrics: dict) -> dict:
         '''
-        if not env.util.metrics:
-            return
+        跨 日 / 月 / 年 检测 (不修改传入的 dict)
 
+        :return: 需要清空时返回新的 dict, 否则返回原 dict
+        '''
         # get time now
-        now = datetime.now(pytz.timezone(env.main.timezone))
+        now = u.now()
         year_is = str(now.year)
         month_is = f'{now.year}-{now.month}'
         today_is = f'{now.year}-{now.month}-{now.day}'
 
         # - check time
-        if self.data['metrics']['today_is'] != today_is:
-            u.debug(f'[metrics] today_is changed: {self.data["metrics"]["today_is"]} -> {today_is}')
-            self.data['metrics']['today_is'] = today_is
-            self.data['metrics']['today'] = {}
+        new = None
+        if metrics['today_is'] != today_is:
+            u.debug(f'[metrics] today_is changed: {metrics["today_is"]} -> {today_is}')
+            new = {**metrics, 'today_is': today_is, 'today': {}}
         # this month
-        if self.data['metrics']['month_is'] != month_is:
-            u.debug(f'[metrics] month_is changed: {self.data["metrics"]["month_is"]} -> {month_is}')
-            self.data['metrics']['month_is'] = month_is
-            self.data['metrics']['month'] = {}
+        if metrics['month_is'] != month_is:
+            u.debug(f'[metrics] month_is changed: {metrics["month_is"]} -> {month_is}')
+            new = {**(new or metrics), 'month_is': month_is, 'month': {}}
         # this year
-        if self.data['metrics']['year_is'] != year_is:
-            u.debug(f'[metrics] year_is changed: {self.data["metrics"]["year_is"]} -> {year_is}')
-            self.data['metrics']['year_is'] = year_is
-            self.data['metrics']['year'] = {}
+        if metrics['year_is'] != year_is:
+            u.debug(f'[metrics] year_is changed: {metrics["year_is"]} -> {year_is}')
+            new = {**(new or metrics), 'year_is': year_is, 'year': {}}
+        return new or metrics
+
+    @staticmethod
+    def _increase(metrics: dict, increments: dict[str, int]) -> dict:
+        '''
+        返回计数增加后的新 metrics dict (不修改传入的 dict)
+
+        :param increments: 路径 -> 增加的计数
+        '''
+        new = dict(metrics)
+        for bucket in journal.METRIC_BUCKETS:
+            counts = dict(metrics.get(bucket, {}))
+            for path, count in increments.items():
+                counts[path] = counts.get(path, 0) + count
+            new[bucket] = counts
+        return new
+
+    def check_metrics_time(self) -> None:
+        '''
+        跨 日 / 月 / 年 检测
+        '''
+        if not env.util.metrics:
+            return
+        with self._write_lock:
+            metrics = self.data.get('metrics')
+            if metrics is None:
+                return  # 尚未初始化 (见 `metrics_init()`)
+            new = self._rollover(metrics)
+            if new is not metrics:
+                self._set('metrics', new)
+        self._metrics_version += 1
 
     def record_metrics(self, path: str | None = None) -> None:
         '''
-        记录调用
+        记录调用 (每个请求都会调用)
+        * 只增加当前线程的计数: 不加锁, 不检查日期, 不修改状态; 由 `fold_metrics()` 合并
+        * 跨 日 / 月 / 年 由定时器在 0 点处理 (见 `start_metrics_rollover()`)
 
         :param path: 访问的路径
         '''
-
-        # check metrics list
-        if not path in metrics_list:
+        if path not in self._metrics_paths:
             return
+        shard: _MetricsShard | None = getattr(self._metrics_local, 'shard', None)
+        if shard is None:
+            shard = _MetricsShard()
+            self._metrics_local.shard = shard
+            with self._metrics_shards_lock:
+                self._metrics_shards.append(shard)
+        counts = shard.counts
+        counts[path] = counts.get(path, 0) + 1
+        shard.total += 1
 
-        self.check_metrics_time()
+    def fold_metrics(self) -> bool:
+        '''
+        将各线程的计数合并到状态中 (读取 / 保存 metrics 前调用)
+        * 没有新的计数时开销仅为比较各线程的总数
 
-        # - record num
-        today = self.data['metrics'].setdefault('today', {})
-        month = self.data['metrics'].setdefault('month', {})
-        year = self.data['metrics'].setdefault('year', {})
-        total = self.data['metrics'].setdefault('total', {})
+        :return: 是否有新的计数
+        '''
+        shards = self._metrics_shards
+        if all(shard.total == shard.folded_total for shard in shards):
+            return False
+        with self._write_lock:
+            increments: dict[str, int] = {}
+            for shard in list(shards):
+                total = shard.total  # 先读总数: 之后读到的计数不会少于此
+                if total != shard.folded_total:
+                    for path, count in list(shard.counts.items()):
+                        delta = count - shard.folded.get(path, 0)
+                        if delta:
+                            increments[path] = increments.get(path, 0) + delta
+                            shard.folded[path] = count
+                    shard.folded_total = total
+                if not shard.thread.is_alive():
+                    # 线程已结束 (不会再有新的计数)
+                    with self._metrics_shards_lock:
+                        self._metrics_shards.remove(shard)
+            if not increments:
+                return False
+            new = self._increase(self.data.get('metrics') or self._empty_metrics(), increments)
+            # 日志只记录这些路径的计数 (`n` 为增量, 供 redis 后端原子增加)
+            records = [{'op': 'metric', 'p': path, 'v': [new[b][path] for b in journal.METRIC_BUCKETS], 'n': count} for path, count in increments.items()]
+            self._set('metrics', new, records)
+            self._metrics_version += 1
+            if self._shared:
+                # 共享模式: 记录本进程尚未保存的增量, 在下次 write() 时合并
+                for path, count in increments.items():
+                    self._metrics_pending[path] = self._metrics_pending.get(path, 0) + count
+        return True
 
-        today[path] = today.get(path, 0) + 1
-        month[path] = month.get(path, 0) + 1
-        year[path] = year.get(path, 0) + 1
-        total[path] = total.get(path, 0) + 1
+    def start_metrics_rollover(self):
+        '''
+        启动跨日定时器: 在下一天的 0 点 (配置的时区) 合并计数并清空 今日 (/ 本月 / 本年) 的统计, 然后重新计时
+        '''
+        if not env.util.metrics:
+            return
+        self.check_metrics_time()  # 启动时可能已跨日
+        delay = u.next_day() - time() + 1  # 稍晚于 0 点, 避免时钟误差
+        timer = threading.Timer(delay, self._metrics_rollover)
+        timer.daemon = True
+        timer.start()
+        self._metrics_timer = timer
+
+    def stop_metrics_rollover(self):
+        '''
+        停止跨日定时器
+        '''
+        timer, self._metrics_timer = self._metrics_timer, None
+        if timer:
+            timer.cancel()
+
+    def _metrics_rollover(self):
+        try:
+            self.fold_metrics()  # 0 点之前的计数计入前一天
+            self.check_metrics_time()
+            u.debug(f'[metrics] Rolled over to {self.data["metrics"]["today_is"]}')
+        except Exception as e:
+            u.warning(f'[metrics] Rollover error: {e}')
+        if self._metrics_timer is not None:
+            self.start_metrics_rollover()
 
     # --- Timer check - save data
 
     def start_timer_check(self, data_check_interval: int = 60):
         '''
-        使用 threading 启动下面的 `timer_check()`
+        使用 threading 启动下面的 `timer_check()` (以及设备心跳检查 / metrics 跨日定时器, 见 `start_heartbeat_check()` / `start_metrics_rollover()`)
 
         :param data_check_interval: 检查间隔 *(秒)*
         '''
         self.data_check_interval = data_check_interval
-        self.timer_thread = threading.Thread(target=self.timer_check, daemon=True)
+        self._timer_stop = threading.Event()
+        self.timer_thread = threading.Thread(target=self.timer_check, args=(self._timer_stop,), daemon=True)
         self.timer_thread.start()
+        self.start_heartbeat_check()
+        self.start_metrics_rollover()
+
+    def stop_timer_check(self):
+        '''
+        停止 `timer_check()` 线程 (launcher 主进程不处理请求, 也不应保存数据)
+        '''
+        self.stop_heartbeat_check()
+        self.stop_metrics_rollover()
+        self._timer_stop.set()
+        timer_thread = getattr(self, 'timer_thread', None)
+        if timer_thread:
+            timer_thread.join(timeout=10)
 
-    def check_device_status(self, trigged_by_timer: bool = False):
+    def check_device_status(self, trigged_by_timer: bool = False) -> bool:
         '''
-        按情况自动切换状态
+        按情况自动切换状态 (需在 `write()` 中调用)
 
         :param trigged_by_timer: 是否由计时器触发 (为 True 将不记录日志)
+        :return: 状态是否被切换
         '''
-        device_status: dict = self.data.get('device_status', {})
-        current_status: int = self.data.get('status', 0)  # 获取当前 status，默认为 0
-        auto_switch_enabled: bool = env.util.auto_switch_status
-
-        # 检查是否启用自动切换功能，并且当前 status 为 0 或 1
-        last_status = self.data['status']
-        if auto_switch_enabled:
-            if current_status in [0, 1]:
-                any_using = any(device.get('using', False) for device in device_status.values())
-                if any_using:
-                    self.data['status'] = 0
-                else:
-                    self.data['status'] = 1
-                if last_status != self.data['status']:
-                    u.debug(f'[check_device_status] 已自动切换状态 ({last_status} -> {self.data["status"]}).')
-                elif not trigged_by_timer:
-                    u.debug(f'[check_device_status] 当前状态已为 {current_status}, 无需切换.')
-            elif not trigged_by_timer:
-                u.debug(f'[check_device_status] 当前状态为 {current_status}, 不适用自动切换.')
+        with tracing.span('check_device_status'):
+            data = self.data  # write() 中为副本
+            current_status: int = data.get('status', 0)  # 获取当前 status，默认为 0
+            auto_switch_enabled: bool = env.util.auto_switch_status
+
+            # 检查是否启用自动切换功能，并且当前 status 为 0 或 1
+            last_status = data['status']
+            if auto_switch_enabled:
+                if current_status in [0, 1]:
+                    data['status'] = self._auto_status(data)
+                    if last_status != data['status']:
+                        self._auto_switches += 1
+                        if u.debugging():
+                            u.debug(f'[check_device_status] 已自动切换状态 ({last_status} -> {data["status"]}).')
+                    elif not trigged_by_timer and u.debugging():
+                        u.debug(f'[check_device_status] 当前状态已为 {current_status}, 无需切换.')
+                elif not trigged_by_timer and u.debugging():
+                    u.debug(f'[check_device_status] 当前状态为 {current_status}, 不适用自动切换.')
+            return last_status != data['status']
+
+    @staticmethod
+    def _auto_status(data: dict) -> int | None:
+        '''
+        自动切换的目标状态 (有设备在使用为 0, 否则为 1), 不适用自动切换时返回 None
+        '''
+        if not env.util.auto_switch_status or data.get('status', 0) not in [0, 1]:
+            return None
+        any_using = any(device.get('using', False) for device in data.get('device_status', {}).values())
+        return 0 if any_using else 1
 
-    def timer_check(self):
+    def timer_check(self, stop: threading.Event):
         '''
         定时检查更改并自动保存
         * 根据 `data_check_interval` 参数调整 sleep() 的秒数
         * 需要使用 threading 启动新线程运行
+
+        :param stop: 停止标志 (见 `stop_timer_check()`)
         '''
         u.info(f'[timer_check] started, interval: {self.data_check_interval} seconds.')
-        while True:
-            sleep(self.data_check_interval)
+        while not stop.wait(self.data_check_interval):
             try:
-                self.check_metrics_time()  # 检测是否跨日
-                self.check_device_status(trigged_by_timer=True)  # 检测设备状态并更新 status
-                file_data = self.load(ret=True)
-                if file_data != self.data:
-                    self.save()
+                self.fold_metrics()  # 合并各线程的 metrics 计数
+                self.sync()
+                data = self.data
+                target = self._auto_status(data)
+                if target is not None and target != data['status']:
+                    # 只在需要切换时才修改 (避免产生无意义的更改)
+                    with self.write(publish=False):
+                        changed = self.check_device_status(trigged_by_timer=True)  # 检测设备状态并更新 status
+                    if changed:
+                        self.publish()
+                pending = self.pending_changes
+                if pending:
+                    # 只在有更改时保存 (不再读取保存的状态比较)
+                    self.persist()
+                    if u.debugging():
+                        u.debug(f'[timer_check] saved {pending} changes in {self._flush_duration * 1000:.1f}ms.')
             except Exception as e:
                 u.warning(f'[timer_check] Error: {e}, retrying.')
 
     # --- check device heartbeat
-    # TODO
+
+    @staticmethod
+    def _parse_ttl(value: str) -> dict[str, int]:
+        '''
+        解析单独设置的设备超时 (`设备id:秒,设备id:秒`)
+        '''
+        ttl = {}
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            device_id, _, seconds = item.rpartition(':')
+            try:
+                ttl[device_id.strip()] = int(seconds)
+            except ValueError:
+                u.warning(f'[heartbeat] Invalid device ttl: {item.strip()}, ignored.')
+        return ttl
+
+    def _heartbeat_deadline(self, device_id: str, device: dict | None) -> float | None:
+        '''
+        设备的过期时间 (上次上报时间 + 超时), 不会过期时返回 None
+        * 超时不适用 (为 0) / 设备不存在 / 已标记为未在使用 (`not_using` 模式) 时不会过期
+        '''
+        if device is None:
+            return None
+        ttl = self._hb_ttl.get(device_id, env.status.device_ttl)
+        if ttl <= 0:
+            return None
+        if env.status.device_expire != 'remove' and not device.get('using', False):
+            return None
+        # 没有上报时间的设备 (旧版本保存) 从启动检查时开始计算
+        return device.get('last_seen', self._hb_started) + ttl
+
+    def start_heartbeat_check(self):
+        '''
+        启动设备心跳检查线程 (未设置超时时不启动)
+        * 每个设备在最小堆中最多一项 (过期时间, 设备 id), 线程只在最早的过期时间醒来, 不轮询所有设备
+        * 设备上报时不更新堆 (O(1)): 到期时重新读取设备的上报时间, 未过期则按新的过期时间放回 (O(log n))
+        * 多进程 / 多节点时上报时间随状态同步, 以最新的上报时间为准
+        '''
+        self._hb_ttl = self._parse_ttl(env.status.device_ttl_ids)
+        if env.status.device_ttl <= 0 and not any(ttl > 0 for ttl in self._hb_ttl.values()):
+            return
+        self._hb_stop = threading.Event()
+        self._hb_cond = threading.Condition()
+        self._hb_started = time()
+        with self._write_lock:
+            heap = []
+            for device_id, device in self.data.get('device_status', {}).items():
+                deadline = self._heartbeat_deadline(device_id, device)
+                if deadline is not None:
+                    heap.append((deadline, device_id))
+            heapq.heapify(heap)
+            self._hb_heap = heap
+            self._hb_scheduled = {device_id for _, device_id in heap}
+            # 本地 / 其他进程的设备更改都会经过此监听函数
+            self.add_record_listener(self._heartbeat_records, remote=True)
+        self.hb_thread = threading.Thread(target=self.heartbeat_check, args=(self._hb_stop, self._hb_cond), daemon=True)
+        self.hb_thread.start()
+        u.info(f'[heartbeat] started, default ttl: {env.status.device_ttl} seconds, on expire: {env.status.device_expire}.')
+
+    def stop_heartbeat_check(self):
+        '''
+        停止设备心跳检查线程
+        '''
+        self.remove_record_listener(self._heartbeat_records)
+        with self._hb_cond:
+            self._hb_stop.set()
+            self._hb_cond.notify()
+        hb_thread = getattr(self, 'hb_thread', None)
+        if hb_thread:
+            hb_thread.join(timeout=10)
+
+    def _heartbeat_records(self, records: list[dict], remote: bool):
+        '''
+        (record 监听函数) 设置设备时加入检查
+        '''
+        for record in records:
+            if record['op'] == 'dev':
+                self.touch_device(record['id'], record['v'])
+
+    def touch_device(self, device_id: str, device: dict):
+        '''
+        将设备加入心跳检查 (已在堆中时无需操作, 到期时会重新读取上报时间)
+        '''
+        with self._hb_cond:
+            if device_id in self._hb_scheduled:
+                return
+            deadline = self._heartbeat_deadline(device_id, device)
+            if deadline is None:
+                return
+            self._hb_scheduled.add(device_id)
+            heapq.heappush(self._hb_heap, (deadline, device_id))
+            if self._hb_heap[0][1] == device_id:
+                self._hb_cond.notify()  # 比原来最早的过期时间更早, 唤醒线程
+
+    def heartbeat_check(self, stop: threading.Event, cond: threading.Condition):
+        '''
+        设备心跳检查线程: 等待到最早的过期时间, 处理到期的设备
+
+        :param stop: 停止标志 (见 `stop_heartbeat_check()`)
+        :param cond: 新的设备加入时唤醒
+        '''
+        while not stop.is_set():
+            with cond:
+                now = time()
+                heap = self._hb_heap
+                due = []
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap)[1])
+                if not due:
+                    cond.wait(heap[0][0] - now if heap else None)
+                    continue
+                data = self.data
+                expired = []
+                for device_id in due:
+                    deadline = self._heartbeat_deadline(device_id, data.get('device_status', {}).get(device_id))
+                    if deadline is None:
+                        self._hb_scheduled.discard(device_id)  # 已移除 / 未在使用, 再次设置时重新加入
+                    elif deadline > now:
+                        heapq.heappush(heap, (deadline, device_id))  # 期间有上报, 按新的过期时间放回
+                    else:
+                        self._hb_scheduled.discard(device_id)
+                        expired.append(device_id)
+            if expired:
+                try:
+                    self.expire_devices(expired)
+                except Exception as e:
+                    u.warning(f'[heartbeat] Error: {e}')
+
+    def expire_devices(self, device_ids: list[str]):
+        '''
+        将超时未上报的设备标记为未在使用 / 移除 (与 `/device/set` 等接口相同, 经过 `write()` 保存并推送)
+
+        :param device_ids: 已到期的设备 id
+        '''
+        now = time()
+
+        def is_expired(device_id: str, devices: dict) -> bool:
+            deadline = self._heartbeat_deadline(device_id, devices.get(device_id))
+            return deadline is not None and deadline <= now
+
+        # 先在当前快照上检查, 均未过期 (期间有新的上报) 时不进入写入锁
+        current = self.data.get('device_status', {})
+        device_ids = [i for i in device_ids if is_expired(i, current)]
+        if not device_ids:
+            return
+        with self.write() as data:
+            devices = data['device_status']
+            expired = []
+            for device_id in device_ids:
+                # 重新检查 (共享模式下 write() 已同步其他进程的更改, 期间可能有新的上报)
+                if not is_expired(device_id, devices):
+                    continue
+                if env.status.device_expire == 'remove':
+                    del devices[device_id]
+                else:
+                    device = devices[device_id]
+                    devices[device_id] = {
+                        **device,
+                        'using': False,
+                        'app_name': env.status.not_using or device['app_name']
+                    }
+                expired.append(device_id)
+            if expired:
+                data['last_updated'] = u.nowstr()
+                self.check_device_status()
+        if expired:
+            u.info(f'[heartbeat] Device expired ({env.status.device_expire}): {", ".join(expired)}')
+
+
+class _MetricsShard:
+    '''
+    单个线程的 metrics 计数 (只由所属线程增加, `fold_metrics()` 合并时只读取)
+    * 计数只增不减, 已合并的部分记录在 `folded` 中, 因此合并时无需与所属线程同步
+    '''
+    __slots__ = ('thread', 'counts', 'total', 'folded', 'folded_total')
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.counts: dict[str, int] = {}
+        self.total: int = 0
+        self.folded: dict[str, int] = {}
+        self.folded_total: int = 0
@@ -0,0 +1,119 @@
+# coding: utf-8
+
+'''
+增量 SSE (`/events?mode=delta`) 的变更日志
+
+- 连接时发送一次完整的 `update` 事件, 之后只发送 `patch` 事件 (变更 / 新增 / 移除的设备 + 变更的顶层字段 + 服务端时间)
+- 每个版本的 patch 只计算 / 序列化一次, 在所有订阅者间共享; 每个事件带有序号 (SSE `id`)
+- 订阅者落后太多 (序号已不在日志中) 时改为发送完整快照
+'''
+
+import threading
+from collections import deque
+from typing import Callable
+
+import utils as u
+import tracing
+
+# 保留的 patch 数量 (更早的订阅者将收到完整快照)
+JOURNAL_SIZE = 64
+
+
+def diff(old: dict, new: dict) -> dict:
+    '''
+    比较两个 `/query` 快照 (不含 `time`)
+
+    :return: `{"fields": {...}, "changed": {...}, "removed": [...], "order": [...] (顺序变化时)}`
+    '''
+    fields = {k: v for k, v in new.items() if k != 'device' and old.get(k) != v}
+    old_devices: dict = old['device']
+    new_devices: dict = new['device']
+    changed = {k: v for k, v in new_devices.items() if old_devices.get(k) != v}
+    removed = [k for k in old_devices if k not in new_devices]
+    patch = {
+        'fields': fields,
+        'changed': changed,
+        'removed': removed
+    }
+    # 排序 (`sorted` / `using_first`) 导致顺序变化时附带完整顺序, 否则客户端按 "原有顺序 + 新增项在末尾" 处理
+    expected = [k for k in old_devices if k in new_devices] + [k for k in new_devices if k not in old_devices]
+    if expected != list(new_devices):
+        patch['order'] = list(new_devices)
+    return patch
+
+
+class DeltaJournal:
+    '''
+    增量事件日志 (线程安全)
+
+    :param d: data 实例 (提供 `version`)
+    :param builder: 生成当前 `/query` 返回 dict 的函数 (参数为 `time` 文本)
+    '''
+
+    def __init__(self, d, builder: Callable[[str], dict], size: int = JOURNAL_SIZE):
+        self._d = d
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._seq: int | None = None  # 最新快照的序号 (即生成时的 d.version)
+        self._snapshot: dict = {}  # 最新快照 (不含 time)
+        self._full: bytes | None = None  # 最新快照的 `update` 事件文本 (按需生成)
+        self._journal: deque[tuple[int, int, bytes]] = deque(maxlen=size)  # (上一序号, 序号, `patch` 事件文本)
+
+    def _advance(self):
+        '''
+        将快照更新到当前版本, 并记录 patch (需持有 `_lock`)
+        '''
+        version = self._d.version
+        if version == self._seq:
+            return
+        # 先读版本再生成, 保证快照不会比其序号更旧
+        with tracing.resume(self._d.publish_trace(version), 'sse.serialize', {'sse.mode': 'delta', 'state.version': version}):
+            now = u.nowstr()
+            ret = self._builder(now)
+            ret.pop('time', None)
+            ret['device'] = {k: dict(v) for k, v in ret['device'].items()}
+            if self._seq is not None:
+                patch = diff(self._snapshot, ret)
+                patch['fields']['time'] = now  # 生成此 patch 时的服务端时间 (客户端随 fields 一并更新)
+                patch['base'] = self._seq
+                patch['seq'] = version
+                self._journal.append((self._seq, version, b'event: patch\nid: %d\ndata: %s\n\n' % (version, u.dumps(patch))))
+        self._seq = version
+        self._snapshot = ret
+        self._full = None
+
+    def _full_payload(self) -> bytes:
+        '''
+        最新快照的完整 `update` 事件 (需持有 `_lock`)
+        '''
+        if self._full is None:
+            ret = {'time': u.nowstr(), **self._snapshot, 'seq': self._seq}
+            self._full = b'event: update\nid: %d\ndata: %s\n\n' % (self._seq, u.dumps(ret))
+        return self._full
+
+    def memory_objects(self) -> dict:
+        '''
+        占用内存的结构 (用于 `/admin/memory` 统计大小)
+        '''
+        return {
+            'delta_snapshot': (self._snapshot, self._full),
+            'delta_journal': self._journal
+        }
+
+    def since(self, seq: int | None) -> tuple[int, list[bytes]]:
+        '''
+        获取订阅者从 `seq` 更新到最新所需的事件
+
+        :param seq: 订阅者已收到的最新序号 (None 为新连接)
+        :return: (最新序号, 事件文本列表)
+        '''
+        with self._lock:
+            self._advance()
+            if seq == self._seq:
+                return self._seq, []
+            if seq is not None:
+                for i, (base, _, _) in enumerate(self._journal):
+                    if base == seq:
+                        # 日志中的 patch 首尾相连, 从此处起全部发送
+                        return self._seq, [payload for _, _, payload in list(self._journal)[i:]]
+            return self._seq, [self._full_payload()]
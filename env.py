@@ -15,7 +15,7 @@ def getenv(key: str, default: Any, typeobj: Callable) -> Any:
 
     :param key: 键
     :param default: 默认值 (未读取到此项配置时使用)
-    :param typeobj: 类型对象 (str / int / bool)
+    :param typeobj: 类型对象 (str / int / float / bool)
     '''
     got_value = os.getenv(key.lower()) or os.getenv(key.upper()) # 全大写 / 全小写皆可
     if got_value is None:
@@ -40,6 +40,67 @@ class _main:
     https_enabled: bool = getenv('sleepy_main_https_enabled', False, bool)
     ssl_cert: str = getenv('sleepy_main_ssl_cert', 'cert.pem', str)
     ssl_key: str = getenv('sleepy_main_ssl_key', 'key.pem', str)
+    cache_max_age: int = getenv('sleepy_main_cache_max_age', 1, int)
+    cache_stale_while_revalidate: int = getenv('sleepy_main_cache_stale_while_revalidate', 5, int)
+
+
+class _server:
+    '''
+    (server) 启动器 (launcher.py) 配置
+    '''
+    mode: str = getenv('sleepy_server_mode', 'auto', str)
+    workers: int = getenv('sleepy_server_workers', 0, int)
+    threads: int = getenv('sleepy_server_threads', 0, int)
+    shared_state: bool = getenv('sleepy_server_shared_state', True, bool)
+    graceful_timeout: int = getenv('sleepy_server_graceful_timeout', 10, int)
+
+
+class _log:
+    '''
+    (log) 日志配置
+    '''
+    level: str = getenv('sleepy_log_level', 'debug' if _main.debug else 'info', str)
+    console: str = getenv('sleepy_log_console', 'text', str)
+    file: str = getenv('sleepy_log_file', '', str)
+    max_bytes: int = getenv('sleepy_log_max_bytes', 10485760, int)
+    backups: int = getenv('sleepy_log_backups', 5, int)
+    buffered: bool = getenv('sleepy_log_buffered', True, bool)
+    batch: int = getenv('sleepy_log_batch', 512, int)
+    queue_size: int = getenv('sleepy_log_queue_size', 10000, int)
+    sample: str = getenv('sleepy_log_sample', '', str)
+
+
+class _trace:
+    '''
+    (trace) 请求追踪
+    '''
+    sample: float = getenv('sleepy_trace_sample', 0.0, float)
+    file: str = getenv('sleepy_trace_file', 'traces.jsonl', str)
+    max_bytes: int = getenv('sleepy_trace_max_bytes', 10485760, int)
+    backups: int = getenv('sleepy_trace_backups', 3, int)
+
+
+class _storage:
+    '''
+    (storage) 状态持久化配置
+    '''
+    backend: str = getenv('sleepy_storage_backend', 'json', str)
+    path: str = getenv('sleepy_storage_path', '', str)
+    redis_url: str = getenv('sleepy_storage_redis_url', '', str)
+    redis_prefix: str = getenv('sleepy_storage_redis_prefix', 'sleepy:', str)
+    journal: bool = getenv('sleepy_storage_journal', True, bool)
+    fsync: bool = getenv('sleepy_storage_fsync', True, bool)
+    compact_bytes: int = getenv('sleepy_storage_compact_bytes', 1048576, int)
+
+
+class _bus:
+    '''
+    (bus) 跨节点事件总线
+    '''
+    type: str = getenv('sleepy_bus_type', '', str)
+    path: str = getenv('sleepy_bus_path', '/tmp/sleepy-bus', str)
+    url: str = getenv('sleepy_bus_url', 'redis://127.0.0.1:6379/0', str)
+    channel: str = getenv('sleepy_bus_channel', 'sleepy:events', str)
 
 
 class _page:
@@ -72,6 +133,9 @@ class _status:
     show_loading: bool = getenv('sleepy_status_show_loading', True, bool)
     refresh_interval: int = getenv('sleepy_status_refresh_interval', 5000, int)
     not_using: str = getenv('sleepy_status_not_using', '', str)
+    device_ttl: int = getenv('sleepy_status_device_ttl', 0, int)
+    device_ttl_ids: str = getenv('sleepy_status_device_ttl_ids', '', str)
+    device_expire: str = getenv('sleepy_status_device_expire', 'not_using', str)
 
 
 class _util:
@@ -84,9 +148,21 @@ class _util:
     steam_api_url: str = getenv('sleepy_util_steam_api_url', 'https://steam-miniprofile-proxy.wyf9.top/miniprofile/', str)
     steam_ids: str = getenv('sleepy_util_steam_ids', '', str)
     steam_refresh_interval: int = getenv('sleepy_util_steam_refresh_interval', 20000, int)
+    history: bool = getenv('sleepy_util_history', True, bool)
+    history_size: int = getenv('sleepy_util_history_size', 200, int)
+    history_spill: bool = getenv('sleepy_util_history_spill', False, bool)
+    analytics: bool = getenv('sleepy_util_analytics', True, bool)
+    analytics_apps: int = getenv('sleepy_util_analytics_apps', 50, int)
+    openmetrics: bool = getenv('sleepy_util_openmetrics', True, bool)
+    diagnostics: bool = getenv('sleepy_util_diagnostics', True, bool)
 
 
 main = _main()
+server = _server()
+log = _log()
+trace = _trace()
+storage = _storage()
+bus = _bus()
 page = _page()
 status = _status()
 util = _util()
@@ -0,0 +1,331 @@
+# coding: utf-8
+
+'''
+设备状态历史 (`/device/history`)
+
+- 只记录变化 (使用状态 / 应用名 / 移除), 重复的相同上报不占用空间
+- 每个设备一个固定容量的环形缓冲区: 时间戳 (`array('q')`) + 应用名编号 (`array('I')`, 应用名去重存储) + 标志位 (`bytearray`), 每条约 13 字节
+- 缓冲区满时覆盖最早的记录; 存储后端支持时 (`sqlite`) 可将被覆盖的记录写入数据库, 查询时合并
+  (多进程共享状态时, 每条记录只由修改状态的进程写入)
+- 查询范围内的记录过多时按时间分段降采样, 每段只返回最后一条 (即该段结束时的状态)
+'''
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from time import time
+
+import utils as u
+import env as env
+
+# 标志位
+USING = 1
+REMOVED = 2
+
+
+class Interner:
+    '''
+    应用名 <-> 编号 (多个设备 / 多条记录共用同一个字符串)
+    '''
+
+    def __init__(self):
+        self.names: list[str] = []
+        self.ids: dict[str, int] = {}
+
+    def intern(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.names.append(name)
+            self.ids[name] = i
+        return i
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+class DeviceHistory:
+    '''
+    单个设备的环形缓冲区 (按时间顺序)
+
+    :param size: 容量
+    '''
+
+    def __init__(self, size: int):
+        self.size = size
+        self.ts = array('q')
+        self.app = array('I')
+        self.flags = bytearray()
+        self._head = 0  # 最早一条的位置 (缓冲区已满时)
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def _index(self, i: int) -> int:
+        return (self._head + i) % len(self.ts)
+
+    def last(self) -> tuple[int, int, int] | None:
+        '''
+        最新一条 (时间戳, 应用名编号, 标志位)
+        '''
+        if not self.ts:
+            return None
+        i = self._index(len(self.ts) - 1)
+        return self.ts[i], self.app[i], self.flags[i]
+
+    def append(self, ts: int, app: int, flags: int) -> tuple[int, int, int] | None:
+        '''
+        追加一条记录
+
+        :return: 被覆盖的最早一条 (缓冲区已满时), 否则为 None
+        '''
+        if len(self.ts) < self.size:
+            self.ts.append(ts)
+            self.app.append(app)
+            self.flags.append(flags)
+            return None
+        i = self._head
+        evicted = (self.ts[i], self.app[i], self.flags[i])
+        self.ts[i], self.app[i], self.flags[i] = ts, app, flags
+        self._head = (i + 1) % self.size
+        return evicted
+
+    def oldest(self) -> int | None:
+        '''
+        最早一条的时间戳
+        '''
+        return self.ts[self._head] if self.ts else None
+
+    def range(self, since: int, until: int) -> list[tuple[int, int, int]]:
+        '''
+        时间在 [since, until] 之间的记录 (二分查找)
+        '''
+        n = len(self.ts)
+        # 按时间顺序的下标 -> 时间戳
+        ordered = _Ordered(self)
+        lo = bisect_left(ordered, since, 0, n)
+        hi = bisect_right(ordered, until, lo, n)
+        result = []
+        for k in range(lo, hi):
+            i = self._index(k)
+            result.append((self.ts[i], self.app[i], self.flags[i]))
+        return result
+
+    def remap(self, mapping: dict[int, int]):
+        '''
+        应用名重新编号后更新 (见 `History._compact_names()`)
+        '''
+        self.app = array('I', (mapping[a] for a in self.app))
+
+    def nbytes(self) -> int:
+        return self.ts.itemsize * len(self.ts) + self.app.itemsize * len(self.app) + len(self.flags)
+
+
+class _Ordered:
+    '''
+    按时间顺序访问环形缓冲区的时间戳 (供 bisect 使用)
+    '''
+
+    def __init__(self, h: DeviceHistory):
+        self._h = h
+
+    def __getitem__(self, k: int) -> int:
+        return self._h.ts[self._h._index(k)]
+
+    def __len__(self) -> int:
+        return len(self._h.ts)
+
+
+class History:
+    '''
+    所有设备的状态历史
+
+    :param d: data 实例
+    :param size: 每个设备保留的记录数
+    :param spill: 是否将被覆盖的记录写入存储后端 (后端不支持时忽略)
+    '''
+
+    def __init__(self, d, size: int = 200, spill: bool = False):
+        self._d = d
+        self.size = max(size, 1)
+        self.spill = spill and d.storage.history
+        if spill and not self.spill:
+            u.warning(f'[history] Storage backend {d.storage.name} cannot keep device history, spill disabled.')
+        self._lock = threading.Lock()
+        self._names = Interner()
+        self._devices: dict[str, DeviceHistory] = {}
+        # 从当前状态开始记录
+        now = int(time())
+        for device_id, device in d.data.get('device_status', {}).items():
+            self._record(device_id, device, now)
+        # 本地 / 其他进程 / 其他节点的更改都会经过此监听函数
+        d.add_record_listener(self._on_records, remote=True)
+
+    def _on_records(self, records: list[dict], remote: bool):
+        '''
+        (record 监听函数, 在写入锁中调用) 记录设备的变化
+
+        :param remote: 是否为其他进程 / 节点的更改 (不写入存储后端, 由修改的进程写入)
+        '''
+        now = int(time())
+        spilled = []
+        with self._lock:
+            for record in records:
+                op = record['op']
+                if op == 'dev':
+                    evicted = self._record(record['id'], record['v'], now)
+                elif op == 'del':
+                    evicted = self._record(record['id'], None, now)
+                elif op == 'set' and record['k'] == 'device_status':
+                    evicted = [self._record(k, v, now) for k, v in record['v'].items()]
+                    evicted += [self._record(k, None, now) for k in self._devices if k not in record['v']]
+                    spilled.extend(e for e in evicted if e)
+                    continue
+                else:
+                    continue
+                if evicted:
+                    spilled.append(evicted)
+            if len(self._names) > 4 * self.size * max(len(self._devices), 1):
+                self._compact_names()
+        if spilled and self.spill and not remote:
+            # 随本次修改一起提交 (组提交)
+            self._d.storage.append([{'op': 'hist', 'id': device_id, 'e': entries} for device_id, entries in spilled])
+
+    def _record(self, device_id: str, device: dict | None, now: int) -> tuple[str, list] | None:
+        '''
+        记录一个设备的状态 (与上一条相同时忽略), 需持有 `_lock`
+
+        :param device: 设备状态, 为 None 表示已移除
+        :return: 需写入存储后端的被覆盖记录 `(设备 id, [[时间戳, 标志位, 应用名]])`, 没有时为 None
+        '''
+        h = self._devices.get(device_id)
+        if device is None:
+            if h is None:
+                return None
+            app, flags = 0, REMOVED
+        else:
+            app, flags = self._names.intern(str(device.get('app_name', ''))), USING if device.get('using') else 0
+        last = h.last() if h is not None else None
+        if last is not None and last[1:] == (app, flags):
+            return None  # 状态未变化
+        if h is None:
+            h = self._devices[device_id] = DeviceHistory(self.size)
+        # 以设备的上报时间为准 (多个进程 / 节点同步时一致), 保证单调不减
+        ts = int(device.get('last_seen', now)) if device is not None else now
+        if last is not None and ts < last[0]:
+            ts = last[0]
+        evicted = h.append(ts, app, flags)
+        if evicted is None:
+            return None
+        return device_id, [[evicted[0], evicted[2], self._names.names[evicted[1]]]]
+
+    def _compact_names(self):
+        '''
+        应用名过多 (大部分已被覆盖) 时重新编号, 丢弃不再使用的应用名 (需持有 `_lock`)
+        '''
+        names = Interner()
+        mapping = {}
+        for h in self._devices.values():
+            for a in set(h.app):
+                if a not in mapping:
+                    mapping[a] = names.intern(self._names.names[a])
+            h.remap(mapping)
+        u.debug(f'[history] Compacted app names: {len(self._names)} -> {len(names)}')
+        self._names = names
+
+    def query(self, device_id: str, since: int = 0, until: int | None = None, limit: int = 100) -> dict | None:
+        '''
+        查询设备历史
+
+        :param since: 起始时间 (秒级时间戳, 包含)
+        :param until: 结束时间 (包含, 默认为当前时间)
+        :param limit: 最多返回的记录数, 超过时降采样
+        :return: `{"total": 范围内的记录数, "downsampled": 是否降采样, "history": [...]}`, 没有此设备的历史时为 None
+        '''
+        if until is None:
+            until = int(time())
+        with self._lock:
+            h = self._devices.get(device_id)
+            if h is not None:
+                entries = [(ts, flags, self._names.names[app]) for ts, app, flags in h.range(since, until)]
+                oldest = h.oldest()
+            else:
+                entries, oldest = [], None
+        if self.spill and (oldest is None or since <= oldest):
+            # 更早的记录已写入存储后端 (与缓冲区中最早一条同一秒的记录可能重复)
+            spilled = self._d.storage.load_history(device_id, since, until if oldest is None else min(until, oldest))
+            kept = [e for e in entries if e[0] == oldest]
+            earlier = []
+            for e in map(tuple, spilled):
+                if e in kept:
+                    kept.remove(e)  # 其他进程写入的, 仍在本进程缓冲区中的记录
+                else:
+                    earlier.append(e)
+            entries = earlier + entries
+        if h is None and not entries:
+            return None
+        total = len(entries)
+        downsampled = total > limit
+        if downsampled:
+            entries = downsample(entries, since if since > 0 else entries[0][0], until, limit)
+        else:
+            entries = [(ts, flags, app, 1) for ts, flags, app in entries]
+        return {
+            'total': total,
+            'downsampled': downsampled,
+            'history': [format_entry(*e) for e in entries]
+        }
+
+    def stats(self) -> dict:
+        '''
+        占用统计
+        '''
+        with self._lock:
+            return {
+                'devices': len(self._devices),
+                'entries': sum(len(h) for h in self._devices.values()),
+                'app_names': len(self._names),
+                'bytes': sum(h.nbytes() for h in self._devices.values())
+            }
+
+
+def downsample(entries: list[tuple], since: int, until: int, limit: int) -> list[tuple]:
+    '''
+    将 [since, until] 分为 `limit` 段, 每段只保留最后一条
+
+    :param entries: 按时间排序的 (时间戳, 标志位, 应用名)
+    :return: (时间戳, 标志位, 应用名, 合并的记录数)
+    '''
+    span = max(until - since, 1)
+    result = []
+    bucket = None
+    for ts, flags, app in entries:
+        b = min((ts - since) * limit // span, limit - 1)
+        if b == bucket:
+            result[-1] = (ts, flags, app, result[-1][3] + 1)
+        else:
+            result.append((ts, flags, app, 1))
+            bucket = b
+    return result
+
+
+def format_entry(ts: int, flags: int, app: str, count: int = 1) -> dict:
+    '''
+    生成返回的历史项
+    '''
+    if flags & REMOVED:
+        entry = {'time': ts, 'removed': True}
+    else:
+        entry = {'time': ts, 'using': bool(flags & USING), 'app_name': app}
+    if count > 1:
+        entry['merged'] = count
+    return entry
+
+
+def open_history(d) -> History | None:
+    '''
+    按配置创建设备历史 (未启用时返回 None)
+    '''
+    if not env.util.history:
+        return None
+    return History(d, size=env.util.history_size, spill=env.util.history_spill)
@@ -0,0 +1,239 @@
+# coding: utf-8
+
+'''
+状态持久化的预写日志 (write-ahead journal)
+
+- 每次修改只追加一行记录 (json, 几十字节) 到 `data.json.journal`, 而不是重写整个 data.json
+- 组提交 (group commit): 多个线程同时提交时只 fsync 一次
+- 压缩 (compaction): 将当前状态写入 data.json (临时文件 + fsync + rename), 然后清空日志
+- 启动时: 加载 data.json, 再重放日志中的记录
+
+记录格式 (均为绝对值, 重复重放结果不变):
+- `{"op": "set", "k": 键, "v": 值}`: 设置顶层项 (如 `status`, `private_mode`, `metrics`)
+- `{"op": "dev", "id": 设备 id, "v": 设备状态}`: 设置设备
+- `{"op": "del", "id": 设备 id}`: 移除设备
+- `{"op": "metric", "p": 路径, "v": [今日, 本月, 本年, 总计]}`: 设置某一路径的统计数
+- `{"op": "ana", "r": {...}, "c": [周期], "s": [[周期, 状态, 秒]], "a": [[周期, 设备 id, 应用名, 秒]]}`: 使用时长统计 (`analytics`) 的变化,
+  `r` 为统计中 `status` / `apps` 以外的部分 (`*_is` / `open`), `c` 为需先清空的周期, `a` 中秒数为 null 即移除此项 (见 `analytics.py`)
+'''
+
+import json
+import os
+import threading
+
+import utils as u
+
+METRIC_BUCKETS = ('today', 'month', 'year', 'total')
+ANALYTICS_BUCKETS = ('today', 'week', 'month', 'year', 'total')
+
+
+def diff_records(old: dict, new: dict, skip: set[str] | frozenset[str] = frozenset()) -> list[dict]:
+    '''
+    比较两个状态快照, 生成日志记录
+    * 未修改的项与旧快照为同一对象 (见 `data.write()`), 先按 `is` 比较
+
+    :param skip: 不比较的项 (已由修改 hook 生成记录)
+    '''
+    records = []
+    for key, value in new.items():
+        old_value = old.get(key)
+        if value is old_value or key in skip:
+            continue
+        if key == 'device_status' and isinstance(old_value, dict):
+            for device_id, device in value.items():
+                old_device = old_value.get(device_id)
+                if device is not old_device and device != old_device:
+                    records.append({'op': 'dev', 'id': device_id, 'v': device})
+            for device_id in old_value:
+                if device_id not in value:
+                    records.append({'op': 'del', 'id': device_id})
+        elif value != old_value:
+            records.append({'op': 'set', 'k': key, 'v': value})
+    return records
+
+
+def apply_record(data: dict, record: dict):
+    '''
+    将一条记录应用到状态上 (原地修改, 仅用于重放)
+    '''
+    op = record['op']
+    if op == 'set':
+        data[record['k']] = record['v']
+    elif op == 'dev':
+        data.setdefault('device_status', {})[record['id']] = record['v']
+    elif op == 'del':
+        data.get('device_status', {}).pop(record['id'], None)
+    elif op == 'metric':
+        metrics = data.get('metrics')
+        if metrics is not None:
+            for bucket, count in zip(METRIC_BUCKETS, record['v']):
+                metrics.setdefault(bucket, {})[record['p']] = count
+    elif op == 'ana':
+        stats = data.get('analytics')
+        if stats is None:
+            stats = data['analytics'] = {'status': {}, 'apps': {}}
+        apply_analytics(stats, record)
+
+
+def apply_analytics(stats: dict, record: dict):
+    '''
+    将一条 `ana` 记录应用到使用时长统计上 (原地修改)
+    '''
+    stats.update(record['r'])
+    for bucket in record.get('c', ()):
+        stats['status'][bucket] = {}
+        stats['apps'][bucket] = {}
+    for bucket, status, seconds in record.get('s', ()):
+        stats['status'].setdefault(bucket, {})[status] = seconds
+    for bucket, device_id, app_name, seconds in record.get('a', ()):
+        apps = stats['apps'].setdefault(bucket, {}).setdefault(device_id, {})
+        if seconds is None:
+            apps.pop(app_name, None)
+        else:
+            apps[app_name] = seconds
+
+
+def replay(data: dict, path: str) -> int:
+    '''
+    重放日志 (先 `.old` 再当前文件) 到状态上
+
+    :param data: 从 data.json 加载的状态 (原地修改)
+    :param path: 日志文件路径
+    :return: 重放的记录数
+    '''
+    count = 0
+    for file in (f'{path}.old', path):
+        if not os.path.exists(file):
+            continue
+        with open(file, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 最后一行可能只写入了一半 (崩溃), 之后的内容不可信
+                    u.warning(f'[journal] Ignoring broken record in {file} after {count} records')
+                    break
+                apply_record(data, record)
+                count += 1
+    return count
+
+
+def fsync_dir(path: str):
+    '''
+    fsync 文件所在目录 (保证 rename 持久化, 不支持的平台忽略)
+    '''
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    '''
+    追加写入的日志文件
+
+    :param path: 日志文件路径
+    :param fsync: 提交时是否 fsync (关闭后只保证写入系统缓存)
+    '''
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()  # 保护缓冲区 / 序号
+        self._commit_lock = threading.Lock()  # 同一时间只有一个线程写入文件
+        self._buf: list[bytes] = []
+        self._seq: int = 0  # 已追加的记录批次序号
+        self._durable: int = 0  # 已写入 (并 fsync) 的序号
+        self._fp = open(path, 'ab')
+        self.size: int = self._fp.tell()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # fork 时其他线程可能持有锁
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+
+    def append(self, records: list[dict]) -> int:
+        '''
+        追加记录到缓冲区 (调用方需保证顺序, 即在 `data` 的写入锁中调用)
+
+        :return: 序号, 传给 `commit()` 以等待写入完成
+        '''
+        if not records:
+            return self._seq
+        lines = b''.join(u.dumps(r) + b'\n' for r in records)
+        with self._lock:
+            self._buf.append(lines)
+            self._seq += 1
+            return self._seq
+
+    def commit(self, seq: int | None = None):
+        '''
+        等待序号 `seq` (默认为全部) 及之前的记录写入文件
+        * 组提交: 等待锁期间其他线程追加的记录, 会由下一个获得锁的线程一起写入, 只 fsync 一次
+        '''
+        if seq is None:
+            seq = self._seq
+        if self._durable >= seq:
+            return
+        with self._commit_lock:
+            if self._durable >= seq:
+                return  # 已被其他线程一并提交
+            with self._lock:
+                buf, upto = self._buf, self._seq
+                self._buf = []
+            if buf:
+                data = b''.join(buf)
+                self._fp.write(data)
+                self._fp.flush()
+                if self.fsync:
+                    os.fsync(self._fp.fileno())
+                self.size += len(data)
+            self._durable = upto
+
+    @property
+    def pending(self) -> bool:
+        '''
+        是否有尚未写入文件的记录
+        '''
+        return self._durable < self._seq
+
+    def rotate(self):
+        '''
+        开始压缩: 提交全部记录, 将当前日志改名为 `.old` 并打开新日志
+        * 需在 `data` 的写入锁中调用 (此时没有新的记录)
+        * 压缩完成 (data.json 已替换) 后调用 `drop_old()`
+        '''
+        self.commit()
+        with self._commit_lock:
+            self._fp.close()
+            if os.path.exists(f'{self.path}.old'):
+                # 上次压缩未完成: 合并到 .old, 避免丢失
+                with open(f'{self.path}.old', 'ab') as old, open(self.path, 'rb') as cur:
+                    old.write(cur.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, f'{self.path}.old')
+            self._fp = open(self.path, 'ab')
+            self.size = 0
+
+    def drop_old(self):
+        '''
+        压缩完成, 删除 `.old`
+        '''
+        try:
+            os.remove(f'{self.path}.old')
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self.commit()
+        with self._commit_lock:
+            self._fp.close()
@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+启动器: 多进程 (pre-fork) + SO_REUSEPORT
+
+- 主进程加载 `server.py` 后 fork 出多个 worker, 每个 worker 各自监听同一端口 (SO_REUSEPORT, 由内核分配连接)
+- worker 意外退出后自动重启; `SIGHUP` 重载 (停止所有 worker 后重新执行主进程, 重新读取代码 / .env / 设置); `SIGTERM` / `SIGINT` 退出 (worker 退出前保存数据)
+- 共享模式 (`sleepy_server_shared_state`): worker 之间通过存储后端 (data.json / SQLite) + 共享内存中的版本号同步状态, 不会各自为政 (`redis` 后端本身即共享状态, 也支持多个节点)
+- 不支持 fork / SO_REUSEPORT 的平台 (如 Windows), 或只有 1 个 worker 时, 直接在当前进程中启动
+- 开启调试模式 (`sleepy_main_debug`) 时仍使用 Flask 自带的开发服务器 (支持自动重载代码)
+'''
+
+import multiprocessing as mp
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from types import ModuleType
+
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+import env
+import utils as u
+
+RESTART_DELAY = 5  # worker 启动后很快退出时, 等待多久再重启 (s)
+
+
+def auto_workers() -> int:
+    '''
+    worker 进程数 (`sleepy_server_workers`, 为 0 则按 CPU 核心数, 最多 8 个)
+    '''
+    if env.server.workers > 0:
+        return env.server.workers
+    return min(os.cpu_count() or 1, 8)
+
+
+def auto_threads() -> int:
+    '''
+    asgi 模式下每个 worker 处理普通请求的线程数 (`sleepy_server_threads`, 为 0 则为 CPU 核心数 x 4, 至少 16 个)
+    * wsgi 模式下每个连接使用一个线程, 不受此限制
+    '''
+    if env.server.threads > 0:
+        return env.server.threads
+    return max(16, (os.cpu_count() or 1) * 4)
+
+
+def server_mode() -> str:
+    '''
+    服务模式 (`sleepy_server_mode`, 为 `auto` 时已安装 uvicorn 则使用 asgi, 否则使用 wsgi)
+    * asgi 模式下 SSE 连接不占用线程, 适合大量访客同时打开页面
+    '''
+    mode = env.server.mode.lower()
+    if mode == 'auto':
+        try:
+            import uvicorn  # type: ignore - 可选依赖
+            return 'asgi'
+        except ImportError:
+            return 'wsgi'
+    return mode
+
+
+def can_prefork() -> bool:
+    '''
+    当前平台是否支持 pre-fork + SO_REUSEPORT
+    '''
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def bind_socket(reuse_port: bool) -> socket.socket:
+    '''
+    创建并监听 socket
+
+    :param reuse_port: 是否设置 SO_REUSEPORT (多个 worker 监听同一端口)
+    '''
+    family = socket.AF_INET6 if ':' in env.main.host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((env.main.host, env.main.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+# --- WSGI
+
+class _RequestHandler(WSGIRequestHandler):
+    '''
+    使用 HTTP/1.1 (没有长度的响应如 SSE 使用分块传输)
+    * werkzeug 处理完每个请求后仍会关闭连接; 需要 keep-alive 时请使用 asgi 模式, 或在前面使用 Nginx 等反向代理
+    '''
+    protocol_version = 'HTTP/1.1'
+
+
+class CountingWSGIServer(ThreadedWSGIServer):
+    '''
+    每个连接一个线程的 WSGI 服务器 (同 `app.run()`), 并记录进行中的连接数 (用于退出时等待)
+    * 不使用固定大小的线程池: SSE 连接 (`/events`) 会一直占用所在的线程, 线程池占满后其他请求将无法处理
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.active: int = 0
+        self._active_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._active_lock:
+            self.active += 1
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            with self._active_lock:
+                self.active -= 1  # 线程未能启动
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._active_lock:
+                self.active -= 1
+
+
+def serve_wsgi(srv: ModuleType, sock: socket.socket):
+    '''
+    在当前进程中运行 WSGI 服务器, 收到 `SIGTERM` / `SIGINT` 后等待请求处理完毕, 保存数据并退出
+    '''
+    ssl_context = (env.main.ssl_cert, env.main.ssl_key) if env.main.https_enabled else None
+    httpd = CountingWSGIServer(
+        env.main.host, env.main.port, srv.app,
+        handler=_RequestHandler,
+        ssl_context=ssl_context,
+        fd=sock.fileno()
+    )
+    sock.close()  # fromfd() 已复制
+
+    def stop(signum, frame):
+        # serve_forever() 所在线程不能直接调用 shutdown()
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    httpd.serve_forever()
+    httpd.server_close()  # 不再接受新连接
+
+    # 等待进行中的请求 (SSE 连接不会主动结束, 超时后直接退出)
+    deadline = time.time() + env.server.graceful_timeout
+    while httpd.active > 0 and time.time() < deadline:
+        time.sleep(0.1)
+    u.info(f'[launcher] Worker {os.getpid()} exiting, saving data...')
+    srv.d.flush()
+    if srv.cluster:
+        srv.cluster.stop()
+
+
+# --- ASGI
+
+def serve_asgi(srv: ModuleType, sock: socket.socket, threads: int):
+    '''
+    在当前进程中运行 ASGI 服务器 (uvicorn), 退出时由 asgi.py 的 lifespan 保存数据
+    '''
+    try:
+        import uvicorn  # type: ignore - 可选依赖
+    except ImportError:
+        u.error('[launcher] asgi mode requires uvicorn, please run: pip install uvicorn')
+        raise
+    import asgi
+    asgi.configure(threads)
+    config = uvicorn.Config(
+        asgi.application,
+        ssl_certfile=env.main.ssl_cert if env.main.https_enabled else None,
+        ssl_keyfile=env.main.ssl_key if env.main.https_enabled else None,
+        log_level='debug' if env.main.debug else 'warning',
+        lifespan='on',
+        timeout_graceful_shutdown=env.server.graceful_timeout
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+# --- Worker
+
+def worker(srv: ModuleType, sock: socket.socket, threads: int, shared: tuple | None = None):
+    '''
+    worker 进程入口 (fork 之后)
+
+    :param srv: 已加载的 server 模块
+    :param sock: 已监听的 socket
+    :param threads: 线程数
+    :param shared: 共享模式下的 (共享版本号, 跨进程锁)
+    '''
+    d = srv.d
+    if shared:
+        d.enable_shared(*shared)
+    else:
+        d.load()  # 主进程中的状态可能已过期
+        if env.util.metrics:
+            d.metrics_init()
+    d.start_timer_check(data_check_interval=env.main.checkdata_interval)
+    if srv.cluster:
+        srv.cluster.start()  # 每个 worker 作为一个节点
+    mode = server_mode()
+    u.info(f'[launcher] Worker {os.getpid()} started ({mode}{f", {threads} threads" if mode == "asgi" else ""}).')
+    if mode == 'asgi':
+        serve_asgi(srv, sock, threads)
+    else:
+        serve_wsgi(srv, sock)
+
+
+class Master:
+    '''
+    主进程: 管理 worker 进程 (启动 / 重启 / 重载 / 退出), 本身不处理请求
+    '''
+
+    def __init__(self, srv: ModuleType, workers: int, threads: int):
+        self.srv = srv
+        self.workers = workers
+        self.threads = threads
+        self.children: dict[int, float] = {}  # pid -> 启动时间
+        self.stopping = False
+        self.reloading = False
+        if srv.d.storage_shared:
+            # 存储后端 (如 redis) 本身即在进程 / 节点间共享状态
+            self.shared = None
+        elif env.server.shared_state:
+            # 需在 fork 之前创建, 由所有 worker 继承
+            self.shared = (mp.Value('q', 0, lock=False), mp.Lock())
+        else:
+            self.shared = None
+            u.warning('[launcher] Shared state disabled, every worker will keep its own state!')
+
+    def spawn(self):
+        '''
+        fork 一个新的 worker
+        '''
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                worker(self.srv, bind_socket(reuse_port=True), self.threads, self.shared)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                u.flush_logs()
+                os._exit(code)
+        self.children[pid] = time.time()
+
+    def reap(self):
+        '''
+        回收已退出的 worker, 并按需重启
+        '''
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, time.time())
+            if self.stopping or self.reloading:
+                continue
+            u.warning(f'[launcher] Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting')
+            if time.time() - started < 1:
+                # 启动后立即退出 (如端口被占用), 避免不停重启
+                time.sleep(RESTART_DELAY)
+            self.spawn()
+
+    def stop_workers(self):
+        '''
+        停止所有 worker (等待保存数据, 超时后强制结束)
+        '''
+        pids = list(self.children)
+        self.kill(pids, signal.SIGTERM)
+        self.wait(pids, env.server.graceful_timeout + 5)
+        if self.children:
+            u.warning(f'[launcher] Killing {len(self.children)} workers not exited in time')
+            self.kill(list(self.children), signal.SIGKILL)
+            self.wait(list(self.children), 5)
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def wait(self, pids, timeout: float):
+        '''
+        等待指定的 worker 退出
+        '''
+        deadline = time.time() + timeout
+        while any(pid in self.children for pid in pids) and time.time() < deadline:
+            time.sleep(0.1)
+            self.reap()
+
+    def run(self):
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        def on_reload(signum, frame):
+            self.reloading = True
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+
+        # 主进程不处理请求, 也不保存数据 / 不参与广播
+        self.srv.d.stop_timer_check()
+        if self.srv.cluster:
+            self.srv.cluster.stop()
+        # 保存并关闭存储后端 (json 后端的日志只能由一个进程写入; sqlite / redis 连接不能跨进程使用)
+        self.srv.d.close_storage()
+        mode = 'storage-shared' if self.srv.d.storage_shared else 'shared' if self.shared else 'separate'
+        u.info(f'[launcher] Master {os.getpid()} starting {self.workers} workers ({mode} state).')
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self.stopping and not self.reloading:
+            time.sleep(1)
+            self.reap()
+
+        u.info('[launcher] Stopping workers...')
+        self.stop_workers()
+        if self.reloading and not self.stopping:
+            # 主进程中已加载的代码 / 配置不会变化, 需重新执行自身才能读取新的版本 (同单进程模式)
+            # * 等待 worker 退出期间收到 `SIGTERM` / `SIGINT` 时不再重载
+            reexec()
+
+
+def reexec():
+    '''
+    重新执行当前进程 (重载: 重新读取代码 / .env / 设置; 进程 id 不变)
+    '''
+    u.info('[launcher] Reloading...')
+    u.flush_logs()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def run(srv: ModuleType | None = None):
+    '''
+    启动服务
+
+    :param srv: 已加载的 server 模块 (为 None 则导入)
+    '''
+    if srv is None:
+        import server as srv
+    # asgi.py 等模块通过 `import server` 获取 app 和 data, 需指向同一个模块 (如 server.py 作为 __main__ 运行)
+    sys.modules.setdefault('server', srv)
+
+    u.info(f'=============== hi {env.page.user}! ===============')
+    listening = f'{f"[{env.main.host}]" if ":" in env.main.host else env.main.host}:{env.main.port}'
+    if env.main.https_enabled:
+        u.info(f'Starting HTTPS server: https://{listening}{" (debug enabled)" if env.main.debug else ""}')
+        u.info(f'Using SSL certificate: {env.main.ssl_cert}')
+        u.info(f'Using SSL key: {env.main.ssl_key}')
+    else:
+        u.info(f'Starting HTTP server: http://{listening}{" (debug enabled)" if env.main.debug else ""}')
+
+    if env.main.debug:
+        # 调试模式: Flask 开发服务器
+        try:
+            srv.app.run(  # 启↗动↘
+                host=env.main.host,
+                port=env.main.port,
+                debug=env.main.debug,
+                ssl_context=(env.main.ssl_cert, env.main.ssl_key) if env.main.https_enabled else None
+            )
+        except Exception as e:
+            u.error(f"Error running server: {e}")
+        print()
+        u.info('Server exited, saving data...')
+        srv.d.flush()
+        u.info('Bye.')
+        return
+
+    workers = auto_workers()
+    threads = auto_threads()
+    if workers > 1 and can_prefork():
+        Master(srv, workers, threads).run()
+    else:
+        if workers > 1:
+            u.warning('[launcher] pre-fork (fork + SO_REUSEPORT) is not supported on this platform, using 1 worker.')
+        mode = server_mode()
+        u.info(f'[launcher] Running in single process ({mode}{f", {threads} threads" if mode == "asgi" else ""}).')
+        reload = []
+        if hasattr(signal, 'SIGHUP'):
+            # 单进程模式下的重载: 正常退出 (保存数据) 后重新执行自身
+            def on_reload(signum, frame):
+                reload.append(signum)
+                os.kill(os.getpid(), signal.SIGTERM)
+            signal.signal(signal.SIGHUP, on_reload)
+        try:
+            if mode == 'asgi':
+                serve_asgi(srv, bind_socket(reuse_port=False), threads)
+            else:
+                serve_wsgi(srv, bind_socket(reuse_port=False))
+        except Exception as e:
+            u.error(f"Error running server: {e}")
+            srv.d.flush()
+        if reload:
+            reexec()
+    u.info('Bye.')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,289 @@
+# coding: utf-8
+
+'''
+异步日志 (`utils.info()` / `utils.access()` 等的实现)
+
+- 调用线程只做级别判断 / 采样判断 + 入队, 不格式化字符串, 不等待输出
+- 后台线程批量取出记录, 格式化后一次性写入控制台 (与原来相同的文本格式, 或 json lines) 和日志文件 (json lines, 按大小轮转)
+- 队列已满时丢弃新记录 (并在之后输出丢弃的数量), 不阻塞请求
+'''
+
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR
+}
+_LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+# 控制台文本格式中的级别标识
+_LEVEL_TEXT = {
+    DEBUG: '⚙️  [Debug]',
+    INFO: 'ℹ️  [Info]',
+    WARNING: '⚠️  [Warning]',
+    ERROR: '❌  [Error]'
+}
+
+
+def parse_sample(text: str) -> dict[str, float]:
+    '''
+    解析采样配置
+
+    :param text: `/events:0.1,/query:0.5` (路径: 保留比例)
+    '''
+    ret = {}
+    for item in text.split(','):
+        path, sep, rate = item.strip().rpartition(':')
+        if sep and path:
+            ret[path] = float(rate)
+    return ret
+
+
+class AsyncLogger:
+    '''
+    异步 + 批量日志
+
+    :param level: 最低级别 (`DEBUG` / `INFO` / ...)
+    :param console: 控制台输出格式 (`text` / `json` / `off`)
+    :param file: 日志文件路径 (json lines), 为空则不写入文件
+    :param max_bytes: 日志文件轮转大小 (0 为不轮转)
+    :param backups: 保留的旧日志文件数量
+    :param batch: 每批最多处理的记录数
+    :param interval: 等待新记录的最长间隔 (秒)
+    :param queue_size: 队列长度
+    :param sample: 访问日志的采样比例 (`{路径: 保留比例}`)
+    :param buffered: 是否使用后台线程 (为 False 时在调用线程中直接输出, 便于调试)
+    '''
+
+    def __init__(self, level: int = INFO, console: str = 'text', file: str = '', max_bytes: int = 0, backups: int = 0,
+                 batch: int = 512, interval: float = 0.2, queue_size: int = 10000, sample: dict[str, float] | None = None, buffered: bool = True):
+        self.level = level
+        self.console = console
+        self.file = file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.interval = interval
+        self.queue_size = queue_size
+        self.sample = sample or {}
+        self.buffered = buffered
+        self.dropped = 0
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # fork 后子进程中没有写入线程, 且不应重复输出父进程队列中的记录
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        '''
+        初始化队列 / 写入线程 / 文件状态
+        '''
+        self._queue: queue.Queue = queue.Queue(self.queue_size)
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._drop_lock = threading.Lock()  # 多个线程同时丢弃时保护 `dropped`
+        self._thread: threading.Thread | None = None
+        self._fp = None
+        self._size = 0
+
+    # --- Producer
+
+    def enabled(self, level: int) -> bool:
+        '''
+        此级别的日志是否会被记录 (可在构造开销较大的日志内容前判断)
+        '''
+        return level >= self.level
+
+    def log(self, level: int, args: tuple, extra: dict | None = None, newline: bool = False):
+        '''
+        记录一条日志 (参数原样入队, 在写入线程中才格式化)
+
+        :param level: 级别
+        :param args: 同 `print()` 的参数
+        :param extra: 附加字段 (仅 json 格式输出)
+        :param newline: 文本格式时在前面添加空行 (`utils.infon()`)
+        '''
+        if level < self.level:
+            return
+        record = (time.time(), level, args, extra, newline)
+        if not self.buffered:
+            with self._write_lock:
+                self._write([record])
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+    def _drop(self):
+        '''
+        队列已满, 丢弃一条记录 (计数, 之后由写入线程输出)
+        '''
+        with self._drop_lock:
+            self.dropped += 1
+
+    def access(self, path: str, ip1: str | None, ip2: str | None = None):
+        '''
+        记录一次请求 (可按路径采样)
+
+        :param path: 路径
+        :param ip1: 客户端 ip
+        :param ip2: `X-Forwarded-For` 头 (如有)
+        '''
+        if INFO < self.level:
+            return
+        rate = self.sample.get(path)
+        if rate is not None and random.random() >= rate:
+            return
+        if ip2:
+            args = ('- Request:', ip1, '/', ip2, ':', path)
+        else:
+            args = ('- Request:', ip1, ':', path)
+        self.log(INFO, args, {'type': 'access', 'path': path, 'ip': ip1, 'forwarded_for': ip2})
+
+    def flush(self, timeout: float = 5):
+        '''
+        等待队列中已有的记录全部写入
+        '''
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self._queue.put((0, None, done, None, False), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    # --- Writer
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sleepy-logger', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        '''
+        写入线程: 阻塞等待第一条记录, 再取出已有的记录 (最多 `batch` 条) 一次性写入
+        '''
+        while True:
+            try:
+                records = [self._queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            while len(records) < self.batch:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.dropped:
+                with self._drop_lock:
+                    dropped, self.dropped = self.dropped, 0
+                records.append((time.time(), WARNING, (f'[logger] queue full, dropped {dropped} records',), None, False))
+            markers = [r[2] for r in records if r[1] is None]
+            try:
+                with self._write_lock:
+                    self._write([r for r in records if r[1] is not None])
+            except Exception as e:
+                sys.stderr.write(f'[logger] write failed: {e}\n')
+            for done in markers:
+                done.set()
+
+    def _write(self, records: list):
+        '''
+        格式化并写入一批记录
+        '''
+        if not records:
+            return
+        if self.console == 'text':
+            sys.stdout.write(''.join(self._format_text(r) for r in records))
+            sys.stdout.flush()
+        lines = [self._format_json(r) for r in records] if (self.file or self.console == 'json') else []
+        if self.console == 'json':
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        if self.file:
+            self._write_file(''.join(lines).encode('utf-8'))
+
+    @staticmethod
+    def _format_text(record) -> str:
+        t, level, args, _, newline = record
+        prefix = datetime.fromtimestamp(t).strftime('[%Y-%m-%d %H:%M:%S]')
+        line = f'{prefix} {_LEVEL_TEXT[level]} {" ".join(map(str, args))}\n'
+        return '\n' + line if newline else line
+
+    @staticmethod
+    def _format_json(record) -> str:
+        t, level, args, extra, _ = record
+        ret = {
+            'time': datetime.fromtimestamp(t).astimezone().isoformat(timespec='milliseconds'),
+            'level': _LEVEL_NAMES[level],
+            'pid': os.getpid(),
+            'msg': ' '.join(map(str, args))
+        }
+        if extra:
+            ret.update(extra)
+        return json.dumps(ret, ensure_ascii=False, default=str) + '\n'
+
+    # --- File
+
+    def _write_file(self, data: bytes):
+        '''
+        追加写入日志文件, 超过 `max_bytes` 时轮转
+        * 多进程时各进程以追加模式写入同一文件; 如发现文件已被其他进程轮转则重新打开
+        '''
+        if self._fp is not None:
+            try:
+                if os.stat(self.file).st_ino != os.fstat(self._fp.fileno()).st_ino:
+                    self._close()
+            except FileNotFoundError:
+                self._close()
+        if self._fp is None:
+            dirname = os.path.dirname(self.file)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._fp = open(self.file, 'ab')
+            self._size = self._fp.tell()
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._fp.write(data)
+        self._fp.flush()
+        self._size += len(data)
+
+    def _close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def _rotate(self):
+        '''
+        `file` -> `file.1` -> `file.2` ... (保留 `backups` 个)
+        '''
+        self._close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f'{self.file}.{i}'
+                if os.path.exists(src):
+                    os.replace(src, f'{self.file}.{i + 1}')
+            if os.path.exists(self.file):
+                os.replace(self.file, f'{self.file}.1')
+        else:
+            # 不保留旧文件时直接清空
+            open(self.file, 'wb').close()
+        self._fp = open(self.file, 'ab')
+        self._size = self._fp.tell()
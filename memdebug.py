@@ -0,0 +1,238 @@
+# coding: utf-8
+
+'''
+内存诊断 (`/admin/memory`)
+
+- 按需启动 tracemalloc (启动前没有任何开销; 启动后每次分配都会记录, 排查完成后应停止)
+- 保存命名的快照, 返回分配最多的位置 / 两个快照之间的增长, 可按 模块 (如 `data.py` / `flask`) / 文件 / 行 分组
+- 主要内存结构 (设备表 / metrics / 响应缓存等) 的大小 (递归计算, 见 `sizeof()`)
+'''
+
+import os
+import sys
+import sysconfig
+import threading
+import tracemalloc
+from collections import deque
+from types import FunctionType, ModuleType
+
+import utils as u
+
+# 最多保存的快照数 (超出时丢弃最早的)
+MAX_SNAPSHOTS = 8
+# 分组方式 -> tracemalloc 的 key_type
+GROUPS = {'module': 'filename', 'file': 'filename', 'line': 'lineno'}
+
+_ROOT = os.path.dirname(u.get_path('server.py')) + os.sep
+_STDLIB = sysconfig.get_paths()['stdlib'] + os.sep
+
+
+class NotTracing(Exception):
+    '''
+    tracemalloc 未启动
+    '''
+
+
+def module_of(filename: str) -> str:
+    '''
+    文件 -> 所属模块
+    - 本项目的文件: 相对路径 (如 `data.py`)
+    - 第三方库: 包名 (如 `flask`, `werkzeug`)
+    - 标准库: `stdlib/<模块>` (如 `stdlib/json`)
+    '''
+    parts = filename.replace('\\', '/').split('/')
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts:
+            i = parts.index(marker)
+            if i + 1 < len(parts):
+                return os.path.splitext(parts[i + 1])[0]
+    if filename.startswith(_ROOT):
+        return filename[len(_ROOT):].replace('\\', '/')
+    if filename.startswith(_STDLIB):
+        return 'stdlib/' + os.path.splitext(filename[len(_STDLIB):].replace('\\', '/').split('/')[0])[0]
+    if filename.startswith('<'):
+        return 'stdlib'  # <frozen ...> / <unknown>
+    return os.path.basename(filename)
+
+
+def _site(stat, group: str) -> str:
+    frame = stat.traceback[0]
+    if group == 'module':
+        return module_of(frame.filename)
+    if group == 'file':
+        return module_of(frame.filename) if frame.filename.startswith(_ROOT) else frame.filename
+    return f'{frame.filename}:{frame.lineno}'
+
+
+class Tracer:
+    '''
+    tracemalloc 的开关 / 命名快照 (线程安全)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots: dict[str, tracemalloc.Snapshot] = {}
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        '''
+        开始记录分配 (已启动时不变)
+
+        :param frames: 每次分配记录的调用栈深度 (越大开销越大)
+        '''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            u.info(f'[memory] tracemalloc started ({frames} frames).')
+
+    def stop(self):
+        '''
+        停止记录, 并丢弃所有快照
+        '''
+        with self._lock:
+            self._snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            u.info('[memory] tracemalloc stopped.')
+
+    def snapshot(self, name: str) -> tracemalloc.Snapshot:
+        '''
+        保存一个快照 (同名时覆盖)
+
+        :raise NotTracing: tracemalloc 未启动
+        '''
+        if not tracemalloc.is_tracing():
+            raise NotTracing()
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)
+        ))
+        with self._lock:
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snap
+            while len(self._snapshots) > MAX_SNAPSHOTS:
+                self._snapshots.pop(next(iter(self._snapshots)))
+        return snap
+
+    def get(self, name: str) -> tracemalloc.Snapshot | None:
+        with self._lock:
+            return self._snapshots.get(name)
+
+    def names(self) -> list[str]:
+        with self._lock:
+            return list(self._snapshots)
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            'tracing': tracemalloc.is_tracing(),
+            'frames': tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else 0,
+            'traced': current,
+            'traced_peak': peak,
+            'overhead': tracemalloc.get_tracemalloc_memory(),
+            'snapshots': self.names()
+        }
+
+
+def top(snap: tracemalloc.Snapshot, group: str = 'module', limit: int = 20) -> list[dict]:
+    '''
+    分配最多的位置
+
+    :param group: `module` / `file` / `line`
+    :return: `[{"site", "size", "count"}]` (按大小排序)
+    '''
+    sites: dict[str, list[int]] = {}
+    for stat in snap.statistics(GROUPS[group]):
+        site = sites.setdefault(_site(stat, group), [0, 0])
+        site[0] += stat.size
+        site[1] += stat.count
+    ranked = sorted(sites.items(), key=lambda i: i[1][0], reverse=True)[:limit]
+    return [{'site': site, 'size': size, 'count': count} for site, (size, count) in ranked]
+
+
+def diff(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, group: str = 'module', limit: int = 20) -> list[dict]:
+    '''
+    两个快照之间的变化
+
+    :return: `[{"site", "size", "size_diff", "count", "count_diff"}]` (按增长的大小排序)
+    '''
+    sites: dict[str, list[int]] = {}
+    for stat in new.compare_to(old, GROUPS[group]):
+        site = sites.setdefault(_site(stat, group), [0, 0, 0, 0])
+        site[0] += stat.size
+        site[1] += stat.size_diff
+        site[2] += stat.count
+        site[3] += stat.count_diff
+    ranked = sorted(sites.items(), key=lambda i: i[1][1], reverse=True)[:limit]
+    return [{
+        'site': site,
+        'size': size,
+        'size_diff': size_diff,
+        'count': count,
+        'count_diff': count_diff
+    } for site, (size, size_diff, count, count_diff) in ranked]
+
+
+# --- Structures
+
+# 不计入大小的对象 (共享 / 不属于数据结构)
+_SKIP = (type, ModuleType, FunctionType, threading.Thread)
+
+
+def sizeof(obj) -> int:
+    '''
+    对象及其包含的对象的大小 (字节, 每个对象只计一次)
+    * 遍历 dict / list / tuple / set / deque 以及对象的 `__dict__` / `__slots__`, 不进入类 / 模块 / 函数 / 线程
+    '''
+    seen: set[int] = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SKIP):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif not isinstance(o, (str, bytes, bytearray, int, float, bool)) and o is not None:
+            if hasattr(o, '__dict__'):
+                stack.append(vars(o))
+            for slot in getattr(type(o), '__slots__', ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+    return size
+
+
+def structures(objects: dict) -> dict[str, dict]:
+    '''
+    各数据结构的大小
+
+    :param objects: `{名称: 对象}`
+    :return: `{名称: {"bytes": 大小, "items": 项数}}` (不支持 len() 的对象没有 `items`)
+    '''
+    result = {}
+    for name, obj in objects.items():
+        item = {'bytes': sizeof(obj)}
+        try:
+            item['items'] = len(obj)
+        except TypeError:
+            pass
+        result[name] = item
+    return result
+
+
+def rss() -> int | None:
+    '''
+    当前进程占用的物理内存 (字节, 不支持的系统返回 None)
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
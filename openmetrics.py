@@ -0,0 +1,250 @@
+# coding: utf-8
+
+'''
+OpenMetrics / Prometheus 文本格式的运行指标 (`/metrics/openmetrics`)
+
+- 请求计数 (按路由 / 方法 / 状态码) 及耗时直方图 (按路由, 固定分桶), 由 `server.py` 的 `before_request` / `after_request` 记录
+- SSE 连接数, 以及生成输出时读取的计量值 (设备数 / 状态版本 / 上次保存耗时 等, 见 `open_registry()`)
+- 记录只修改当前线程的计数 (不加锁), 生成输出时合并各线程的计数 (同 `data.record_metrics()`)
+- 每个进程单独计数: 多进程模式下每次抓取只得到处理此请求的 worker 的数据 (以 `instance` 标签区分)
+'''
+
+import threading
+import weakref
+from bisect import bisect_left
+from typing import Callable
+
+import env as env
+
+# 耗时分桶的上界 (秒), 最后还有一个 +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 其他方法统一记为 `other` (限制标签的取值数量)
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Shard:
+    '''
+    单个线程的请求计数 (只由所属线程修改, 生成输出时只读取)
+    * `latency` 的每一项为 `[各分桶的次数 (不累加)..., +Inf 的次数, 耗时总和]`
+    '''
+    __slots__ = ('thread', 'requests', 'latency')
+
+    def __init__(self):
+        self.thread = weakref.ref(threading.current_thread())  # 不持有线程对象 (结束后可回收)
+        self.requests: dict[tuple[str, str, int], int] = {}
+        self.latency: dict[str, list] = {}
+
+    def merge(self, requests: dict, latency: dict):
+        '''
+        将计数累加到 `requests` / `latency` 中
+        '''
+        for key, count in list(self.requests.items()):
+            requests[key] = requests.get(key, 0) + count
+        for route, values in list(self.latency.items()):
+            values = list(values)
+            total = latency.get(route)
+            if total is None:
+                latency[route] = values
+            else:
+                for i, v in enumerate(values):
+                    total[i] += v
+
+    @property
+    def alive(self) -> bool:
+        thread = self.thread()
+        return thread is not None and thread.is_alive()
+
+
+class Registry:
+    '''
+    运行指标
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[_Shard] = []
+        self._lock = threading.Lock()
+        self._retired = _Shard()  # 已结束的线程的计数 (只在持有 `_lock` 时修改)
+        self._callbacks: list[tuple[str, str, str, Callable]] = []
+        self.streams: int = 0
+        self.streams_opened: int = 0
+
+    # --- Record
+
+    def record(self, route: str, method: str, status: int, seconds: float):
+        '''
+        记录一次请求 (不加锁, 只修改当前线程的计数)
+
+        :param route: 路由规则 (如 `/device/set`, 未匹配的请求为 `other`)
+        :param method: 请求方法
+        :param status: 响应状态码
+        :param seconds: 耗时 *(秒)*
+        '''
+        shard: _Shard | None = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = _Shard()
+            self._local.shard = shard
+            with self._lock:
+                # 新线程 (如每个连接一个线程) 加入时合并已结束的线程, 不依赖抓取 `collect()`
+                self._retire_locked()
+                self._shards.append(shard)
+        if method not in METHODS:
+            method = 'other'
+        key = (route, method, status)
+        requests = shard.requests
+        requests[key] = requests.get(key, 0) + 1
+        values = shard.latency.get(route)
+        if values is None:
+            values = shard.latency[route] = [0] * (len(BUCKETS) + 1) + [0.0]
+        values[bisect_left(BUCKETS, seconds)] += 1
+        values[-1] += seconds
+
+    def open_stream(self):
+        with self._lock:
+            self.streams += 1
+            self.streams_opened += 1
+
+    def close_stream(self):
+        with self._lock:
+            self.streams -= 1
+
+    def track_stream(self, stream):
+        '''
+        包装 SSE 事件流的生成器, 在连接期间计入 `sleepy_sse_streams`
+        '''
+        self.open_stream()
+        try:
+            yield from stream
+        finally:
+            self.close_stream()
+
+    # --- Gauges / Counters
+
+    def gauge(self, name: str, help: str, fn: Callable):
+        '''
+        添加一个计量值 (生成输出时调用 `fn()`)
+
+        :param fn: 返回数值, 或 `[(标签 dict, 数值), ...]`
+        '''
+        self._callbacks.append((name, 'gauge', help, fn))
+
+    def counter(self, name: str, help: str, fn: Callable):
+        '''
+        添加一个计数 (同 `gauge()`, 数值只增不减; `name` 不含 `_total`)
+        '''
+        self._callbacks.append((name, 'counter', help, fn))
+
+    # --- Exposition
+
+    def collect(self) -> tuple[dict, dict]:
+        '''
+        合并各线程的计数
+
+        :return: `(requests, latency)`, 格式同 `_Shard`
+        '''
+        requests: dict = {}
+        latency: dict = {}
+        with self._lock:
+            self._retire_locked()
+            for shard in self._shards:
+                shard.merge(requests, latency)
+            self._retired.merge(requests, latency)
+        return requests, latency
+
+    def _retire_locked(self):
+        '''
+        将已结束的线程的计数合并到 `_retired` 后丢弃 (需持有 `_lock`)
+        '''
+        alive = []
+        for shard in self._shards:
+            if shard.alive:
+                alive.append(shard)
+            else:
+                # 线程已结束 (不会再有新的计数)
+                shard.merge(self._retired.requests, self._retired.latency)
+        self._shards = alive
+
+    def render(self, openmetrics: bool = True) -> str:
+        '''
+        生成文本格式的输出
+
+        :param openmetrics: 为 True 时使用 OpenMetrics 格式 (`CONTENT_TYPE`), 否则使用 Prometheus 文本格式 (`CONTENT_TYPE_TEXT`)
+        '''
+        requests, latency = self.collect()
+        lines: list[str] = []
+
+        def header(name: str, kind: str, help: str):
+            # Prometheus 文本格式中计数的名称包含 `_total`
+            family = name if openmetrics or kind != 'counter' else f'{name}_total'
+            lines.append(f'# HELP {family} {help}')
+            lines.append(f'# TYPE {family} {kind}')
+
+        header('sleepy_http_requests', 'counter', 'Requests handled, by route, method and status.')
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(f'sleepy_http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+
+        header('sleepy_http_request_duration_seconds', 'histogram', 'Time spent handling requests, by route.')
+        for route, values in sorted(latency.items()):
+            cumulative = 0
+            for le, count in zip(BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'sleepy_http_request_duration_seconds_bucket{_labels(route=route, le=le)} {cumulative}')
+            lines.append(f'sleepy_http_request_duration_seconds_count{_labels(route=route)} {cumulative}')
+            lines.append(f'sleepy_http_request_duration_seconds_sum{_labels(route=route)} {_number(values[-1])}')
+
+        header('sleepy_sse_streams', 'gauge', 'Open SSE streams.')
+        lines.append(f'sleepy_sse_streams {self.streams}')
+        header('sleepy_sse_streams_opened', 'counter', 'SSE streams opened.')
+        lines.append(f'sleepy_sse_streams_opened_total {self.streams_opened}')
+
+        for name, kind, help, fn in self._callbacks:
+            try:
+                value = fn()
+            except Exception:
+                continue  # 读取失败时跳过此项 (如尚未初始化)
+            header(name, kind, help)
+            sample = f'{name}_total' if kind == 'counter' else name
+            for labels, v in (value if isinstance(value, list) else [({}, value)]):
+                lines.append(f'{sample}{_labels(**labels)} {_number(v)}')
+
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _number(value: int | float | bool) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def open_registry(d) -> Registry | None:
+    '''
+    按配置创建运行指标 (未启用时返回 None), 并添加 data 相关的计量值
+
+    :param d: data 实例
+    '''
+    if not env.util.openmetrics:
+        return None
+    registry = Registry()
+    registry.gauge('sleepy_process_start_time_seconds', 'Start time of the process since unix epoch in seconds.',
+                   lambda: [({'instance': d.instance}, d.boot_time)])
+    registry.gauge('sleepy_devices', 'Devices in the current state.', lambda: len(d.data.get('device_status', {})))
+    registry.gauge('sleepy_state_version', 'Current state version (incremented on every change).', lambda: d.version)
+    registry.gauge('sleepy_persist_pending_changes', 'Changes not yet saved to the storage backend.', lambda: d.pending_changes)
+    registry.gauge('sleepy_persist_last_duration_seconds', 'Duration of the last save / commit.', lambda: d.last_flush_duration)
+    registry.counter('sleepy_status_auto_switches', 'Status changes made by auto switch.', lambda: d.auto_switches)
+    return registry
@@ -0,0 +1,182 @@
+# coding: utf-8
+
+'''
+采样 CPU 分析 (`/admin/profile`)
+
+- 运行期间由一个后台线程按固定间隔读取所有线程的调用栈 (`sys._current_frames()`), 包括请求线程 / 定时检查线程 / SSE 事件流
+- 结果为折叠栈 (collapsed stacks, 每行 `线程;函数;函数... 次数`, 可直接用于 flamegraph.pl / speedscope), 以及按自身时间 (栈顶) 排序的函数
+- 未运行时没有任何开销 (不设置 trace / profile 函数, 也没有后台线程)
+- 默认忽略空闲的线程 (栈顶为等待锁 / 等待连接等, 见 `IDLE`), 使结果接近 CPU 时间
+'''
+
+import math
+import os
+import re
+import sys
+import threading
+from time import perf_counter, sleep
+
+# 栈顶为这些函数时视为空闲 (阻塞在 C 代码中, 栈顶为调用它的 Python 函数)
+IDLE = frozenset((
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('socketserver.py', 'serve_forever'),
+    ('queue.py', 'get'),
+    ('ssl.py', 'read'),
+    ('base_events.py', '_run_once'),
+    ('logger.py', '_run'),
+))
+# 单次分析的最长时间 (秒)
+MAX_SECONDS = 60
+
+
+class Busy(Exception):
+    '''
+    已有正在进行的分析
+    '''
+
+
+class Profile:
+    '''
+    一次分析的结果
+
+    :param stacks: `{(线程名, 帧, 帧, ...): 次数}` (从外到内)
+    '''
+
+    def __init__(self, stacks: dict[tuple[str, ...], int], samples: int, idle: int, duration: float, interval: float):
+        self.stacks = stacks
+        self.samples = samples
+        self.idle = idle
+        self.duration = duration
+        self.interval = interval
+
+    def collapsed(self) -> str:
+        '''
+        折叠栈文本 (按次数从多到少)
+        '''
+        return ''.join(f'{";".join(stack)} {count}\n' for stack, count in sorted(self.stacks.items(), key=lambda i: i[1], reverse=True))
+
+    def top(self, limit: int = 20) -> list[dict]:
+        '''
+        按自身时间 (位于栈顶的次数) 排序的函数
+
+        :return: `[{"function", "self", "self_percent", "total", "total_percent"}]` (`total` 为出现在栈中的次数, 包括调用的函数)
+        '''
+        own: dict[str, int] = {}
+        total: dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            frames = stack[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):  # 递归调用只计一次
+                total[frame] = total.get(frame, 0) + count
+        sampled = max(sum(self.stacks.values()), 1)
+        ranked = sorted(own.items(), key=lambda i: i[1], reverse=True)[:limit]
+        return [{
+            'function': frame,
+            'self': count,
+            'self_percent': round(count * 100 / sampled, 2),
+            'total': total[frame],
+            'total_percent': round(total[frame] * 100 / sampled, 2)
+        } for frame, count in ranked]
+
+    def threads(self) -> dict[str, int]:
+        '''
+        各线程 (按名称分组) 的采样数
+        '''
+        result: dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            result[stack[0]] = result.get(stack[0], 0) + count
+        return dict(sorted(result.items(), key=lambda i: i[1], reverse=True))
+
+
+class Sampler:
+    '''
+    采样分析器 (同一时间只能进行一次分析)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels: dict = {}  # 代码对象 -> 帧名 (缓存, 每次分析后清空)
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float, interval: float = 0.01, idle: bool = False) -> Profile:
+        '''
+        在当前线程中进行一次分析 (阻塞 `seconds` 秒)
+
+        :param seconds: 分析时长 *(秒, 最多 `MAX_SECONDS`)*
+        :param interval: 采样间隔 *(秒)*
+        :param idle: 是否包括空闲的线程
+        :raise Busy: 已有正在进行的分析
+        :raise ValueError: 时长 / 间隔不是有限的正数
+        '''
+        if not (math.isfinite(seconds) and math.isfinite(interval) and interval > 0):
+            raise ValueError('seconds and interval must be finite, interval must be positive')
+        if not self._lock.acquire(blocking=False):
+            raise Busy()
+        try:
+            seconds = min(max(seconds, interval), MAX_SECONDS)
+            stacks: dict[tuple[str, ...], int] = {}
+            samples = idle_samples = 0
+            me = threading.get_ident()
+            start = perf_counter()
+            deadline = start + seconds
+            next_tick = start
+            while True:
+                now = perf_counter()
+                if now >= deadline:
+                    break
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue  # 分析所在的线程 (只在等待)
+                    samples += 1
+                    code = frame.f_code
+                    if not idle and (os.path.basename(code.co_filename), code.co_name) in IDLE:
+                        idle_samples += 1
+                        continue
+                    stack = self._stack(frame, names.get(ident, str(ident)))
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                del frame  # 不持有其他线程的帧
+                # 按固定节拍采样 (采样本身的耗时不累积到间隔中)
+                next_tick += interval
+                delay = next_tick - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    next_tick = perf_counter()
+            return Profile(stacks, samples, idle_samples, perf_counter() - start, interval)
+        finally:
+            self._labels = {}
+            self._lock.release()
+
+    def _stack(self, frame, thread: str) -> tuple[str, ...]:
+        '''
+        帧 -> (线程名, 最外层的帧名, ..., 栈顶的帧名)
+        '''
+        labels = self._labels
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            frames.append(label)
+            frame = frame.f_back
+        frames.append(thread_group(thread))
+        frames.reverse()
+        return tuple(frames)
+
+
+def thread_group(name: str) -> str:
+    '''
+    线程名去掉编号 (同类线程合并, 如 `Thread-12 (process_request_thread)` -> `Thread (process_request_thread)`)
+    '''
+    return re.sub(r'[-_]\d+', '', name)
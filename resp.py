@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''
+Redis 协议 (RESP) 的最小实现, 用于 `redis` 存储后端 (见 `storage.py`)
+
+- `RespClient`: 客户端 (命令 / 管道 / 订阅), 无需安装 redis 库
+- `StandinServer`: 本地替代服务器, 支持存储后端用到的命令 (字符串 / hash / 计数 / 事务 / 发布订阅), 数据只保存在内存中
+  * 未配置 `sleepy_storage_redis_url` 时在进程内启动 (多 worker 时由 launcher 主进程持有)
+  * 也可单独运行, 供多个节点连接: `python resp.py --host 0.0.0.0 --port 6379`
+'''
+
+import socket
+import socketserver
+import threading
+from urllib.parse import urlsplit, unquote
+
+
+class RespError(Exception):
+    '''
+    服务器返回的错误
+    '''
+
+
+def encode_command(*args) -> bytes:
+    '''
+    编码一条命令 (参数为 str / bytes / int)
+    '''
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode('utf-8')
+        else:
+            data = str(arg).encode('utf-8')
+        out.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(out)
+
+
+def read_reply(fp):
+    '''
+    读取一个回复
+    * 错误回复以 `RespError` 实例返回 (不抛出), 以便读完管道中的其余回复
+    '''
+    line = fp.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        return RespError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        return None if length < 0 else fp.read(length + 2)[:-2]
+    if kind == b'*':
+        length = int(rest)
+        return None if length < 0 else [read_reply(fp) for _ in range(length)]
+    raise ConnectionError(f'protocol error: {line!r}')
+
+
+# --- Client
+
+class RespClient:
+    '''
+    Redis 协议客户端 (非线程安全, 调用方需加锁)
+
+    :param url: `redis://[:密码@]主机[:端口][/数据库]`
+    :param timeout: 连接 / 读取超时 *(秒)*
+    '''
+
+    def __init__(self, url: str, timeout: float = 10):
+        parts = urlsplit(url)
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else ''
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self._sock: socket.socket | None = None
+        self._fp = None
+
+    def _connect(self):
+        if self._sock is not None:
+            return
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock, self._fp = sock, sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self.pipeline(setup)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._fp.close()  # type: ignore
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = self._fp = None
+
+    def pipeline(self, commands: list[tuple]) -> list:
+        '''
+        一次发送多条命令, 再依次读取回复
+
+        :return: 回复列表 (有错误回复时抛出第一个 `RespError`)
+        '''
+        self._connect()
+        try:
+            self._sock.sendall(b''.join(encode_command(*c) for c in commands))  # type: ignore
+            replies = [read_reply(self._fp) for _ in commands]
+        except (OSError, ConnectionError):
+            # 连接已不可用, 下次调用时重新连接 (不自动重试, 避免重复执行 HINCRBY 等命令)
+            self.close()
+            raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def execute(self, *args):
+        '''
+        执行一条命令
+        '''
+        return self.pipeline([args])[0]
+
+    def transaction(self, commands: list[tuple]) -> list:
+        '''
+        在 `MULTI` / `EXEC` 中原子地执行多条命令
+
+        :return: 各命令的回复
+        '''
+        replies = self.pipeline([('MULTI',), *commands, ('EXEC',)])
+        return replies[-1] or []
+
+    def listen(self, channel: str):
+        '''
+        订阅频道 (使用本连接, 之后不能再执行其他命令)
+
+        :return: 生成器, 产生收到的消息 (bytes)
+        '''
+        self._connect()
+        self._sock.settimeout(None)  # type: ignore - 等待消息时不超时
+        self._sock.sendall(encode_command('SUBSCRIBE', channel))  # type: ignore
+        while True:
+            reply = read_reply(self._fp)
+            if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                yield reply[2]
+
+
+# --- Stand-in server
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: '_TCPServer'
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.queued: list | None = None  # MULTI 中排队的命令
+        self.channels: set[bytes] = set()
+        self.authed = False
+
+    def send(self, data: bytes):
+        with self.send_lock:
+            self.wfile.write(data)
+
+    def handle(self):
+        standin = self.server.standin
+        try:
+            while True:
+                command = read_reply(self.rfile)
+                if not isinstance(command, list) or not command:
+                    self.send(b'-ERR protocol error\r\n')
+                    return
+                name = command[0].upper()
+                if name == b'QUIT':
+                    self.send(b'+OK\r\n')
+                    return
+                self.send(standin.dispatch(self, name, command[1:]))
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            standin.unsubscribe(self)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    standin: 'StandinServer'
+
+
+def _encode(value) -> bytes:
+    '''
+    编码回复
+    '''
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, RespError):
+        return b'-%s\r\n' % str(value).encode('utf-8')
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    return b'*%d\r\n' % len(value) + b''.join(_encode(v) for v in value)
+
+
+class StandinServer:
+    '''
+    本地 Redis 协议替代服务器 (数据只保存在内存中)
+
+    :param host: 监听地址
+    :param port: 监听端口 (0 为随机)
+    :param password: 需要的密码 (为空则不验证)
+    '''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, password: str = ''):
+        self.password = password
+        self._lock = threading.Lock()
+        self._store: dict[bytes, bytes | dict[bytes, bytes]] = {}
+        self._subscribers: dict[bytes, set[_Handler]] = {}
+        self._server = _TCPServer((host, port), _Handler)
+        self._server.standin = self
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        auth = f':{self.password}@' if self.password else ''
+        return f'redis://{auth}{host}:{port}/0'
+
+    def start(self) -> 'StandinServer':
+        '''
+        在后台线程中运行
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever, name='sleepy-resp', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- Commands
+
+    def dispatch(self, client: _Handler, name: bytes, args: list) -> bytes:
+        '''
+        执行一条命令, 返回编码后的回复
+        '''
+        if self.password and not client.authed and name not in (b'AUTH', b'PING'):
+            return b'-NOAUTH Authentication required.\r\n'
+        if name == b'AUTH':
+            client.authed = args[-1].decode('utf-8') == self.password
+            return b'+OK\r\n' if client.authed else b'-WRONGPASS invalid password\r\n'
+        if name == b'MULTI':
+            client.queued = []
+            return b'+OK\r\n'
+        if name == b'DISCARD':
+            client.queued = None
+            return b'+OK\r\n'
+        if name == b'EXEC':
+            if client.queued is None:
+                return b'-ERR EXEC without MULTI\r\n'
+            queued, client.queued = client.queued, None
+            with self._lock:
+                replies = [self._call(client, n, a) for n, a in queued]
+            return _encode(replies)
+        if client.queued is not None:
+            client.queued.append((name, args))
+            return b'+QUEUED\r\n'
+        if name == b'SUBSCRIBE':
+            return self.subscribe(client, args)
+        with self._lock:
+            return _encode(self._call(client, name, args))
+
+    def _call(self, client: _Handler, name: bytes, args: list):
+        '''
+        执行命令 (需持有 `_lock`)
+        '''
+        handler = getattr(self, f'_cmd_{name.decode("ascii", "replace").lower()}', None)
+        if handler is None:
+            return RespError(f'ERR unknown command {name.decode("utf-8", "replace")}')
+        try:
+            return handler(*args)
+        except TypeError:
+            return RespError(f'ERR wrong number of arguments for {name.decode("utf-8", "replace")}')
+        except ValueError:
+            return RespError('ERR value is not an integer or out of range')
+
+    def _hash(self, key: bytes, create: bool = False) -> dict:
+        value = self._store.get(key)
+        if value is None:
+            value = {}
+            if create:
+                self._store[key] = value
+        if not isinstance(value, dict):
+            raise ValueError
+        return value
+
+    def _cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def _cmd_select(self, db):
+        return 'OK'  # 只有一个数据库
+
+    def _cmd_get(self, key):
+        return self._store.get(key)
+
+    def _cmd_set(self, key, value):
+        self._store[key] = value
+        return 'OK'
+
+    def _cmd_del(self, *keys):
+        return sum(self._store.pop(k, None) is not None for k in keys)
+
+    def _cmd_exists(self, *keys):
+        return sum(k in self._store for k in keys)
+
+    def _cmd_incrby(self, key, amount):
+        value = int(self._store.get(key, b'0')) + int(amount)  # type: ignore
+        self._store[key] = str(value).encode('ascii')
+        return value
+
+    def _cmd_incr(self, key):
+        return self._cmd_incrby(key, 1)
+
+    def _cmd_flushdb(self):
+        self._store.clear()
+        return 'OK'
+
+    def _cmd_hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        h = self._hash(key, create=True)
+        added = 0
+        for i in range(0, len(pairs), 2):
+            added += pairs[i] not in h
+            h[pairs[i]] = pairs[i + 1]
+        return added
+
+    def _cmd_hsetnx(self, key, field, value):
+        h = self._hash(key, create=True)
+        if field in h:
+            return 0
+        h[field] = value
+        return 1
+
+    def _cmd_hget(self, key, field):
+        return self._hash(key).get(field)
+
+    def _cmd_hdel(self, key, *fields):
+        h = self._hash(key)
+        count = sum(h.pop(f, None) is not None for f in fields)
+        if not h:
+            self._store.pop(key, None)
+        return count
+
+    def _cmd_hgetall(self, key):
+        return [x for pair in self._hash(key).items() for x in pair]
+
+    def _cmd_hlen(self, key):
+        return len(self._hash(key))
+
+    def _cmd_hincrby(self, key, field, amount):
+        h = self._hash(key, create=True)
+        value = int(h.get(field, b'0')) + int(amount)
+        h[field] = str(value).encode('ascii')
+        return value
+
+    def _cmd_publish(self, channel, message):
+        receivers = list(self._subscribers.get(channel, ()))
+        payload = _encode([b'message', channel, message])
+        for client in receivers:
+            try:
+                client.send(payload)
+            except OSError:
+                pass
+        return len(receivers)
+
+    # --- Pub/Sub
+
+    def subscribe(self, client: _Handler, channels: list) -> bytes:
+        out = []
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(client)
+                client.channels.add(channel)
+                out.append(_encode([b'subscribe', channel, len(client.channels)]))
+        return b''.join(out)
+
+    def unsubscribe(self, client: _Handler):
+        with self._lock:
+            for channel in client.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers:
+                    subscribers.discard(client)
+            client.channels.clear()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='sleepy: local Redis-protocol stand-in server (in-memory)')
+    parser.add_argument('--host', default='127.0.0.1', help='listen host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=6379, help='listen port (default: 6379)')
+    parser.add_argument('--password', default='', help='require AUTH with this password')
+    args = parser.parse_args()
+    server = StandinServer(args.host, args.port, args.password)
+    print(f'Listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
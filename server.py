@@ -1,18 +1,25 @@
 #!/usr/bin/python3
 # coding: utf-8
 
-import time
-from datetime import datetime
+import math
+import sys
 from functools import wraps  # 用于修饰器
+from time import time, perf_counter
 
 import flask
 from flask_cors import CORS
-import json5
-import pytz
 from markupsafe import escape
 
 import env
 import utils as u
+import delta
+import bus
+import history
+import analytics
+import openmetrics
+import profiler
+import memdebug
+import tracing
 from data import data as data_init
 from setting import status_list
 
@@ -29,12 +36,30 @@ try:
     # init data
     d = data_init()
     d.load()
-    d.start_timer_check(data_check_interval=env.main.checkdata_interval)  # 启动定时保存
 
-    # init metrics if enabled
+    # init metrics if enabled (before the midnight rollover timer starts)
     if env.util.metrics:
         u.info('[metrics] metrics enabled, open /metrics to see the count.')
         d.metrics_init()
+
+    d.start_timer_check(data_check_interval=env.main.checkdata_interval)  # 启动定时保存
+
+    # init event bus (cross-node) if enabled
+    cluster = bus.open_bus(d)
+    if cluster:
+        cluster.start()
+
+    # init device history if enabled
+    device_history = history.open_history(d)
+
+    # init usage analytics if enabled
+    usage_analytics = analytics.open_analytics(d)
+
+    # init request tracing if enabled
+    tracing_enabled = tracing.open_tracer()
+
+    # init runtime metrics (openmetrics) if enabled
+    runtime_metrics = openmetrics.open_registry(d)
 except u.SleepyException as e:
     u.error(f'==========\n{e}')
     exit(1)
@@ -52,82 +77,278 @@ except:
 # --- Functions
 
 
+if tracing_enabled:
+    @app.before_request
+    def start_trace():
+        '''
+        开始请求的根 span (按采样比例, 最先执行)
+        '''
+        rule = flask.request.url_rule
+        route = rule.rule if rule else 'other'
+        flask.g.trace_root = tracing.begin(f'{flask.request.method} {route}', flask.request.headers.get('traceparent'), {
+            'http.request.method': flask.request.method,
+            'http.route': route,
+            'url.path': flask.request.path,
+            'client.address': flask.request.remote_addr or ''
+        })
+
+    @app.after_request
+    def trace_response(resp: flask.Response):
+        '''
+        记录状态码, 并在响应头 `traceresponse` 中返回 trace id (仅被采样的请求)
+        '''
+        root: tracing.Span | None = flask.g.get('trace_root')
+        if root is not None:
+            root.set('http.response.status_code', resp.status_code)
+            if resp.status_code >= 500:
+                root.fail(f'HTTP {resp.status_code}')
+            resp.headers['traceresponse'] = tracing.traceparent(root)
+        return resp
+
+    @app.teardown_request
+    def end_trace(exc: BaseException | None):
+        '''
+        结束请求的根 span (SSE 等流式响应在开始发送时结束)
+        '''
+        root: tracing.Span | None = flask.g.pop('trace_root', None)
+        if root is not None:
+            if exc is not None:
+                root.fail(f'{type(exc).__name__}: {exc}')
+            tracing.finish(root)
+
+
+if runtime_metrics:
+    @app.before_request
+    def start_timer():
+        '''
+        记录请求开始的时间 (最先执行, 耗时包括 `showip()` 中的同步)
+        '''
+        flask.g.request_start = perf_counter()
+
+    @app.after_request
+    def record_latency(resp: flask.Response):
+        '''
+        记录请求计数 / 耗时 (按路由规则, 未匹配的请求记为 `other`)
+        * SSE 等流式响应只记录到开始发送为止的耗时
+        '''
+        start = flask.g.pop('request_start', None)
+        if start is not None:
+            rule = flask.request.url_rule
+            runtime_metrics.record(rule.rule if rule else 'other', flask.request.method, resp.status_code, perf_counter() - start)
+        return resp
+
+    @app.teardown_request
+    def record_error(exc: BaseException | None):
+        '''
+        未处理的异常 (不经过 `after_request`) 记为 500
+        '''
+        start = flask.g.pop('request_start', None)
+        if start is not None:
+            rule = flask.request.url_rule
+            runtime_metrics.record(rule.rule if rule else 'other', flask.request.method, 500, perf_counter() - start)
+
+
 @app.before_request
 def showip():
     '''
     在日志中显示 ip, 并记录 metrics 信息
+    '''
+    d.sync()  # 多进程共享模式: 加载其他进程的更改
+    req = flask.request
+    # 条件请求可能返回 304, 到 `not_modified()` 确定后再计数 (否则计数本身会使 ETag 失效)
+    conditional = 'If-None-Match' in req.headers or 'If-Modified-Since' in req.headers
+    if conditional and env.util.metrics:
+        flask.g.deferred_count = req.path
+    record_request(
+        path=req.path,
+        ip1=req.remote_addr,
+        ip2=req.headers.get('X-Forwarded-For'),
+        count=not conditional
+    )
 
-    :param req: `flask.request` 对象, 用于取 ip
-    :param msg: 信息 (一般是路径, 同时作为 metrics 的项名)
+
+@app.teardown_request
+def flush_deferred_count(exc: BaseException | None):
+    '''
+    未经过 `not_modified()` 的条件请求在结束时计数
+    '''
+    count_deferred()
+
+
+def count_deferred():
+    '''
+    记录 `showip()` 中推迟的计数 (如有)
+    '''
+    path = flask.g.pop('deferred_count', None)
+    if path is not None:
+        d.record_metrics(path)
+
+
+def record_request(path: str, ip1: str | None, ip2: str | None = None, count: bool = True):
+    '''
+    记录一次请求 (日志 + metrics), 供 `showip()` 和 asgi 模式使用
+
+    :param path: 访问的路径 (同时作为 metrics 的项名)
+    :param ip1: 客户端 ip
+    :param ip2: `X-Forwarded-For` 头 (如有)
+    :param count: 是否计入 metrics
     '''
-    # --- get path
-    path = flask.request.path
     # --- log
-    ip1 = flask.request.remote_addr
-    ip2 = flask.request.headers.get('X-Forwarded-For')
-    if ip2:
-        u.info(f'- Request: {ip1} / {ip2} : {path}')
-    else:
-        u.info(f'- Request: {ip1} : {path}')
+    u.access(path, ip1, ip2)
     # --- count
-    if env.util.metrics:
+    if count and env.util.metrics:
         d.record_metrics(path)
 
 
+def verify_secret() -> bool:
+    '''
+    检查请求中的 secret 是否正确 (见 `require_secret()`)
+    '''
+    # 1. body
+    # -> {"secret": "my-secret"}
+    body: dict = u.request_body(silent=True) or {}
+    if body.get('secret', '') == env.main.secret:
+        u.debug('[Auth] Verify secret Success from Body')
+        return True
+
+    # 2. param
+    # -> ?secret=my-secret
+    elif flask.request.args.get('secret', '') == env.main.secret:
+        u.debug('[Auth] Verify secret Success from Param')
+        return True
+
+    # 3. header (Sleepy-Secret)
+    # -> Sleepy-Secret: my-secret
+    elif flask.request.headers.get('Sleepy-Secret', '') == env.main.secret:
+        u.debug('[Auth] Verify secret Success from Header (Sleepy-Secret)')
+        return True
+
+    # 4. header (Authorization)
+    # -> Authorization: Bearer my-secret
+    elif flask.request.headers.get('Authorization', '')[7:] == env.main.secret:
+        u.debug('[Auth] Verify secret Success from Header (Authorization)')
+        return True
+
+    # -1. no any secret
+    else:
+        u.debug('[Auth] Verify secret Failed')
+        return False
+
+
 def require_secret(view_func):
     '''
     require_secret 修饰器, 用于指定函数需要 secret 鉴权
     '''
     @wraps(view_func)
     def wrapped_view(*args, **kwargs):
-        # 1. body
-        # -> {"secret": "my-secret"}
-        body: dict = flask.request.get_json(silent=True) or {}
-        if body.get('secret', '') == env.main.secret:
-            u.debug('[Auth] Verify secret Success from Body')
+        with tracing.span('require_secret'):
+            verified = verify_secret()
+        if verified:
             return view_func(*args, **kwargs)
+        return u.reterr(
+            code='not authorized',
+            message='wrong secret'
+        ), 401
+    return wrapped_view
 
-        # 2. param
-        # -> ?secret=my-secret
-        elif flask.request.args.get('secret', '') == env.main.secret:
-            u.debug('[Auth] Verify secret Success from Param')
-            return view_func(*args, **kwargs)
 
-        # 3. header (Sleepy-Secret)
-        # -> Sleepy-Secret: my-secret
-        elif flask.request.headers.get('Sleepy-Secret', '') == env.main.secret:
-            u.debug('[Auth] Verify secret Success from Header (Sleepy-Secret)')
-            return view_func(*args, **kwargs)
+# --- Conditional requests (ETag / Last-Modified)
 
-        # 4. header (Authorization)
-        # -> Authorization: Bearer my-secret
-        elif flask.request.headers.get('Authorization', '')[7:] == env.main.secret:
-            u.debug('[Auth] Verify secret Success from Header (Authorization)')
-            return view_func(*args, **kwargs)
+def make_etag(*parts: int | str) -> str:
+    '''
+    由进程标识 + 版本号等生成 ETag (无需序列化内容)
+
+    :param parts: 影响返回内容的版本号 / 视图参数
+    '''
+    return '-'.join([d.instance, *(f'{i:x}' if isinstance(i, int) else i for i in parts)])
+
+
+def not_modified(etag: str, last_modified: float | None = None) -> flask.Response | None:
+    '''
+    检查条件请求 (`If-None-Match` / `If-Modified-Since`), 需在序列化之前调用
+
+    :param etag: 当前内容的 ETag
+    :param last_modified: 当前内容的最后修改时间戳
+    :return: 客户端缓存仍有效时返回 304 Response, 否则为 None
+    * 返回 304 的请求不计入 metrics; 否则在此计数, 之后需重新计算依赖 metrics 的 ETag
+    '''
+    req = flask.request
+    if 'If-None-Match' in req.headers:
+        # 存在 If-None-Match 时忽略 If-Modified-Since (RFC 9110 13.1.3), 使用弱比较
+        matched = req.if_none_match.contains_weak(etag)
+    elif last_modified is not None and req.if_modified_since and int(last_modified) != d.ambiguous_second:
+        # 同一秒内有多次更改时, 客户端缓存的可能是此秒内较早的版本, 不使用 If-Modified-Since
+        matched = int(last_modified) <= req.if_modified_since.timestamp()
+    else:
+        matched = False
+    if matched:
+        flask.g.pop('deferred_count', None)
+        return cacheable(flask.Response(status=304), etag, last_modified)
+    count_deferred()
+    return None
+
+
+def cacheable(resp: flask.Response, etag: str, last_modified: float | None = None) -> flask.Response:
+    '''
+    为 Response 设置 `ETag` / `Last-Modified` / `Cache-Control`
+    * `stale-while-revalidate` 允许前置的 CDN / Nginx 短时间缓存
+    '''
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = int(last_modified)
+    resp.headers['Cache-Control'] = f'public, max-age={env.main.cache_max_age}, stale-while-revalidate={env.main.cache_stale_while_revalidate}'
+    return resp
 
-        # -1. no any secret
-        else:
-            u.debug('[Auth] Verify secret Failed')
-            return u.reterr(
-                code='not authorized',
-                message='wrong secret'
-            ), 401
-    return wrapped_view
+
+# more_text 中使用了访问统计时, 主页内容随每次访问变化
+index_uses_metrics = env.util.metrics and '{visit_' in env.page.more_text
+# more_text 中使用了使用时长时, 主页内容随时间变化 (按分钟更新)
+index_uses_analytics = bool(usage_analytics) and ('{awake_' in env.page.more_text or '{top_app_' in env.page.more_text)
+
+
+class _Placeholders(dict):
+    '''
+    `more_text` 的占位符 (未提供的占位符保持原样)
+    '''
+
+    def __missing__(self, key):
+        return f'{{{key}}}'
 
 # --- Templates
 
 
+def index_etag() -> str:
+    '''
+    首页的 ETag (随状态 / 访问统计 / 时间变化)
+    '''
+    if index_uses_metrics:
+        d.fold_metrics()  # 合并各线程的访问计数
+        etag = make_etag('index', d.version, d.metrics_version)
+    else:
+        etag = make_etag('index', d.version)
+    if index_uses_analytics:
+        etag += f'-{int(time() // 60):x}'
+    return etag
+
+
 @app.route('/')
 def index():
     '''
     根目录返回 html
     - Method: **GET**
     '''
+    # 内容还随访问统计 / 时间变化时, 修改时间不能代表内容, 只使用 ETag
+    modified = None if index_uses_metrics or index_uses_analytics else d.modified
+    resp = not_modified(index_etag(), modified)
+    if resp:
+        return resp
+    etag = index_etag()  # 重新计算: 包含本次访问的计数
+    data = d.data  # 同一快照
     # 获取手动状态
     try:
-        status: dict = status_list[d.data['status']]
+        status: dict = status_list[data['status']]
     except:
-        u.warning(f"Index {d.data['status']} out of range!")
+        u.warning(f"Index {data['status']} out of range!")
         status = {
             'name': 'Unknown',
             'desc': '未知的标识符，可能是配置问题。',
@@ -135,21 +356,26 @@ def index():
         }
     # 获取更多信息 (more_text)
     more_text: str = env.page.more_text
+    placeholders = _Placeholders()
     if env.util.metrics:
-        more_text = more_text.format(
-            visit_today=d.data['metrics']['today'].get('/', 0),
-            visit_month=d.data['metrics']['month'].get('/', 0),
-            visit_year=d.data['metrics']['year'].get('/', 0),
-            visit_total=d.data['metrics']['total'].get('/', 0)
+        placeholders.update(
+            visit_today=data['metrics']['today'].get('/', 0),
+            visit_month=data['metrics']['month'].get('/', 0),
+            visit_year=data['metrics']['year'].get('/', 0),
+            visit_total=data['metrics']['total'].get('/', 0)
         )
+    if index_uses_analytics:
+        placeholders.update(usage_analytics.placeholders())  # type: ignore
+    if placeholders:
+        more_text = more_text.format_map(placeholders)
     # 返回 html
-    return flask.render_template(
+    return cacheable(flask.make_response(flask.render_template(
         'index.html',
         env=env,
         more_text=more_text,
         status=status,
-        last_updated=d.data['last_updated']
-    ), 200
+        last_updated=data['last_updated']
+    )), etag, modified), 200
 
 
 @app.route('/'+'git'+'hub')
@@ -171,17 +397,15 @@ def none():
 # --- Read-only
 
 
-@app.route('/query')
-def query(ret_as_dict: bool = False):
+def build_query(time_str: str) -> dict:
     '''
-    获取当前状态
-    - 无需鉴权
-    - Method: **GET**
+    构造 `/query` 返回的 dict
 
-    :param ret_as_dict: 使函数直接返回 dict 而非 `u.format_dict()` 格式化后的 response
+    :param time_str: `time` 字段的内容 (预序列化时传入 `u.TIME_PLACEHOLDER`)
     '''
+    data = d.data  # 同一快照, 读取无需加锁
     # 获取手动状态
-    st: int = d.data['status']
+    st: int = data['status']
     try:
         stinfo = status_list[st]
     except:
@@ -192,15 +416,15 @@ def query(ret_as_dict: bool = False):
             'color': 'error'
         }
     # 获取设备状态
-    if d.data['private_mode']:
+    if data['private_mode']:
         # 隐私模式
         devicelst = {}
     elif env.page.using_first:
         # 使用中优先
         devicelst = {}  # devicelst = device_using
         device_not_using = {}
-        for n in d.data['device_status']:
-            i = d.data['device_status'][n]
+        for n in data['device_status']:
+            i = data['device_status'][n]
             if i['using']:
                 devicelst[n] = i
             else:
@@ -211,27 +435,47 @@ def query(ret_as_dict: bool = False):
         devicelst.update(device_not_using)  # append not_using items to end
     else:
         # 正常获取
-        devicelst: dict = d.data['device_status']
+        devicelst: dict = data['device_status']
         if env.page.sorted:
             devicelst = dict(sorted(devicelst.items()))
+    # `last_seen` 只用于心跳超时检查 (随状态保存 / 在节点间同步), 不返回给客户端
+    devicelst = {k: {f: v for f, v in i.items() if f != 'last_seen'} for k, i in devicelst.items()}
 
     # 构造返回
-    timenow = datetime.now(pytz.timezone(env.main.timezone))
-    ret = {
-        'time': timenow.strftime('%Y-%m-%d %H:%M:%S'),
+    return {
+        'time': time_str,
         'timezone': env.main.timezone,
         'success': True,
         'status': st,
         'info': stinfo,
         'device': devicelst,
         'device_status_slice': env.status.device_slice,
-        'last_updated': d.data['last_updated'],
+        'last_updated': data['last_updated'],
         'refresh': env.status.refresh_interval
     }
+
+
+@app.route('/query')
+def query(ret_as_dict: bool = False):
+    '''
+    获取当前状态
+    - 无需鉴权
+    - Method: **GET**
+
+    :param ret_as_dict: 使函数直接返回 dict 而非 `u.format_dict()` 格式化后的 response
+    '''
     if ret_as_dict:
-        return ret
-    else:
-        return u.format_dict(ret), 200
+        return build_query(u.nowstr())
+    version, modified = d.version, d.modified
+    mimetype, pretty = u.response_format()
+    etag = make_etag('query', version, u.format_tag(mimetype, pretty))
+    resp = not_modified(etag, modified)
+    if resp:
+        return resp
+    # 按状态版本 + 视图 + 编码缓存序列化结果, 每次请求只拼接当前时间
+    view = ('query', d.data['private_mode'], env.page.sorted, env.page.using_first, mimetype, pretty)
+    _, (head, tail) = d.cached(view, lambda: u.prebuild(build_query(u.TIME_PLACEHOLDER), pretty, mimetype), version=version)
+    return cacheable(u.json_response(head + u.encode(u.nowstr(), mimetype) + tail, mimetype), etag, modified), 200
 
 
 @app.route('/status_list')
@@ -241,7 +485,14 @@ def get_status_list():
     - 无需鉴权
     - Method: **GET**
     '''
-    return u.format_dict(status_list), 200
+    # status_list 运行中不会改变, 只序列化一次
+    pretty = u.want_pretty()
+    etag = make_etag('status_list', 'p' if pretty else 'c')
+    resp = not_modified(etag)
+    if resp:
+        return resp
+    _, body = d.cached(('status_list', pretty), lambda: u.dumps(status_list, pretty=pretty), version=0)
+    return cacheable(u.json_response(body), etag), 200
 
 
 # --- Status API
@@ -263,7 +514,8 @@ def set_normal():
             code='bad request',
             message="argument 'status' must be int"
         ), 400
-    d.dset('status', status)
+    with d.write():
+        d.dset('status', status)
     return u.format_dict({
         'success': True,
         'code': 'OK',
@@ -285,38 +537,119 @@ def device_set():
             device_id = escape(flask.request.args.get('id'))
             device_show_name = escape(flask.request.args.get('show_name'))
             device_using = u.tobool(escape(flask.request.args.get('using')), throw=True)
-            app_name = escape(flask.request.args.get('app_name'))
+            device = make_device(device_show_name, device_using, escape(flask.request.args.get('app_name')))
         except:
             return u.reterr(
                 code='bad request',
                 message='missing param or wrong param type'
             ), 400
     elif flask.request.method == 'POST':
-        req = flask.request.get_json()
         try:
-            device_id = req['id']
-            device_show_name = req['show_name']
-            device_using = u.tobool(req['using'], throw=True)
-            app_name = req['app_name']
+            device_id, device = parse_device(u.request_body())
         except:
             return u.reterr(
                 code='bad request',
                 message='missing param or wrong param type'
             ), 400
-    devices: dict = d.dget('device_status') # type: ignore
-    if (not device_using) and env.status.not_using:
+    with d.write() as data:
+        data['device_status'][device_id] = device
+        data['last_updated'] = u.nowstr()
+        d.check_device_status()
+    return u.format_dict({
+        'success': True,
+        'code': 'OK'
+    }), 200
+
+
+def make_device(show_name: str, using: bool, app_name: str) -> dict:
+    '''
+    生成设备状态项 (未在使用且设置了 `not_using` 时替换应用名)
+    * `last_seen` 为上报时间 (秒级时间戳), 用于心跳超时检查 (`build_query()` 中去除)
+    '''
+    if (not using) and env.status.not_using:
         # 如未在使用且锁定了提示，则替换
         app_name = env.status.not_using
-    devices[device_id] = {
-        'show_name': device_show_name,
-        'using': device_using,
-        'app_name': app_name
+    return {
+        'show_name': show_name,
+        'using': using,
+        'app_name': app_name,
+        'last_seen': int(time())
     }
-    d.data['last_updated'] = datetime.now(pytz.timezone(env.main.timezone)).strftime('%Y-%m-%d %H:%M:%S')
-    d.check_device_status()
+
+
+def parse_device(req: dict) -> tuple[str, dict]:
+    '''
+    解析 POST 请求体中的单个设备
+
+    :param req: `{"id": ..., "show_name": ..., "using": ..., "app_name": ...}`
+    :return: (设备 id, 设备状态项)
+    :raises: 缺少参数 / 参数类型错误时抛出异常
+    '''
+    return req['id'], make_device(req['show_name'], u.tobool(req['using'], throw=True), req['app_name'])
+
+
+@app.route('/device/batch_set', methods=['POST'])
+@require_secret
+def device_batch_set():
+    '''
+    批量设置 / 移除设备状态
+    - Method: **POST**
+    * 所有更改在同一次 `d.write()` 中完成: 只加锁一次, 只检查一次自动切换, 只推送一次更新
+    * 任意一个 `set` 项格式错误时不做任何更改 (返回 400)
+    '''
+    req = u.request_body(silent=True)
+    if not isinstance(req, dict) or not isinstance(req.get('set', []), list) or not isinstance(req.get('remove', []), list):
+        return u.reterr(
+            code='bad request',
+            message='body must be {"set": [...], "remove": [...]}'
+        ), 400
+
+    # 1. 先检查所有项, 有错误则整体拒绝
+    upserts: list[tuple[str, dict]] = []
+    set_results = []
+    for item in req.get('set', []):
+        try:
+            device_id, device = parse_device(item)
+            if not isinstance(device_id, str):
+                raise TypeError('id must be a string')
+        except:
+            set_results.append({
+                'id': item.get('id') if isinstance(item, dict) else None,
+                'success': False,
+                'code': 'bad request',
+                'message': 'missing param or wrong param type'
+            })
+        else:
+            upserts.append((device_id, device))
+            set_results.append({'id': device_id, 'success': True, 'code': 'OK'})
+    if len(upserts) != len(set_results):
+        u.error('Response: bad request - invalid item in batch')
+        return u.format_dict({
+            'success': False,
+            'code': 'bad request',
+            'message': 'invalid item in batch, nothing changed',
+            'set': set_results,
+            'remove': []
+        }), 400
+
+    # 2. 一次性应用 (先 set 后 remove)
+    remove_results = []
+    with d.write() as data:
+        for device_id, device in upserts:
+            data['device_status'][device_id] = device
+        for device_id in req.get('remove', []):
+            if isinstance(device_id, str) and device_id in data['device_status']:
+                del data['device_status'][device_id]
+                remove_results.append({'id': device_id, 'success': True, 'code': 'OK'})
+            else:
+                remove_results.append({'id': device_id, 'success': False, 'code': 'not found'})
+        data['last_updated'] = u.nowstr()
+        d.check_device_status()
     return u.format_dict({
         'success': True,
-        'code': 'OK'
+        'code': 'OK',
+        'set': set_results,
+        'remove': remove_results
     }), 200
 
 
@@ -329,9 +662,10 @@ def remove_device():
     '''
     device_id = escape(flask.request.args.get('id'))
     try:
-        del d.data['device_status'][device_id]
-        d.data['last_updated'] = datetime.now(pytz.timezone(env.main.timezone)).strftime('%Y-%m-%d %H:%M:%S')
-        d.check_device_status()
+        with d.write() as data:
+            del data['device_status'][device_id]
+            data['last_updated'] = u.nowstr()
+            d.check_device_status()
     except KeyError:
         return u.reterr(
             code='not found',
@@ -350,9 +684,10 @@ def clear_device():
     清除所有设备状态
     - Method: **GET**
     '''
-    d.data['device_status'] = {}
-    d.data['last_updated'] = datetime.now(pytz.timezone(env.main.timezone)).strftime('%Y-%m-%d %H:%M:%S')
-    d.check_device_status()
+    with d.write() as data:
+        data['device_status'] = {}
+        data['last_updated'] = u.nowstr()
+        d.check_device_status()
     return u.format_dict({
         'success': True,
         'code': 'OK'
@@ -372,8 +707,9 @@ def private_mode():
             code='invaild request',
             message='"private" arg only supports boolean type'
         ), 400
-    d.data['private_mode'] = private
-    d.data['last_updated'] = datetime.now(pytz.timezone(env.main.timezone)).strftime('%Y-%m-%d %H:%M:%S')
+    with d.write() as data:
+        data['private_mode'] = private
+        data['last_updated'] = u.nowstr()
     return u.format_dict({
         'success': True,
         'code': 'OK'
@@ -388,7 +724,7 @@ def save_data():
     - Method: **GET**
     '''
     try:
-        d.save()
+        d.flush()
     except Exception as e:
         return u.reterr(
             code='exception',
@@ -397,7 +733,8 @@ def save_data():
     return u.format_dict({
         'success': True,
         'code': 'OK',
-        'data': d.data
+        'data': d.data,
+        'persist': d.persist_stats()
     }), 200
 
 
@@ -406,38 +743,56 @@ def events():
     '''
     SSE 事件流，用于推送状态更新
     - Method: **GET**
+    - `?mode=delta`: 增量模式, 首次发送完整 `update`, 之后只发送 `patch` (见 `delta.py`)
     '''
+    def delta_stream():
+        last_seq = None
+        sent = None
+        while True:
+            seq = d.wait_event(last_seq, timeout=30)
+            if seq != last_seq:
+                last_seq = seq
+                sent, payloads = delta_journal.since(sent)
+                yield from payloads
+            else:
+                yield f"event: heartbeat\ndata: {u.nowstr()}\n\n"
+
     def event_stream():
-        last_update = None
-        last_heartbeat = time.time()
+        last_seq = None
         while True:
-            current_time = time.time()
-            # 检查数据是否已更新
-            current_update = d.data['last_updated']
-
-            # 如果数据有更新，发送更新事件并重置心跳计时器
-            if last_update != current_update:
-                last_update = current_update
-                # 重置心跳计时器
-                last_heartbeat = current_time
-
-                # 获取 /query 返回数据
-                ret = query(ret_as_dict=True)
-                yield f"event: update\ndata: {json5.dumps(ret, quote_keys=True)}\n\n"
-            # 只有在没有数据更新的情况下才检查是否需要发送心跳
-            elif current_time - last_heartbeat >= 30:
-                timenow = datetime.now(pytz.timezone(env.main.timezone))
-                yield f"event: heartbeat\ndata: {timenow.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                last_heartbeat = current_time
-
-            time.sleep(1)  # 每秒检查一次更新
-
-    response = flask.Response(event_stream(), mimetype="text/event-stream", status=200)
+            # 等待状态更改 (由 d.publish() 唤醒), 超时则发送心跳
+            seq = d.wait_event(last_seq, timeout=30)
+            if seq != last_seq:
+                # 事件文本在所有订阅者间共享, 每次更改只序列化一次
+                last_seq, payload = d.cached('events', build_event_payload)
+                yield payload
+            else:
+                yield f"event: heartbeat\ndata: {u.nowstr()}\n\n"
+
+    stream = delta_stream() if flask.request.args.get('mode') == 'delta' else event_stream()
+    if runtime_metrics:
+        stream = runtime_metrics.track_stream(stream)
+    response = flask.Response(stream, mimetype="text/event-stream", status=200)
     response.headers["Cache-Control"] = "no-cache"  # 禁用缓存
     response.headers["X-Accel-Buffering"] = "no"  # 禁用 Nginx 缓冲
     response.headers["Access-Control-Allow-Origin"] = "*"  # 允许跨域访问
     return response
 
+
+def build_event_payload() -> bytes:
+    '''
+    生成 SSE `update` 事件文本 (通过 `d.cached()` 调用, 每个版本只生成一次)
+    '''
+    version = d.version
+    with tracing.resume(d.publish_trace(version), 'sse.serialize', {'sse.mode': 'update', 'state.version': version}):
+        ret = query(ret_as_dict=True)
+        return b'event: update\ndata: ' + u.dumps(ret) + b'\n\n'
+
+
+# 增量 SSE 的变更日志 (所有订阅者共享)
+delta_journal = delta.DeltaJournal(d, build_query)
+
+
 CORS(app, resources={
     r"/events": {"origins": "*"},
     r"/query": {"origins": "*"}
@@ -446,14 +801,273 @@ CORS(app, resources={
 # --- Special
 
 if env.util.metrics:
+    def metrics_etag() -> str:
+        '''
+        统计信息的 ETag
+        '''
+        d.fold_metrics()  # 合并各线程的计数
+        return make_etag('metrics', d.metrics_version, 'p' if u.want_pretty() else 'c')
+
     @app.route('/metrics')
     def metrics():
         '''
         获取统计信息
         - Method: **GET**
         '''
-        resp = d.get_metrics_resp()
-        return resp, 200
+        resp = not_modified(metrics_etag())
+        if resp:
+            return resp
+        return cacheable(d.get_metrics_resp(), metrics_etag()), 200  # 包含本次访问的计数
+
+if runtime_metrics:
+    @app.route('/metrics/openmetrics')
+    def openmetrics_exposition():
+        '''
+        获取运行指标 (OpenMetrics / Prometheus 文本格式, 供 Prometheus 等抓取)
+        - 请求头 `Accept` 包含 `application/openmetrics-text` 时返回 OpenMetrics 格式, 否则返回 Prometheus 文本格式
+        - Method: **GET**
+        '''
+        use_openmetrics = 'application/openmetrics-text' in flask.request.headers.get('Accept', '')
+        resp = flask.Response(runtime_metrics.render(use_openmetrics), status=200)
+        resp.headers['Content-Type'] = openmetrics.CONTENT_TYPE if use_openmetrics else openmetrics.CONTENT_TYPE_TEXT
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+if env.util.diagnostics:
+    sampler = profiler.Sampler()
+
+    @app.route('/admin/profile')
+    @require_secret
+    def admin_profile():
+        '''
+        采样 CPU 分析: 在 `seconds` 秒内采样所有线程的调用栈, 返回折叠栈 / 自身时间最多的函数
+        - Method: **GET**
+        - `?format=collapsed`: 返回折叠栈文本 (用于生成火焰图)
+        '''
+        try:
+            seconds = float(flask.request.args.get('seconds', 5))
+            interval = max(float(flask.request.args.get('interval', 10)), 1) / 1000
+            top = min(max(int(flask.request.args.get('top', 20)), 1), 200)
+            idle = u.tobool(flask.request.args.get('idle', '0'))
+            if not (math.isfinite(seconds) and math.isfinite(interval)):
+                raise ValueError  # nan / inf: 分析永远不会结束
+        except ValueError:
+            return u.reterr(
+                code='bad request',
+                message='wrong param type'
+            ), 400
+        try:
+            result = sampler.run(seconds, interval, idle=bool(idle))
+        except profiler.Busy:
+            return u.reterr(
+                code='busy',
+                message='another profile is running'
+            ), 409
+        if flask.request.args.get('format') == 'collapsed':
+            resp = flask.Response(result.collapsed(), status=200, mimetype='text/plain')
+            resp.headers['Cache-Control'] = 'no-store'
+            return resp
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'instance': d.instance,
+            'duration': round(result.duration, 3),
+            'interval': result.interval,
+            'samples': result.samples,
+            'idle_samples': result.idle,
+            'threads': result.threads(),
+            'top': result.top(top)
+        }), 200
+
+    tracer = memdebug.Tracer()
+
+    def memory_args() -> tuple[str, int]:
+        '''
+        `/admin/memory/*` 的分组方式 / 返回数量参数
+
+        :raise ValueError: 参数错误
+        '''
+        group = flask.request.args.get('group', 'module')
+        if group not in memdebug.GROUPS:
+            raise ValueError(group)
+        return group, min(max(int(flask.request.args.get('limit', 20)), 1), 500)
+
+    @app.route('/admin/memory')
+    @require_secret
+    def admin_memory():
+        '''
+        内存诊断状态: tracemalloc 状态 / 进程占用 / 主要数据结构的大小
+        - Method: **GET**
+        '''
+        objects = {**d.memory_objects(), **delta_journal.memory_objects()}
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'instance': d.instance,
+            'rss': memdebug.rss(),
+            'tracemalloc': tracer.status(),
+            'structures': memdebug.structures(objects),
+            'device_history': device_history.stats() if device_history else None
+        }), 200
+
+    @app.route('/admin/memory/start')
+    @require_secret
+    def admin_memory_start():
+        '''
+        启动 tracemalloc
+        - Method: **GET**
+        '''
+        try:
+            frames = min(max(int(flask.request.args.get('frames', 1)), 1), 64)
+        except ValueError:
+            return u.reterr(
+                code='bad request',
+                message="argument 'frames' must be int"
+            ), 400
+        tracer.start(frames)
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'tracemalloc': tracer.status()
+        }), 200
+
+    @app.route('/admin/memory/stop')
+    @require_secret
+    def admin_memory_stop():
+        '''
+        停止 tracemalloc (并丢弃所有快照)
+        - Method: **GET**
+        '''
+        tracer.stop()
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'tracemalloc': tracer.status()
+        }), 200
+
+    @app.route('/admin/memory/snapshot')
+    @require_secret
+    def admin_memory_snapshot():
+        '''
+        保存一个命名的快照, 并返回分配最多的位置
+        - Method: **GET**
+        '''
+        name = flask.request.args.get('name', 'default')
+        try:
+            group, limit = memory_args()
+            snap = tracer.snapshot(name)
+        except ValueError:
+            return u.reterr(
+                code='bad request',
+                message='wrong param type'
+            ), 400
+        except memdebug.NotTracing:
+            return u.reterr(
+                code='not tracing',
+                message='tracemalloc is not started'
+            ), 409
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'name': name,
+            'group': group,
+            'traced': sum(t.size for t in snap.traces),
+            'top': memdebug.top(snap, group, limit)
+        }), 200
+
+    @app.route('/admin/memory/diff')
+    @require_secret
+    def admin_memory_diff():
+        '''
+        比较两个快照 (未指定 `to` 时与当前比较), 返回增长最多的位置
+        - Method: **GET**
+        '''
+        try:
+            group, limit = memory_args()
+            old_name = flask.request.args['from']
+            new_name = flask.request.args.get('to')
+            old = tracer.get(old_name)
+            new = tracer.get(new_name) if new_name else tracer.snapshot('latest')
+        except (KeyError, ValueError):
+            return u.reterr(
+                code='bad request',
+                message='missing param or wrong param type'
+            ), 400
+        except memdebug.NotTracing:
+            return u.reterr(
+                code='not tracing',
+                message='tracemalloc is not started'
+            ), 409
+        if old is None or new is None:
+            return u.reterr(
+                code='not found',
+                message='cannot find snapshot'
+            ), 404
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'from': old_name,
+            'to': new_name or 'latest',
+            'group': group,
+            'diff': memdebug.diff(old, new, group, limit)
+        }), 200
+
+if device_history:
+    @app.route('/device/history')
+    def device_history_query():
+        '''
+        获取设备状态的历史 (只记录变化)
+        - 无需鉴权 (隐私模式下不可用)
+        - Method: **GET**
+        '''
+        try:
+            device_id = flask.request.args['id']
+            since = int(flask.request.args.get('since', 0))
+            until = flask.request.args.get('until')
+            until = int(until) if until else None
+            limit = min(max(int(flask.request.args.get('limit', 100)), 1), 1000)
+        except (KeyError, ValueError):
+            return u.reterr(
+                code='bad request',
+                message='missing param or wrong param type'
+            ), 400
+        result = None if d.data['private_mode'] else device_history.query(device_id, since, until, limit)
+        if result is None:
+            return u.reterr(
+                code='not found',
+                message='cannot find item'
+            ), 404
+        return u.format_dict({
+            'success': True,
+            'code': 'OK',
+            'id': device_id,
+            **result
+        }), 200
+
+if usage_analytics:
+    @app.route('/analytics')
+    def analytics_summary():
+        '''
+        获取使用时长统计
+        - 无需鉴权 (隐私模式下不返回设备 / 应用)
+        - Method: **GET**
+        '''
+        try:
+            top = min(max(int(flask.request.args.get('top', 10)), 0), 100)
+        except ValueError:
+            return u.reterr(
+                code='bad request',
+                message="argument 'top' must be int"
+            ), 400
+        summary = usage_analytics.summary(top)
+        if d.data['private_mode']:
+            summary['apps'] = {}
+            summary['top_apps'] = {}
+        return u.format_dict({
+            'time': u.nowstr(),
+            'timezone': env.main.timezone,
+            **summary
+        }), 200
 
 if env.util.steam_enabled:
     @app.route('/steam-iframe')
@@ -463,38 +1077,16 @@ if env.util.steam_enabled:
             env=env
         ), 200
 
+# --- Tracing
+
+if tracing_enabled:
+    # 在 span 中执行视图函数 (需在所有路由注册之后)
+    for endpoint, view in list(app.view_functions.items()):
+        app.view_functions[endpoint] = tracing.traced('handler', {'flask.endpoint': endpoint})(view)
+
 # --- End
 
 if __name__ == '__main__':
-    u.info(f'=============== hi {env.page.user}! ===============')
-    # --- plugins - undone
-    # u.info(f'Loading plugins...')
-    # all_plugins = u.list_dir(u.get_path('plugin'), include_subfolder=False, ext='.py')
-    # enabled_plugins = []
-    # for i in all_plugins:
-    #     pass
-    # --- launch
-    # 检查是否启用 HTTPS
-    listening = f'{f"[{env.main.host}]" if ":" in env.main.host else env.main.host}:{env.main.port}'
-    if env.main.https_enabled:
-        ssl_context = (env.main.ssl_cert, env.main.ssl_key)
-        u.info(f'Starting HTTPS server: https://{listening}{" (debug enabled)" if env.main.debug else ""}')
-        u.info(f'Using SSL certificate: {env.main.ssl_cert}')
-        u.info(f'Using SSL key: {env.main.ssl_key}')
-    else:
-        ssl_context = None
-        u.info(f'Starting HTTP server: http://{listening}{" (debug enabled)" if env.main.debug else ""}')
-
-    try:
-        app.run(  # 启↗动↘
-            host=env.main.host,
-            port=env.main.port,
-            debug=env.main.debug,
-            ssl_context=ssl_context
-        )
-    except Exception as e:
-        u.error(f"Error running server: {e}")
-    print()
-    u.info('Server exited, saving data...')
-    d.save()
-    u.info('Bye.')
+    # 由启动器负责 (多进程 / 重载 / 退出时保存), 详见 launcher.py
+    import launcher
+    launcher.run(sys.modules[__name__])
@@ -1,26 +1,18 @@
 #!/usr/bin/python3
 # coding: utf-8
 
-from os import name, path, system
-from sys import argv
-from time import sleep
+'''
+启动器入口 (等同于 `python3 server.py`)
+* 多进程 / worker 崩溃自动重启 / 重载 (SIGHUP) / 退出时保存数据, 详见 launcher.py
+'''
 
-Server_Path = 'server.py'  # server.py 相对路径
-Sleep_Time = 5  # 等待时间 (s)
+from os import path
+from sys import argv, path as syspath
 
-c = 0  # count
-selfn = argv[0]  # self
-dirn = path.dirname(selfn)  # self dir
-server = path.join(dirn, Server_Path)  # server.py path
-print(f'[Start] Server path: {server}')
-while True:
-    c += 1
-    print(f'[Start] Starting server #{c}')
-    if name == 'nt':
-        # Windows
-        r = system(f'python {server}')
-    else:
-        # not Windows
-        r = system(f'python3 {server}')
-    print(f'[Start] #{c} exited with code {r}\nwaiting {Sleep_Time}s')
-    sleep(Sleep_Time)
+syspath.insert(0, path.dirname(path.abspath(argv[0])))  # 允许在其他目录下运行
+
+if True:
+    import launcher
+
+if __name__ == '__main__':
+    launcher.run()
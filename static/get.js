@@ -141,6 +141,29 @@ let lastEventTime = Date.now();
 let connectionAttempts = 0;
 let firstError = true; // 是否为 SSR 第一次出错 (如是则激活 Vercel 部署检测)
 const maxReconnectDelay = 30000; // 最大重连延迟时间为 30 秒
+let lastState = null; // 增量模式: 当前完整状态 (由 update 事件初始化, patch 事件修改)
+let lastSeq = null; // 增量模式: 当前状态的序号
+
+function applyPatch(state, patch) {
+    /*
+    将增量模式的 patch 应用到完整状态上
+    patch: { base, seq, fields: {time, ...}, changed: {id: device}, removed: [id], order?: [id] }
+    */
+    Object.assign(state, patch.fields);
+    for (const id of patch.removed) {
+        delete state.device[id];
+    }
+    Object.assign(state.device, patch.changed);
+    if (patch.order) {
+        // 顺序变化时按服务端给出的顺序重建
+        const device = {};
+        for (const id of patch.order) {
+            device[id] = state.device[id];
+        }
+        state.device = device;
+    }
+    return state;
+}
 
 // 重连函数
 function reconnectWithDelay(delay) {
@@ -233,8 +256,10 @@ function setupEventSource() {
         evtSource.close();
     }
 
-    // 创建新连接
-    evtSource = new EventSource('/events');
+    // 创建新连接 (增量模式)
+    lastState = null;
+    lastSeq = null;
+    evtSource = new EventSource('/events?mode=delta');
 
     // 监听连接打开事件
     evtSource.onopen = function () {
@@ -252,6 +277,8 @@ function setupEventSource() {
 
         // 处理更新数据
         if (data.success) {
+            lastState = data;
+            lastSeq = data.seq;
             updateElement(data);
         } else {
             if (statusElement) {
@@ -264,6 +291,24 @@ function setupEventSource() {
         }
     });
 
+    // 监听增量更新事件
+    evtSource.addEventListener('patch', function (event) {
+        lastEventTime = Date.now(); // 更新最后收到消息的时间
+
+        const patch = JSON.parse(event.data);
+        console.log(`[SSE] 收到增量更新 (${patch.base} -> ${patch.seq}):`, patch);
+
+        if (lastState === null || patch.base !== lastSeq) {
+            // 序号不连续, 重新连接以获取完整状态
+            console.warn(`[SSE] 增量序号不连续 (当前 ${lastSeq}, patch 基于 ${patch.base})，重新连接...`);
+            setupEventSource();
+            return;
+        }
+        applyPatch(lastState, patch);
+        lastSeq = patch.seq;
+        updateElement(lastState);
+    });
+
     // 监听心跳事件
     evtSource.addEventListener('heartbeat', function (event) {
         console.log(`[SSE] 收到心跳: ${event.data}`);
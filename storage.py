@@ -0,0 +1,711 @@
+# coding: utf-8
+
+'''
+状态持久化后端 (`data` 类通过此接口读写保存的状态)
+
+- `json`: data.json + 预写日志 (见 `journal.py`), 默认
+- `sqlite`: SQLite 数据库 (WAL 模式), 每次修改只更新变化的行; 同一主机上的多个 worker 进程可直接共享
+- `redis`: Redis 协议的键值存储 (hash / 原子计数 / 发布订阅), 多个 worker / 多个节点共享状态; 未配置地址时使用进程内的替代服务器 (见 `resp.py`)
+
+记录格式同 `journal.py` (`set` / `dev` / `del` / `metric` / `ana`), 以及设备历史 `{"op": "hist", "id": 设备 id, "e": [[时间戳, 标志位, 应用名], ...]}` (见 `history.py`, 仅 `history` 为 True 的后端)
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from time import sleep, time_ns
+
+import utils as u
+import env as env
+import journal
+import resp
+
+
+class Storage:
+    '''
+    存储后端接口
+
+    - `load()` / `save()`: 读取 / 写入完整状态
+    - `append()` / `commit()`: 增量写入 (仅 `incremental` 为 True 时可用)
+    - `begin_compact()` / `compact()`: 压缩 (合并增量写入), 由 `data.compact()` 调用
+    '''
+    name: str = ''
+    # 是否支持增量写入
+    incremental: bool = False
+    # 状态是否由多个进程 / 节点共享 (其他进程的修改通过 `subscribe()` 通知)
+    shared: bool = False
+    # 是否可保存设备历史 (`hist` 记录, 见 `history.py`)
+    history: bool = False
+
+    def load(self) -> dict | None:
+        '''
+        读取保存的状态
+
+        :return: 状态 dict, 尚未保存过时返回 None (读取失败时抛出异常)
+        '''
+        raise NotImplementedError
+
+    def save(self, snapshot: dict):
+        '''
+        写入完整状态 (失败时抛出异常)
+        '''
+        raise NotImplementedError
+
+    def reset(self):
+        '''
+        删除保存的状态 (无法读取时使用)
+        '''
+        raise NotImplementedError
+
+    def append(self, records: list[dict]) -> int:
+        '''
+        追加记录 (需在 `data` 的写入锁中调用, 保证顺序)
+
+        :return: 序号, 传给 `commit()` 以等待写入完成
+        '''
+        raise NotImplementedError
+
+    def commit(self, seq: int | None = None):
+        '''
+        等待序号 `seq` (默认为全部) 及之前的记录持久化
+        '''
+        raise NotImplementedError
+
+    def should_compact(self) -> bool:
+        '''
+        是否需要压缩 (由定时检查线程调用)
+        '''
+        return False
+
+    def begin_compact(self):
+        '''
+        开始压缩 (在 `data` 的写入锁中调用, 之后的记录不属于此次压缩)
+        '''
+
+    def compact(self, snapshot: dict):
+        '''
+        完成压缩 (不持有写入锁)
+
+        :param snapshot: `begin_compact()` 时的状态
+        '''
+
+    def close(self):
+        '''
+        压缩后关闭 (launcher 在 fork 多个 worker 前调用)
+        '''
+
+    def subscribe(self, callback):
+        '''
+        (`shared` 为 True 时) 其他进程 / 节点修改状态后, 在后台线程中调用 `callback()`
+        '''
+
+    def load_history(self, device_id: str, since: int, until: int) -> list[list]:
+        '''
+        (`history` 为 True 时) 读取保存的设备历史
+
+        :return: 时间在 [since, until] 之间的 `[时间戳, 标志位, 应用名]`, 按时间排序
+        '''
+        return []
+
+
+class _GroupCommit:
+    '''
+    增量写入的缓冲区 + 组提交: 等待期间其他线程追加的记录会由同一次 `_write()` 写入
+    '''
+
+    def _init_buffer(self):
+        self._lock = threading.Lock()  # 保护缓冲区 / 序号
+        self._commit_lock = threading.Lock()  # 同一时间只有一个线程写入
+        self._buf: list[dict] = []
+        self._seq: int = 0
+        self._durable: int = 0
+
+    def _write(self, records: list[dict]):
+        '''
+        写入一批记录 (持有 `_commit_lock`, 失败时抛出异常)
+        '''
+        raise NotImplementedError
+
+    def append(self, records: list[dict]) -> int:
+        if not records:
+            return self._seq
+        with self._lock:
+            self._buf.extend(records)
+            self._seq += 1
+            return self._seq
+
+    def commit(self, seq: int | None = None):
+        if seq is None:
+            seq = self._seq
+        if self._durable >= seq:
+            return
+        with self._commit_lock:
+            if self._durable >= seq:
+                return  # 已被其他线程一并提交
+            with self._lock:
+                buf, upto = self._buf, self._seq
+                self._buf = []
+            if buf:
+                try:
+                    self._write(buf)
+                except BaseException:
+                    with self._lock:
+                        self._buf[:0] = buf  # 放回缓冲区, 下次提交时重试
+                    raise
+            self._durable = upto
+
+
+class JsonStorage(Storage):
+    '''
+    data.json + 预写日志
+
+    :param path: data.json 路径
+    :param use_journal: 是否使用预写日志 (关闭后每次保存都重写整个文件)
+    :param fsync: 保存 / 提交时是否 fsync
+    :param compact_bytes: 日志超过此大小时压缩
+    '''
+    name = 'json'
+
+    def __init__(self, path: str, use_journal: bool = True, fsync: bool = True, compact_bytes: int = 1048576):
+        self.path = path
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self.replayed: int = 0
+        self._journal: journal.Journal | None = None
+        self._recovered = False  # 启动时日志不为空 (上次未正常退出)
+        if use_journal:
+            self._journal = journal.Journal(f'{path}.journal', fsync=fsync)
+            self._recovered = bool(self._journal.size) or os.path.exists(f'{path}.journal.old')
+
+    @property
+    def incremental(self) -> bool:  # type: ignore
+        return self._journal is not None
+
+    def load(self) -> dict | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as file:
+            ret: dict = json.load(file)
+        if self._journal:
+            self._journal.commit()  # 重放前先写入缓冲区中的记录
+            self.replayed = journal.replay(ret, self._journal.path)
+        return ret
+
+    def save(self, snapshot: dict):
+        '''
+        先写入临时文件 (fsync) 再替换, 崩溃时 data.json 不会只写了一半
+        '''
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, indent=4, ensure_ascii=False)
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(f'{self.path}.tmp', self.path)
+        if self.fsync:
+            journal.fsync_dir(self.path)
+
+    def reset(self):
+        for path in (self.path, f'{self.path}.journal.old'):
+            if os.path.exists(path):
+                os.remove(path)
+        if self._journal:
+            self._journal.rotate()
+            self._journal.drop_old()
+
+    def append(self, records: list[dict]) -> int:
+        return self._journal.append(records)  # type: ignore
+
+    def commit(self, seq: int | None = None):
+        self._journal.commit(seq)  # type: ignore
+
+    def should_compact(self) -> bool:
+        return self._journal is not None and (self._recovered or self._journal.size >= self.compact_bytes)
+
+    def begin_compact(self):
+        # 改名日志, 之后的记录写入新日志
+        self._journal.rotate()  # type: ignore
+
+    def compact(self, snapshot: dict):
+        self.save(snapshot)
+        self._journal.drop_old()  # type: ignore - 保存失败时 (抛出异常) 保留 .old, 下次压缩 / 启动时重放
+        self._recovered = False
+
+    def close(self):
+        '''
+        关闭并删除日志, 之后每次保存都重写整个文件 (日志文件只能由一个进程写入)
+        '''
+        if self._journal:
+            self._journal.close()
+            self._journal.drop_old()
+            try:
+                os.remove(self._journal.path)
+            except FileNotFoundError:
+                pass
+            self._journal = None
+
+
+class SqliteStorage(_GroupCommit, Storage):
+    '''
+    SQLite 数据库 (WAL 模式)
+
+    - `state`: 顶层项 (`status` / `private_mode` / `last_updated` 等, json 文本), 以及 metrics 的 `*_is`
+    - `device`: 设备状态 (按插入顺序)
+    - `metric`: 统计计数 (`today` / `month` / `year` / `total`, 路径)
+    - `analytics`: 使用时长 (周期, 类型 `s` 状态 / `a` 应用, 设备 id, 状态 / 应用名), 其余部分 (`*_is` / `open`) 在 state 中
+    - `history`: 设备历史 (环形缓冲区中被覆盖的记录)
+
+    :param path: 数据库路径
+    :param fsync: 是否在每次提交时同步 (`synchronous=FULL`, 否则为 `NORMAL`, 断电时可能丢失最后的提交)
+    :param legacy: 数据库为空时从此 data.json 导入 (从 json 后端迁移)
+    '''
+    name = 'sqlite'
+    incremental = True
+    history = True
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS device (id TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS metric (bucket TEXT NOT NULL, path TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (bucket, path));
+        CREATE TABLE IF NOT EXISTS analytics (bucket TEXT NOT NULL, kind TEXT NOT NULL, device TEXT NOT NULL, name TEXT NOT NULL, seconds INTEGER NOT NULL, PRIMARY KEY (bucket, kind, device, name));
+        CREATE TABLE IF NOT EXISTS history (device TEXT NOT NULL, ts INTEGER NOT NULL, flags INTEGER NOT NULL, app TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS history_device_ts ON history (device, ts);
+    '''
+
+    def __init__(self, path: str, fsync: bool = True, legacy: str = ''):
+        self.path = path
+        self.fsync = fsync
+        self.legacy = legacy
+        self._init_buffer()  # `_commit_lock` 同时保护连接
+        self._db: sqlite3.Connection | None = None
+        self._pid: int = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # 连接不能跨进程使用, 在子进程中重新连接
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._db = None
+
+    def _conn(self) -> sqlite3.Connection:
+        '''
+        获取连接 (需持有 `_commit_lock`)
+        '''
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(f'PRAGMA synchronous={"FULL" if self.fsync else "NORMAL"}')
+            db.executescript(self.SCHEMA)
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def load(self) -> dict | None:
+        state = self._load()
+        if state is None and self.legacy and os.path.exists(self.legacy):
+            u.info(f'[storage] Importing {self.legacy} into {self.path}')
+            state = JsonStorage(self.legacy, use_journal=False).load()
+            if state is not None:
+                journal.replay(state, f'{self.legacy}.journal')
+                self.save(state)
+        return state
+
+    def _load(self) -> dict | None:
+        with self._commit_lock:
+            db = self._conn()
+            state = {k: json.loads(v) for k, v in db.execute('SELECT key, value FROM state')}
+            if not state:
+                return None
+            state['device_status'] = {k: json.loads(v) for k, v in db.execute('SELECT id, value FROM device ORDER BY rowid')}
+            if 'metrics' in state:
+                metrics = state['metrics']
+                for bucket in journal.METRIC_BUCKETS:
+                    metrics[bucket] = {}
+                for bucket, path, count in db.execute('SELECT bucket, path, count FROM metric ORDER BY rowid'):
+                    metrics.setdefault(bucket, {})[path] = count
+            if 'analytics' in state:
+                stats = state['analytics']
+                stats['status'] = {b: {} for b in journal.ANALYTICS_BUCKETS}
+                stats['apps'] = {b: {} for b in journal.ANALYTICS_BUCKETS}
+                for bucket, kind, device, name, seconds in db.execute('SELECT bucket, kind, device, name, seconds FROM analytics ORDER BY rowid'):
+                    if kind == 's':
+                        stats['status'].setdefault(bucket, {})[name] = seconds
+                    else:
+                        stats['apps'].setdefault(bucket, {}).setdefault(device, {})[name] = seconds
+            return state
+
+    def save(self, snapshot: dict):
+        with self._commit_lock:
+            db = self._conn()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('DELETE FROM state')
+                db.execute('DELETE FROM device')
+                db.execute('DELETE FROM metric')
+                db.execute('DELETE FROM analytics')
+                for key, value in snapshot.items():
+                    self._apply(db, {'op': 'set', 'k': key, 'v': value})
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def reset(self):
+        with self._commit_lock:
+            db = self._conn()
+            db.executescript('DELETE FROM state; DELETE FROM device; DELETE FROM metric; DELETE FROM analytics;')
+
+    def _apply(self, db: sqlite3.Connection, record: dict):
+        '''
+        将一条记录写入数据库 (在事务中调用)
+        '''
+        op = record['op']
+        if op == 'dev':
+            db.execute('INSERT INTO device (id, value) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET value = excluded.value',
+                       (record['id'], json.dumps(record['v'], ensure_ascii=False)))
+        elif op == 'del':
+            db.execute('DELETE FROM device WHERE id = ?', (record['id'],))
+        elif op == 'metric':
+            db.executemany('INSERT INTO metric (bucket, path, count) VALUES (?, ?, ?) ON CONFLICT (bucket, path) DO UPDATE SET count = excluded.count',
+                           [(bucket, record['p'], count) for bucket, count in zip(journal.METRIC_BUCKETS, record['v'])])
+        elif op == 'ana':
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('analytics', json.dumps(record['r'], ensure_ascii=False)))
+            for bucket in record.get('c', ()):
+                db.execute('DELETE FROM analytics WHERE bucket = ?', (bucket,))
+            upsert = 'INSERT INTO analytics (bucket, kind, device, name, seconds) VALUES (?, ?, ?, ?, ?) ON CONFLICT (bucket, kind, device, name) DO UPDATE SET seconds = excluded.seconds'
+            db.executemany(upsert, [(bucket, 's', '', status, seconds) for bucket, status, seconds in record.get('s', ())])
+            for bucket, device, name, seconds in record.get('a', ()):
+                if seconds is None:
+                    db.execute("DELETE FROM analytics WHERE bucket = ? AND kind = 'a' AND device = ? AND name = ?", (bucket, device, name))
+                else:
+                    db.execute(upsert, (bucket, 'a', device, name, seconds))
+        elif op == 'hist':
+            db.executemany('INSERT INTO history (device, ts, flags, app) VALUES (?, ?, ?, ?)',
+                           [(record['id'], *entry) for entry in record['e']])
+        elif record['k'] == 'device_status':
+            # 整体替换 (按顺序重新插入)
+            db.execute('DELETE FROM device')
+            db.executemany('INSERT INTO device (id, value) VALUES (?, ?)',
+                           [(k, json.dumps(v, ensure_ascii=False)) for k, v in record['v'].items()])
+        elif record['k'] == 'metrics':
+            # 计数写入 metric 表, 其余 (`*_is`) 写入 state
+            metrics: dict = record['v']
+            db.execute('DELETE FROM metric')
+            db.executemany('INSERT INTO metric (bucket, path, count) VALUES (?, ?, ?)',
+                           [(bucket, path, count) for bucket in journal.METRIC_BUCKETS for path, count in metrics.get(bucket, {}).items()])
+            rest = {k: v for k, v in metrics.items() if k not in journal.METRIC_BUCKETS}
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('metrics', json.dumps(rest, ensure_ascii=False)))
+        elif record['k'] == 'analytics':
+            # 时长写入 analytics 表, 其余 (`*_is` / `open`) 写入 state
+            stats: dict = record['v']
+            db.execute('DELETE FROM analytics')
+            db.executemany('INSERT INTO analytics (bucket, kind, device, name, seconds) VALUES (?, ?, ?, ?, ?)',
+                           [(bucket, 's', '', status, seconds) for bucket, counts in stats.get('status', {}).items() for status, seconds in counts.items()] +
+                           [(bucket, 'a', device, name, seconds) for bucket, devices in stats.get('apps', {}).items()
+                            for device, apps in devices.items() for name, seconds in apps.items()])
+            rest = {k: v for k, v in stats.items() if k not in ('status', 'apps')}
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('analytics', json.dumps(rest, ensure_ascii=False)))
+        else:
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (record['k'], json.dumps(record['v'], ensure_ascii=False)))
+
+    def _write(self, records: list[dict]):
+        db = self._conn()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for record in records:
+                self._apply(db, record)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def begin_compact(self):
+        self.commit()
+
+    def compact(self, snapshot: dict):
+        # 将 WAL 合并到数据库文件
+        with self._commit_lock:
+            self._conn().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def load_history(self, device_id: str, since: int, until: int) -> list[list]:
+        self.commit()  # 包括尚未提交的记录
+        with self._commit_lock:
+            return [list(row) for row in self._conn().execute(
+                'SELECT ts, flags, app FROM history WHERE device = ? AND ts BETWEEN ? AND ? ORDER BY ts, rowid',
+                (device_id, since, until))]
+
+    def close(self):
+        self.commit()
+        with self._commit_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def _analytics_field(kind: str, device: str, name: str) -> str:
+    '''
+    使用时长在 redis hash 中的字段名
+    '''
+    return json.dumps([kind, device, name], ensure_ascii=False)
+
+
+class RedisStorage(_GroupCommit, Storage):
+    '''
+    Redis 协议的键值存储 (多个 worker / 节点共享)
+
+    - `{prefix}state` (hash): 顶层项 (json 文本), 以及 metrics 的 `*_is`
+    - `{prefix}device` (hash): 设备状态; `{prefix}device_order` (hash): 设备首次出现的时间, 用于保持顺序
+    - `{prefix}metric:{today|month|year|total}` (hash): 统计计数, 使用 `HINCRBY` 原子增加 (多个节点同时计数不会互相覆盖)
+    - `{prefix}analytics:{today|week|month|year|total}` (hash): 使用时长, 字段为 json `[类型 (s 状态 / a 应用), 设备 id, 状态 / 应用名]`; 其余部分 (`*_is` / `open`) 在 state 中
+    - `{prefix}version`: 每次提交 +1; 提交后在 `{prefix}changes` 频道发布本进程的标识, 其他进程 / 节点收到后重新加载
+
+    :param url: `redis://[:密码@]主机[:端口][/数据库]`
+    :param prefix: 键名前缀
+    :param legacy: 存储为空时从此 data.json 导入
+    :param mirror: 压缩时将完整状态写入此 json 文件 (进程内替代服务器只保存在内存中, 重启后从此文件导入)
+    '''
+    name = 'redis'
+    incremental = True
+    shared = True
+
+    def __init__(self, url: str, prefix: str = 'sleepy:', legacy: str = '', mirror: str = ''):
+        self.url = url
+        self.prefix = prefix
+        self.legacy = legacy
+        self.mirror = mirror
+        self._init_buffer()  # `_commit_lock` 同时保护连接
+        self._client = resp.RespClient(url)
+        self._node = uuid.uuid4().hex  # 本进程的标识 (忽略自己发布的通知)
+        self._callback = None
+        self._changed = threading.Event()
+        self._mirrored = True  # 镜像文件是否已是最新
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # 连接不能跨进程使用, 在子进程中重新连接; 订阅线程也需重新启动
+        self._init_buffer()
+        self._client = resp.RespClient(self.url)
+        self._node = uuid.uuid4().hex
+        self._changed = threading.Event()
+        if self._callback:
+            self._start_watch()
+
+    # --- Keys
+
+    @property
+    def _keys(self) -> list[str]:
+        return [f'{self.prefix}state', f'{self.prefix}device', f'{self.prefix}device_order'] + \
+            [f'{self.prefix}metric:{b}' for b in journal.METRIC_BUCKETS] + \
+            [f'{self.prefix}analytics:{b}' for b in journal.ANALYTICS_BUCKETS]
+
+    def _commands(self, records: list[dict]) -> list[tuple]:
+        '''
+        记录 -> 命令
+        * 连续的 metrics 增量 (`n`) 按路径合并为一次 `HINCRBY`
+        '''
+        p = self.prefix
+        commands = []
+        increments: dict[str, int] = {}
+
+        def flush_increments():
+            for path, n in increments.items():
+                commands.extend(('HINCRBY', f'{p}metric:{b}', path, n) for b in journal.METRIC_BUCKETS)
+            increments.clear()
+
+        for record in records:
+            op = record['op']
+            if op == 'metric' and 'n' in record:
+                increments[record['p']] = increments.get(record['p'], 0) + record['n']
+                continue
+            flush_increments()
+            if op == 'dev':
+                commands.append(('HSET', f'{p}device', record['id'], json.dumps(record['v'], ensure_ascii=False)))
+                commands.append(('HSETNX', f'{p}device_order', record['id'], time_ns()))
+            elif op == 'del':
+                commands.append(('HDEL', f'{p}device', record['id']))
+                commands.append(('HDEL', f'{p}device_order', record['id']))
+            elif op == 'metric':
+                commands.extend(('HSET', f'{p}metric:{b}', record['p'], count) for b, count in zip(journal.METRIC_BUCKETS, record['v']))
+            elif op == 'ana':
+                commands.append(('HSET', f'{p}state', 'analytics', json.dumps(record['r'], ensure_ascii=False)))
+                commands.extend(('DEL', f'{p}analytics:{b}') for b in record.get('c', ()))
+                commands.extend(('HSET', f'{p}analytics:{b}', _analytics_field('s', '', status), seconds) for b, status, seconds in record.get('s', ()))
+                for b, device, name, seconds in record.get('a', ()):
+                    if seconds is None:
+                        commands.append(('HDEL', f'{p}analytics:{b}', _analytics_field('a', device, name)))
+                    else:
+                        commands.append(('HSET', f'{p}analytics:{b}', _analytics_field('a', device, name), seconds))
+            elif record['k'] == 'device_status':
+                commands.append(('DEL', f'{p}device', f'{p}device_order'))
+                base = time_ns()
+                for i, (device_id, device) in enumerate(record['v'].items()):
+                    commands.append(('HSET', f'{p}device', device_id, json.dumps(device, ensure_ascii=False)))
+                    commands.append(('HSET', f'{p}device_order', device_id, base + i))
+            elif record['k'] == 'metrics':
+                metrics: dict = record['v']
+                commands.append(('DEL', *(f'{p}metric:{b}' for b in journal.METRIC_BUCKETS)))
+                for bucket in journal.METRIC_BUCKETS:
+                    counts = metrics.get(bucket) or {}
+                    if counts:
+                        commands.append(('HSET', f'{p}metric:{bucket}', *(x for pair in counts.items() for x in pair)))
+                rest = {k: v for k, v in metrics.items() if k not in journal.METRIC_BUCKETS}
+                commands.append(('HSET', f'{p}state', 'metrics', json.dumps(rest, ensure_ascii=False)))
+            elif record['k'] == 'analytics':
+                stats: dict = record['v']
+                commands.append(('DEL', *(f'{p}analytics:{b}' for b in journal.ANALYTICS_BUCKETS)))
+                for bucket in journal.ANALYTICS_BUCKETS:
+                    fields = [(_analytics_field('s', '', status), seconds) for status, seconds in stats.get('status', {}).get(bucket, {}).items()]
+                    fields += [(_analytics_field('a', device, name), seconds)
+                               for device, apps in stats.get('apps', {}).get(bucket, {}).items() for name, seconds in apps.items()]
+                    if fields:
+                        commands.append(('HSET', f'{p}analytics:{bucket}', *(x for pair in fields for x in pair)))
+                rest = {k: v for k, v in stats.items() if k not in ('status', 'apps')}
+                commands.append(('HSET', f'{p}state', 'analytics', json.dumps(rest, ensure_ascii=False)))
+            else:
+                commands.append(('HSET', f'{p}state', record['k'], json.dumps(record['v'], ensure_ascii=False)))
+        flush_increments()
+        return commands
+
+    def _execute(self, commands: list[tuple]):
+        '''
+        在事务中执行命令, 并通知其他进程 / 节点 (持有 `_commit_lock`)
+        '''
+        self._client.transaction([*commands, ('INCR', f'{self.prefix}version')])
+        self._client.execute('PUBLISH', f'{self.prefix}changes', self._node)
+        self._mirrored = False
+
+    # --- Storage
+
+    def load(self) -> dict | None:
+        with self._commit_lock:
+            replies = self._client.pipeline([('HGETALL', k) for k in self._keys])
+        state_raw, devices_raw, order_raw, *counts_raw = [dict(zip(r[::2], r[1::2])) for r in replies]
+        metrics_raw, analytics_raw = counts_raw[:len(journal.METRIC_BUCKETS)], counts_raw[len(journal.METRIC_BUCKETS):]
+        if not state_raw:
+            if self.legacy and os.path.exists(self.legacy):
+                u.info(f'[storage] Importing {self.legacy} into {self.url}')
+                state = JsonStorage(self.legacy, use_journal=False).load()
+                if state is not None:
+                    journal.replay(state, f'{self.legacy}.journal')
+                    self.save(state)
+                return state
+            return None
+        state = {k.decode('utf-8'): json.loads(v) for k, v in state_raw.items()}
+        order = sorted(devices_raw, key=lambda k: int(order_raw.get(k, 0)))
+        state['device_status'] = {k.decode('utf-8'): json.loads(devices_raw[k]) for k in order}
+        if 'metrics' in state:
+            for bucket, counts in zip(journal.METRIC_BUCKETS, metrics_raw):
+                state['metrics'][bucket] = {k.decode('utf-8'): int(v) for k, v in counts.items()}
+        if 'analytics' in state:
+            stats = state['analytics']
+            stats['status'] = {b: {} for b in journal.ANALYTICS_BUCKETS}
+            stats['apps'] = {b: {} for b in journal.ANALYTICS_BUCKETS}
+            for bucket, fields in zip(journal.ANALYTICS_BUCKETS, analytics_raw):
+                for field, seconds in fields.items():
+                    kind, device, name = json.loads(field)
+                    if kind == 's':
+                        stats['status'][bucket][name] = int(seconds)
+                    else:
+                        stats['apps'][bucket].setdefault(device, {})[name] = int(seconds)
+        return state
+
+    def save(self, snapshot: dict):
+        commands = [('DEL', *self._keys)] + self._commands([{'op': 'set', 'k': k, 'v': v} for k, v in snapshot.items()])
+        with self._commit_lock:
+            self._execute(commands)
+
+    def reset(self):
+        with self._commit_lock:
+            self._client.execute('DEL', *self._keys)
+
+    def _write(self, records: list[dict]):
+        self._execute(self._commands(records))
+
+    def should_compact(self) -> bool:
+        return bool(self.mirror) and not self._mirrored
+
+    def begin_compact(self):
+        self.commit()
+
+    def compact(self, snapshot: dict):
+        if self.mirror and not self._mirrored:
+            self._mirrored = True
+            JsonStorage(self.mirror, use_journal=False).save(snapshot)
+
+    def close(self):
+        self.commit()
+        with self._commit_lock:
+            self._client.close()
+
+    # --- Notify
+
+    def subscribe(self, callback):
+        self._callback = callback
+        self._start_watch()
+
+    def _start_watch(self):
+        threading.Thread(target=self._listen, name='sleepy-storage-listen', daemon=True).start()
+        threading.Thread(target=self._notify, name='sleepy-storage-notify', daemon=True).start()
+
+    def _listen(self):
+        '''
+        订阅 `{prefix}changes` 频道 (断开后重新连接, 并重新加载一次)
+        '''
+        changed = self._changed
+        while True:
+            client = resp.RespClient(self.url)
+            try:
+                for node in client.listen(f'{self.prefix}changes'):
+                    if node != self._node.encode('ascii'):
+                        changed.set()
+            except Exception as e:
+                u.warning(f'[storage] Subscription lost: {e}, reconnecting.')
+            finally:
+                client.close()
+            sleep(1)
+            changed.set()
+
+    def _notify(self):
+        '''
+        合并连续的通知, 每批只重新加载一次
+        '''
+        changed = self._changed
+        while True:
+            changed.wait()
+            changed.clear()
+            try:
+                self._callback()  # type: ignore
+            except Exception as e:
+                u.warning(f'[storage] Reload error: {e}')
+
+
+# 进程内的 Redis 协议替代服务器 (未配置 `sleepy_storage_redis_url` 时)
+_standin: resp.StandinServer | None = None
+
+
+def open_storage() -> Storage:
+    '''
+    按配置创建存储后端
+    '''
+    backend = env.storage.backend.lower()
+    if backend == 'redis':
+        url = env.storage.redis_url
+        mirror = ''
+        if not url:
+            # 进程内替代服务器 (数据只保存在内存中, 压缩时写入 data.json, 重启后导入)
+            global _standin
+            if _standin is None:
+                _standin = resp.StandinServer().start()
+                u.info(f'[storage] No redis url configured, started in-process stand-in server at {_standin.url}')
+            url = _standin.url
+            mirror = u.get_path(env.storage.path or 'data.json')
+        return RedisStorage(url, prefix=env.storage.redis_prefix, legacy=u.get_path('data.json'), mirror=mirror)
+    if backend == 'sqlite':
+        return SqliteStorage(u.get_path(env.storage.path or 'data.db'), fsync=env.storage.fsync, legacy=u.get_path('data.json'))
+    if backend != 'json':
+        u.warning(f'[storage] Unknown backend {backend}, using json.')
+    return JsonStorage(u.get_path(env.storage.path or 'data.json'), use_journal=env.storage.journal,
+                       fsync=env.storage.fsync, compact_bytes=env.storage.compact_bytes)
@@ -0,0 +1,62 @@
+# coding: utf-8
+
+'''
+条件请求测试: 重复的条件 GET 返回 304 (访问计数不使 ETag 失效)
+
+运行: `python -m unittest discover tests` 或 `python -m pytest tests`
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ConditionalGetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # 需在导入 server 之前设置 (env 可能已被其他测试导入, 直接修改配置项)
+        import env
+        cls.dir = tempfile.mkdtemp(prefix='sleepy-test-')
+        env.storage.path = os.path.join(cls.dir, 'data.json')
+        env.util.metrics = True
+        env.page.more_text = '{visit_today}'
+        import server
+        cls.client = server.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir, ignore_errors=True)
+
+    def assert_revalidates(self, path: str):
+        first = self.client.get(path)
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers['ETag']
+        for _ in range(3):
+            resp = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_metrics(self):
+        self.assert_revalidates('/metrics')
+
+    def test_index_with_metrics(self):
+        self.assert_revalidates('/')
+
+    def test_stale_etag_counted(self):
+        # 缓存过期: 返回 200, 本次访问已计入返回的内容和 ETag
+        first = self.client.get('/metrics')
+        self.client.get('/query')
+        resp = self.client.get('/metrics', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], first.headers['ETag'])
+        again = self.client.get('/metrics', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+# coding: utf-8
+
+'''
+存储后端测试: 保存 / 加载 / 增量记录重放 (json 日志 / sqlite / redis 替代服务器)
+
+运行: `python -m unittest discover tests` 或 `python -m pytest tests`
+'''
+
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal  # noqa: E402
+import resp  # noqa: E402
+import storage  # noqa: E402
+
+
+def sample_state() -> dict:
+    '''
+    包含所有顶层项的状态
+    '''
+    return {
+        'status': 1,
+        'private_mode': False,
+        'last_updated': '2026-10-18 12:00:00',
+        'device_status': {
+            'pc': {'show_name': 'PC', 'using': True, 'app_name': 'vim'},
+            'phone': {'show_name': '手机', 'using': False, 'app_name': ''},
+        },
+        'metrics': {
+            'today_is': '2026-10-18', 'month_is': 10, 'year_is': 2026,
+            'today': {'/': 3, '/query': 5},
+            'month': {'/': 30, '/query': 50},
+            'year': {'/': 300, '/query': 500},
+            'total': {'/': 3000, '/query': 5000},
+        },
+        'analytics': {
+            'today_is': '2026-10-18', 'week_is': '2026-W42', 'month_is': '2026-10', 'year_is': '2026',
+            'open': {'status': [1, 1760760000.0], 'devices': {}},
+            'status': {b: {'1': 60} for b in journal.ANALYTICS_BUCKETS},
+            'apps': {b: {'pc': {'vim': 30, '终端': 10}} for b in journal.ANALYTICS_BUCKETS},
+        },
+    }
+
+
+# 依次应用的增量记录 (覆盖所有 op)
+RECORDS = [
+    {'op': 'set', 'k': 'status', 'v': 2},
+    {'op': 'set', 'k': 'private_mode', 'v': True},
+    {'op': 'dev', 'id': 'pc', 'v': {'show_name': 'PC', 'using': False, 'app_name': 'vim'}},
+    {'op': 'dev', 'id': 'tablet', 'v': {'show_name': 'Tablet', 'using': True, 'app_name': 'reader'}},
+    {'op': 'del', 'id': 'phone'},
+    {'op': 'metric', 'p': '/query', 'v': [6, 51, 501, 5001]},
+    {'op': 'metric', 'p': '/new', 'v': [1, 1, 1, 1]},
+    {'op': 'ana', 'r': {'today_is': '2026-10-19', 'week_is': '2026-W42', 'month_is': '2026-10', 'year_is': '2026',
+                        'open': {'status': [2, 1760846400.0], 'devices': {}}},
+     'c': ['today'],
+     's': [['today', '2', 5], ['total', '1', 90]],
+     'a': [['total', 'pc', 'vim', 45], ['total', 'pc', '终端', None], ['week', 'tablet', 'reader', 5]]},
+]
+
+
+def replayed(state: dict, records: list[dict]) -> dict:
+    '''
+    在状态的副本上应用记录 (预期结果)
+    '''
+    state = copy.deepcopy(state)
+    for record in records:
+        journal.apply_record(state, record)
+    return state
+
+
+class _StorageCases:
+    '''
+    各后端共用的测试 (子类实现 `open()`)
+    '''
+
+    def open(self) -> storage.Storage:
+        raise NotImplementedError
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='sleepy-test-')
+        self.storage = self.open()
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def reopen(self) -> storage.Storage:
+        '''
+        关闭后重新打开 (模拟重启)
+        '''
+        self.storage.close()
+        self.storage = self.open()
+        return self.storage
+
+    def test_empty(self):
+        self.assertIsNone(self.storage.load())
+
+    def test_save_load(self):
+        state = sample_state()
+        self.storage.save(state)
+        self.assertEqual(self.reopen().load(), state)
+
+    def test_device_order(self):
+        state = sample_state()
+        state['device_status'] = {k: {'show_name': k} for k in ('b', 'a', 'c')}
+        self.storage.save(state)
+        self.storage.append([{'op': 'dev', 'id': 'd', 'v': {'show_name': 'd'}}])
+        self.storage.commit()
+        self.assertEqual(list(self.reopen().load()['device_status']), ['b', 'a', 'c', 'd'])  # type: ignore
+
+    def test_replay(self):
+        state = sample_state()
+        self.storage.save(state)
+        seq = 0
+        for record in RECORDS:
+            seq = self.storage.append([record])
+        self.storage.commit(seq)
+        self.assertEqual(self.reopen().load(), replayed(state, RECORDS))
+
+    def test_replay_whole_items(self):
+        # 整项替换 (`set device_status` / `metrics` / `analytics`)
+        state = sample_state()
+        self.storage.save(state)
+        new = sample_state()
+        new['device_status'] = {'watch': {'show_name': 'Watch'}}
+        new['metrics']['today'] = {'/x': 1}
+        new['analytics']['apps']['today'] = {}
+        records = journal.diff_records(state, new)
+        self.storage.append(records)
+        self.storage.commit()
+        self.assertEqual(self.reopen().load(), new)
+
+    def test_compact(self):
+        state = sample_state()
+        self.storage.save(state)
+        self.storage.append(RECORDS)
+        self.storage.begin_compact()
+        expected = replayed(state, RECORDS)
+        self.storage.compact(expected)
+        self.assertEqual(self.reopen().load(), expected)
+
+    def test_reset(self):
+        self.storage.save(sample_state())
+        self.storage.reset()
+        self.assertIsNone(self.reopen().load())
+
+
+class JsonStorageTest(_StorageCases, unittest.TestCase):
+
+    def open(self) -> storage.Storage:
+        return storage.JsonStorage(os.path.join(self.dir, 'data.json'), fsync=False)
+
+    def reopen(self) -> storage.Storage:
+        '''
+        不压缩直接丢弃实例 (模拟进程崩溃: 日志中的记录未合并到 data.json)
+        * `close()` 会删除日志 (只在压缩后调用), 不能用于模拟重启
+        '''
+        self.storage._journal._fp.close()  # type: ignore
+        self.storage = self.open()
+        return self.storage
+
+    def test_crash_replay(self):
+        state = sample_state()
+        self.storage.save(state)
+        self.storage.commit(self.storage.append(RECORDS))
+        new = self.reopen()
+        self.assertTrue(new.should_compact())  # 日志不为空: 启动后压缩
+        self.assertEqual(new.load(), replayed(state, RECORDS))
+        self.assertEqual(new.replayed, len(RECORDS))  # type: ignore
+
+    def test_crash_broken_tail(self):
+        # 最后一条记录只写入了一半: 忽略此行及之后的内容
+        state = sample_state()
+        self.storage.save(state)
+        self.storage.commit(self.storage.append(RECORDS[:3]))
+        self.storage._journal._fp.write(b'{"op": "set", "k": "sta')  # type: ignore
+        self.storage._journal._fp.flush()  # type: ignore
+        self.assertEqual(self.reopen().load(), replayed(state, RECORDS[:3]))
+
+    def test_crash_during_compact(self):
+        # 压缩时 (日志已改名为 .old) 崩溃, data.json 未替换: 重放 .old 和新日志
+        state = sample_state()
+        self.storage.save(state)
+        self.storage.append(RECORDS[:4])
+        self.storage.begin_compact()
+        self.storage.commit(self.storage.append(RECORDS[4:]))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'data.json.journal.old')))
+        new = self.reopen()
+        self.assertEqual(new.load(), replayed(state, RECORDS))
+        # 再次压缩后日志清空, 结果不变
+        new.begin_compact()
+        new.compact(replayed(state, RECORDS))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'data.json.journal.old')))
+        self.assertEqual(self.reopen().load(), replayed(state, RECORDS))
+
+    def test_replay_idempotent(self):
+        # 记录均为绝对值: 重复重放 (如压缩完成前崩溃) 结果不变
+        state = sample_state()
+        self.storage.save(state)
+        self.storage.commit(self.storage.append(RECORDS))
+        self.storage.commit(self.storage.append(RECORDS))
+        self.assertEqual(self.reopen().load(), replayed(state, RECORDS))
+
+
+class SqliteStorageTest(_StorageCases, unittest.TestCase):
+
+    def open(self) -> storage.Storage:
+        return storage.SqliteStorage(os.path.join(self.dir, 'data.db'), fsync=False)
+
+    def test_legacy_import(self):
+        # 数据库为空时从 data.json (及其日志) 导入
+        state = sample_state()
+        legacy = storage.JsonStorage(os.path.join(self.dir, 'data.json'), fsync=False)
+        legacy.save(state)
+        legacy.commit(legacy.append(RECORDS))
+        legacy._journal._fp.close()  # type: ignore
+        self.storage = storage.SqliteStorage(os.path.join(self.dir, 'data.db'), fsync=False, legacy=os.path.join(self.dir, 'data.json'))
+        self.assertEqual(self.storage.load(), replayed(state, RECORDS))
+        self.assertEqual(self.reopen().load(), replayed(state, RECORDS))
+
+    def test_history(self):
+        self.storage.save(sample_state())
+        self.storage.append([{'op': 'hist', 'id': 'pc', 'e': [[100, 1, 'vim'], [200, 0, ''], [300, 1, 'git']]}])
+        self.assertEqual(self.storage.load_history('pc', 150, 300), [[200, 0, ''], [300, 1, 'git']])
+        self.assertEqual(self.storage.load_history('phone', 0, 300), [])
+
+
+class RedisStorageTest(_StorageCases, unittest.TestCase):
+    server: resp.StandinServer
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = resp.StandinServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def open(self) -> storage.Storage:
+        return storage.RedisStorage(self.server.url, prefix=f'{self.id()}:')
+
+    def test_shared_increments(self):
+        # 多个节点同时计数: `HINCRBY` 累加, 不互相覆盖
+        state = sample_state()
+        self.storage.save(state)
+        other = self.open()
+        try:
+            for s in (self.storage, other):
+                s.append([{'op': 'metric', 'p': '/query', 'v': [0, 0, 0, 0], 'n': 2}])
+                s.commit()
+            loaded = other.load()
+        finally:
+            other.close()
+        for bucket in journal.METRIC_BUCKETS:
+            self.assertEqual(loaded['metrics'][bucket]['/query'], state['metrics'][bucket]['/query'] + 4)  # type: ignore
+
+    def test_prefix_isolation(self):
+        self.storage.save(sample_state())
+        other = storage.RedisStorage(self.server.url, prefix=f'{self.id()}-other:')
+        try:
+            self.assertIsNone(other.load())
+        finally:
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
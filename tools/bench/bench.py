@@ -0,0 +1,570 @@
+# coding: utf-8
+'''
+负载测试: 在本地启动服务 (或连接到已运行的服务), 模拟一批设备上报状态 + 一批页面轮询 `/query` (+ 可选的 SSE 连接)
+
+- 设备: 每个设备按 `interval` 秒 (±`jitter`) 的间隔 POST `/device/set`, 每次以 `churn` 的概率切换到另一个应用 (偶尔切换为未在使用)
+- 轮询: 每个轮询者按 `poll` 秒 (±`jitter`) 的间隔 GET `/query`
+- 所有请求由 `concurrency` 个线程 (各自保持一个 keep-alive 连接) 按计划时间发出; 计划时间到了但没有空闲线程时会推迟, 推迟的时间记为 `lag` (lag 较大说明客户端或服务端已饱和, 此时的延迟不能代表正常负载)
+- 结果: 各接口的吞吐量 / 延迟 (p50 / p95 / p99 / max), 服务端进程 (含 worker 子进程) 的 CPU / RSS, 写入 json 文件以便用 `compare.py` 比较不同提交的结果
+
+用法: `python tools/bench/bench.py [--devices 100] [--pollers 10] [--duration 30] ...` (`--help` 查看所有参数)
+'''
+import argparse
+import heapq
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# 模拟设备使用的应用名 (切换时从中随机选择, 另外会生成带序号的窗口标题, 使应用名不断变化)
+APPS = (
+    'Visual Studio Code', 'Google Chrome', 'Microsoft Edge', 'Firefox', 'WeChat', 'QQ', 'Telegram', 'Discord',
+    'Steam', 'Minecraft', 'Genshin Impact', 'Bilibili', 'YouTube', 'Spotify', 'NetEase Cloud Music', 'Windows Terminal',
+    'PyCharm', 'IntelliJ IDEA', 'Obsidian', 'Notion', 'Word', 'Excel', 'PowerPoint', 'OBS Studio', 'Photoshop'
+)
+DEVICE_KINDS = ('PC', 'Laptop', 'Phone', 'Tablet')
+
+
+# --- Server
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalServer:
+    '''
+    在子进程中启动服务 (`start.py`), 数据文件 / 输出放在临时目录中 (结束后删除; 启动失败时保留), 不影响程序目录下的数据
+
+    :param extra_env: 额外的环境变量 (如 `sleepy_server_workers=1`), 优先于 `.env`
+    '''
+
+    def __init__(self, extra_env: dict[str, str]):
+        self.tmp = tempfile.mkdtemp(prefix='sleepy-bench-')
+        self.port = free_port()
+        self.secret = secrets.token_hex(16)
+        self.env = dict(os.environ)
+        self.env.update({
+            'sleepy_main_host': '127.0.0.1',
+            'sleepy_main_port': str(self.port),
+            'sleepy_main_debug': 'false',
+            'sleepy_secret': self.secret,
+            'sleepy_storage_path': os.path.join(self.tmp, 'data.json'),
+            'sleepy_log_file': '',
+            'sleepy_trace_file': os.path.join(self.tmp, 'traces.jsonl'),
+            'sleepy_bus_path': os.path.join(self.tmp, 'bus')
+        })
+        self.env.update(extra_env)
+        self.output = os.path.join(self.tmp, 'server.log')
+        self.proc: subprocess.Popen | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self, timeout: float = 30):
+        with open(self.output, 'wb') as out:
+            self.proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'start.py')], cwd=ROOT, env=self.env,
+                                         stdout=out, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'server exited with code {self.proc.returncode}:\n{self.tail()}')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+                conn.request('GET', '/query')
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+                conn.close()
+            except OSError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'server not ready in {timeout}s:\n{self.tail()}')
+
+    def stop(self, timeout: float = 20):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def tail(self, lines: int = 20) -> str:
+        try:
+            with open(self.output, 'r', encoding='utf-8', errors='replace') as f:
+                return ''.join(f.readlines()[-lines:])
+        except OSError:
+            return ''
+
+
+# --- Process stats
+
+class ProcessStats:
+    '''
+    定时读取进程 (及其所有子进程) 的 CPU 时间 / RSS (读取 `/proc`, 其他系统不支持时均为 None)
+    '''
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.tick = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.supported = os.path.exists(f'/proc/{pid}/stat')
+        self.rss_peak = 0
+        self.rss_last = 0
+        self.processes = 0
+        self._cpu_start = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-stats', daemon=True)
+
+    def _read(self) -> tuple[float, int, int]:
+        '''
+        :return: (CPU 时间 (秒), RSS (字节), 进程数), 包括所有子进程
+        '''
+        stats: dict[int, tuple[int, float, int]] = {}  # pid -> (ppid, cpu, rss)
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat', 'r') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue  # 进程已退出
+            stats[int(name)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / self.tick, int(fields[21]) * self.page)
+        tree = {self.pid}
+        changed = True
+        while changed:
+            changed = False
+            for pid, (ppid, _, _) in stats.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    changed = True
+        cpu = sum(stats[pid][1] for pid in tree if pid in stats)
+        rss = sum(stats[pid][2] for pid in tree if pid in stats)
+        return cpu, rss, len(tree & stats.keys())
+
+    def begin(self):
+        '''
+        开始记录 (预热结束后调用, 重置 RSS 峰值)
+        '''
+        if self.supported:
+            self._cpu_start = self._read()[0]
+            self.rss_peak = 0
+
+    def end(self) -> float | None:
+        '''
+        :return: `begin()` 之后使用的 CPU 时间 (秒)
+        '''
+        if not self.supported:
+            return None
+        return round(self._read()[0] - self._cpu_start, 3)
+
+    def start(self):
+        if self.supported:
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                _, rss, processes = self._read()
+            except OSError:
+                continue
+            self.rss_last = rss
+            self.rss_peak = max(self.rss_peak, rss)
+            self.processes = max(self.processes, processes)
+
+
+# --- Load
+
+class Recorder:
+    '''
+    记录各接口的请求耗时 / 错误
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency: dict[str, list[float]] = {}
+        self.errors: dict[str, dict[str, int]] = {}
+        self.lag: list[float] = []
+
+    def record(self, endpoint: str, seconds: float, error: str | None = None, lag: float = 0.0):
+        with self._lock:
+            self.latency.setdefault(endpoint, []).append(seconds)
+            self.lag.append(lag)
+            if error:
+                errors = self.errors.setdefault(endpoint, {})
+                errors[error] = errors.get(error, 0) + 1
+
+
+class Device:
+    '''
+    一个模拟设备 (状态在每次上报前更新)
+    '''
+
+    def __init__(self, index: int, rand: random.Random):
+        self.id = f'bench-{index}'
+        self.show_name = f'{rand.choice(DEVICE_KINDS)} {index}'
+        self.using = True
+        self.app = rand.choice(APPS)
+
+    def next(self, rand: random.Random, churn: float) -> dict:
+        if rand.random() < churn:
+            if rand.random() < 0.1:
+                self.using = not self.using
+            else:
+                self.using = True
+                app = rand.choice(APPS)
+                # 一部分应用名带有窗口标题 (每次都不同)
+                self.app = f'{app} - {rand.randrange(10000)}' if rand.random() < 0.3 else app
+        return {'id': self.id, 'show_name': self.show_name, 'using': self.using, 'app_name': self.app}
+
+
+class Load:
+    '''
+    按计划发出请求 (设备上报 / 轮询共用一个按时间排序的队列和一组线程)
+    '''
+
+    def __init__(self, url: str, secret: str, args, recorder: Recorder):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or (443 if self.https else 80)
+        self.secret = secret
+        self.args = args
+        self.recorder = recorder
+        self.rand = random.Random(args.seed)
+        self.devices = [Device(i, self.rand) for i in range(args.devices)]
+        self._cond = threading.Condition()
+        self._heap: list[tuple[float, int, str, int]] = []  # (计划时间, 序号, 类型, 编号)
+        self._seq = 0
+        self._deadline = 0.0
+        self._closed = threading.Event()
+        self._streams: list[threading.Thread] = []
+        self.events = 0
+
+    def _connect(self, timeout: float | None = None) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=timeout or self.args.timeout)
+
+    def _schedule(self, at: float, kind: str, index: int):
+        # 调用时需持有 `_cond`
+        self._seq += 1
+        heapq.heappush(self._heap, (at, self._seq, kind, index))
+        self._cond.notify()
+
+    def _jittered(self, interval: float) -> float:
+        return interval * (1 + self.rand.uniform(-self.args.jitter, self.args.jitter))
+
+    def run(self, duration: float):
+        '''
+        发出请求 `duration` 秒 (可多次调用, 如先预热再测量; 计划继续沿用上次的)
+        '''
+        now = time.perf_counter()
+        self._deadline = now + duration
+        with self._cond:
+            if not self._seq:
+                # 初始时间随机分布在一个间隔内, 避免所有设备同时上报
+                for i in range(self.args.devices):
+                    self._schedule(now + self.rand.uniform(0, self.args.interval), 'device', i)
+                for i in range(self.args.pollers):
+                    self._schedule(now + self.rand.uniform(0, self.args.poll), 'poll', i)
+        if not self._streams:
+            # SSE 连接在多次 run() 之间保持, 由 close() 关闭
+            self._streams = [threading.Thread(target=self._stream, name=f'bench-stream-{i}', daemon=True) for i in range(self.args.streams)]
+            for t in self._streams:
+                t.start()
+        threads = [threading.Thread(target=self._worker, name=f'bench-worker-{i}', daemon=True) for i in range(self.args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _next(self) -> tuple[float, str, int] | None:
+        with self._cond:
+            while True:
+                now = time.perf_counter()
+                if now >= self._deadline:
+                    self._cond.notify_all()
+                    return None
+                if self._heap and self._heap[0][0] <= now:
+                    at, _, kind, index = heapq.heappop(self._heap)
+                    return at, kind, index
+                wait = (self._heap[0][0] if self._heap else self._deadline) - now
+                self._cond.wait(min(wait, self._deadline - now))
+
+    def _worker(self):
+        conn = self._connect()
+        while True:
+            task = self._next()
+            if task is None:
+                break
+            at, kind, index = task
+            if kind == 'device':
+                with self._cond:
+                    body = json.dumps(self.devices[index].next(self.rand, self.args.churn)).encode()
+                conn = self._request(conn, 'POST', '/device/set', body, at)
+                interval = self.args.interval
+            else:
+                conn = self._request(conn, 'GET', '/query', None, at)
+                interval = self.args.poll
+            with self._cond:
+                # 下次的计划时间基于本次的计划时间 (而非完成时间), 使请求速率不受延迟影响; 间隔为 0 时立即再次发出
+                self._schedule(at + self._jittered(interval) if interval > 0 else time.perf_counter(), kind, index)
+        conn.close()
+
+    def _request(self, conn: http.client.HTTPConnection, method: str, path: str, body: bytes | None, at: float) -> http.client.HTTPConnection:
+        headers = {'Sleepy-Secret': self.secret}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        error = None
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 400:
+                error = str(resp.status)
+        except (OSError, http.client.HTTPException) as e:
+            error = type(e).__name__
+            conn.close()
+            conn = self._connect()
+        self.recorder.record(path, time.perf_counter() - start, error, lag=start - at)
+        return conn
+
+    def close(self):
+        '''
+        关闭 SSE 连接
+        '''
+        self._closed.set()
+        for t in self._streams:
+            t.join()
+
+    def _stream(self):
+        '''
+        保持一个 SSE 连接 (`/events`), 统计收到的事件数
+        '''
+        while not self._closed.is_set():
+            conn = self._connect(timeout=1)  # 读取超时时检查是否已关闭
+            try:
+                conn.request('GET', '/events', headers={'Accept': 'text/event-stream'})
+                resp = conn.getresponse()
+                while not self._closed.is_set():
+                    try:
+                        line = resp.fp.readline()
+                    except socket.timeout:
+                        continue
+                    if not line:
+                        break
+                    if line.startswith(b'data:'):
+                        with self._cond:
+                            self.events += 1
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.5)
+            finally:
+                conn.close()
+
+
+# --- Report
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+    百分位数 (nearest-rank, `values` 需已排序)
+    '''
+    if not values:
+        return 0.0
+    k = max(min(math.ceil(p / 100 * len(values)) - 1, len(values) - 1), 0)
+    return values[k]
+
+
+def summary(values: list[float], duration: float) -> dict:
+    values = sorted(values)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'requests': len(values),
+        'rps': round(len(values) / duration, 2) if duration > 0 else 0,
+        'latency_ms': {
+            'mean': ms(sum(values) / len(values)) if values else 0,
+            'p50': ms(percentile(values, 50)),
+            'p95': ms(percentile(values, 95)),
+            'p99': ms(percentile(values, 99)),
+            'max': ms(values[-1]) if values else 0
+        }
+    }
+
+
+def git_info() -> dict:
+    def git(*args) -> str:
+        try:
+            return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ''
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'subject': git('log', '-1', '--format=%s'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))
+    }
+
+
+def print_report(result: dict):
+    print(f'\n{"endpoint":<14} {"requests":>9} {"errors":>7} {"rps":>9} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}  (ms)')
+    for endpoint, s in result['endpoints'].items():
+        lat = s['latency_ms']
+        print(f'{endpoint:<14} {s["requests"]:>9} {s["errors"]:>7} {s["rps"]:>9} {lat["mean"]:>9} {lat["p50"]:>9} {lat["p95"]:>9} {lat["p99"]:>9} {lat["max"]:>9}')
+    lag = result['lag_ms']
+    print(f'\nschedule lag (ms): p50 {lag["p50"]}, p99 {lag["p99"]}, max {lag["max"]}')
+    if result['sse']['streams']:
+        print(f'sse: {result["sse"]["streams"]} streams, {result["sse"]["events"]} events received')
+    server = result['server']
+    if server['cpu_seconds'] is not None:
+        print(f'server: cpu {server["cpu_seconds"]}s ({server["cpu_percent"]}% of one core), rss peak {server["rss_peak_bytes"] / 1048576:.1f} MiB, end {server["rss_end_bytes"] / 1048576:.1f} MiB, {server["processes"]} process(es)')
+    print(f'client: cpu {result["client"]["cpu_seconds"]}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sleepy load test: simulated devices posting /device/set + /query pollers')
+    parser.add_argument('--devices', type=int, default=100, help='number of simulated devices (default: 100)')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between reports of each device (default: 2)')
+    parser.add_argument('--churn', type=float, default=0.3, help='probability of a device switching app on each report (default: 0.3)')
+    parser.add_argument('--pollers', type=int, default=10, help='number of /query pollers (default: 10)')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between requests of each poller (default: 1)')
+    parser.add_argument('--streams', type=int, default=0, help='number of open /events (SSE) connections (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='relative random jitter of the intervals, 0 ~ 1 (default: 0.5)')
+    parser.add_argument('--concurrency', type=int, default=32, help='client threads / connections (default: 32)')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds (default: 30)')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds before measuring (default: 3)')
+    parser.add_argument('--timeout', type=float, default=10, help='request timeout in seconds (default: 10)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed (for repeatable device behaviour)')
+    parser.add_argument('--url', default='', help='benchmark a running server instead of starting one (e.g. http://127.0.0.1:9010)')
+    parser.add_argument('--secret', default=None, help='secret for --url (default: sleepy_secret from .env)')
+    parser.add_argument('--pid', type=int, default=None, help='server pid for --url, to report cpu / rss')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra environment variable for the started server (repeatable)')
+    parser.add_argument('--label', default='', help='free-form label saved in the result')
+    parser.add_argument('--output', default='', help=f'result json path (default: {os.path.relpath(RESULTS)}/<time>-<commit>.json, "-" to skip)')
+    args = parser.parse_args()
+    if args.concurrency < 1 or (args.devices < 1 and args.pollers < 1):
+        parser.error('nothing to do: need --concurrency >= 1 and some --devices / --pollers')
+    extra_env = {}
+    for item in args.env:
+        key, sep, value = item.partition('=')
+        if not sep:
+            parser.error(f'--env expects KEY=VALUE, got {item!r}')
+        extra_env[key] = value
+
+    server = None
+    if args.url:
+        url = args.url.rstrip('/')
+        secret = args.secret
+        if secret is None:
+            sys.path.append(ROOT)
+            import env
+            secret = env.main.secret
+        pid = args.pid
+    else:
+        server = LocalServer(extra_env)
+        print(f'starting server on {server.url} (data in {server.tmp})...')
+        server.start()
+        url, secret, pid = server.url, server.secret, server.proc.pid
+
+    recorder = Recorder()
+    load = Load(url, secret, args, recorder)
+    stats = ProcessStats(pid) if pid else None
+    try:
+        print(f'{args.devices} devices every {args.interval}s, {args.pollers} pollers every {args.poll}s, '
+              f'{args.streams} streams, {args.concurrency} connections: {args.warmup}s warmup + {args.duration}s...')
+        if stats:
+            stats.start()
+        if args.warmup > 0:
+            load.run(args.warmup)
+        # 预热结束, 开始记录
+        load.recorder = recorder = Recorder()
+        if stats:
+            stats.begin()
+        client_start = sum(os.times()[:2])
+        measure_start = time.perf_counter()
+        load.run(args.duration)
+        measured = time.perf_counter() - measure_start
+        client_cpu = sum(os.times()[:2]) - client_start
+        server_cpu = stats.end() if stats else None
+    finally:
+        load.close()
+        if stats:
+            stats.stop()
+        if server:
+            server.stop()
+            shutil.rmtree(server.tmp, ignore_errors=True)
+
+    endpoints = {}
+    for endpoint in ('/device/set', '/query'):
+        values = recorder.latency.get(endpoint, [])
+        if values or endpoint == '/device/set' and args.devices or endpoint == '/query' and args.pollers:
+            item = summary(values, measured)
+            errors = recorder.errors.get(endpoint, {})
+            endpoints[endpoint] = {'requests': item['requests'], 'errors': sum(errors.values()), 'error_kinds': errors,
+                                   'rps': item['rps'], 'latency_ms': item['latency_ms']}
+    all_values = [v for values in recorder.latency.values() for v in values]
+    total = summary(all_values, measured)
+    endpoints['all'] = {'requests': total['requests'], 'errors': sum(sum(e.values()) for e in recorder.errors.values()),
+                        'error_kinds': {}, 'rps': total['rps'], 'latency_ms': total['latency_ms']}
+    result = {
+        'version': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'label': args.label,
+        'git': git_info(),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'params': {k: v for k, v in vars(args).items() if k not in ('secret', 'output')},
+        'duration': round(measured, 3),
+        'endpoints': endpoints,
+        'lag_ms': summary(recorder.lag, measured)['latency_ms'],
+        'sse': {'streams': args.streams, 'events': load.events},
+        'server': {
+            'cpu_seconds': server_cpu,
+            'cpu_percent': round(server_cpu * 100 / measured, 1) if server_cpu is not None else None,
+            'rss_peak_bytes': stats.rss_peak if stats and stats.supported else None,
+            'rss_end_bytes': stats.rss_last if stats and stats.supported else None,
+            'processes': stats.processes if stats and stats.supported else None
+        },
+        'client': {'cpu_seconds': round(client_cpu, 3)}
+    }
+    print_report(result)
+
+    if args.output != '-':
+        path = args.output
+        if not path:
+            os.makedirs(RESULTS, exist_ok=True)
+            path = os.path.join(RESULTS, f'{time.strftime("%Y%m%d-%H%M%S")}-{(result["git"]["commit"] or "nogit")[:8]}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'\nresult saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
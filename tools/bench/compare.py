@@ -0,0 +1,88 @@
+# coding: utf-8
+'''
+比较 `bench.py` 的结果: 以第一个文件为基准, 列出其他结果的吞吐量 / 延迟 / CPU / RSS 及变化比例
+
+用法: `python tools/bench/compare.py <基准.json> <结果.json> [结果.json ...]`
+'''
+import json
+import sys
+
+# (显示名称, 取值函数, 越小越好)
+ENDPOINT_METRICS = (
+    ('rps', lambda e: e['rps'], False),
+    ('p50 ms', lambda e: e['latency_ms']['p50'], True),
+    ('p95 ms', lambda e: e['latency_ms']['p95'], True),
+    ('p99 ms', lambda e: e['latency_ms']['p99'], True),
+    ('errors', lambda e: e['errors'], True),
+)
+SERVER_METRICS = (
+    ('cpu %', lambda r: r['server']['cpu_percent'], True),
+    ('rss peak MiB', lambda r: r['server']['rss_peak_bytes'] / 1048576 if r['server']['rss_peak_bytes'] is not None else None, True),
+    ('lag p99 ms', lambda r: r['lag_ms']['p99'], True),
+)
+# 变化小于此比例时不标记
+THRESHOLD = 0.05
+
+
+def load(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def name_of(result: dict, path: str) -> str:
+    commit = result.get('git', {}).get('commit', '')[:8]
+    name = result.get('label') or commit or path
+    if commit and result.get('git', {}).get('dirty'):
+        name += '*'
+    return name
+
+
+def cell(value, base, lower_better: bool) -> str:
+    if value is None:
+        return '-'
+    text = f'{value:.2f}' if isinstance(value, float) else str(value)
+    if not base:
+        return text
+    change = (value - base) / base
+    mark = ''
+    if abs(change) >= THRESHOLD:
+        mark = ' +' if (change < 0) == lower_better else ' -'  # + 为变好, - 为变差
+    return f'{text} ({change:+.0%}){mark}'
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    paths = sys.argv[1:]
+    results = [load(p) for p in paths]
+    names = [name_of(r, p) for r, p in zip(results, paths)]
+    base = results[0]
+    params = {k: v for k, v in base['params'].items() if k not in ('label', 'url', 'pid')}
+    for name, result in zip(names[1:], results[1:]):
+        other = {k: v for k, v in result['params'].items() if k not in ('label', 'url', 'pid')}
+        if other != params:
+            diff = ', '.join(f'{k}={other.get(k)!r}' for k in sorted(set(params) | set(other)) if params.get(k) != other.get(k))
+            print(f'warning: {name} ran with different params ({diff})')
+
+    width = max(max(len(n) for n in names), 10) + 2
+    rows: list[tuple[str, list[str]]] = []
+    for endpoint in base['endpoints']:
+        for label, get, lower_better in ENDPOINT_METRICS:
+            base_value = get(base['endpoints'][endpoint])
+            cells = [cell(get(r['endpoints'][endpoint]) if endpoint in r['endpoints'] else None, base_value if i else None, lower_better)
+                     for i, r in enumerate(results)]
+            rows.append((f'{endpoint} {label}', cells))
+    for label, get, lower_better in SERVER_METRICS:
+        base_value = get(base)
+        rows.append((label, [cell(get(r), base_value if i else None, lower_better) for i, r in enumerate(results)]))
+
+    first = max(len(r[0]) for r in rows) + 2
+    widths = [max(width, *(len(r[1][i]) + 2 for r in rows)) for i in range(len(results))]
+    print(f'{"":<{first}}' + ''.join(f'{n:>{w}}' for n, w in zip(names, widths)))
+    for label, cells in rows:
+        print(f'{label:<{first}}' + ''.join(f'{c:>{w}}' for c, w in zip(cells, widths)))
+
+
+if __name__ == '__main__':
+    main()
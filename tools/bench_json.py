@@ -0,0 +1,69 @@
+# coding: utf-8
+'''
+json 序列化性能测试: 比较旧版格式 (标准库, indent=4) / 标准库紧凑格式 / orjson / json5 (旧版 SSE)
+
+用法: `python tools/bench_json.py [设备数量, 默认 1000] [重复次数, 默认 200]`
+'''
+import json
+import sys
+import timeit
+
+import json5
+
+sys.path.append('./')
+sys.path.append('../')
+if True:
+    import utils as u
+
+
+def payload(devices: int) -> dict:
+    '''
+    构造与 `/query` 返回相同结构的测试数据
+    '''
+    return {
+        'time': '2025-01-01 00:00:00',
+        'timezone': 'Asia/Shanghai',
+        'success': True,
+        'status': 0,
+        'info': {
+            'id': 0,
+            'name': '活着',
+            'desc': '目前在线，可以通过任何可用的联系方式联系本人。',
+            'color': 'awake'
+        },
+        'device': {
+            f'device-{i}': {
+                'show_name': f'设备 {i}',
+                'using': i % 2 == 0,
+                'app_name': f'应用程序 {i} - 正在使用 VSCode 编辑 server.py'
+            } for i in range(devices)
+        },
+        'device_status_slice': 30,
+        'last_updated': '2025-01-01 00:00:00',
+        'refresh': 5000
+    }
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    dic = payload(devices)
+    cases = {
+        'stdlib indent=4 (old)': lambda: json.dumps(dic, indent=4, ensure_ascii=False).encode('utf-8'),
+        'json5 quote_keys (old sse)': lambda: json5.dumps(dic, quote_keys=True),
+        'stdlib compact': lambda: json.dumps(dic, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+        'u.dumps compact': lambda: u.dumps(dic),
+        'u.dumps pretty': lambda: u.dumps(dic, pretty=True),
+    }
+    print(f'backend: {"orjson " + u.orjson.__version__ if u.orjson else "json (stdlib)"}, {devices} devices, {number} runs')
+    print(f'{"case":<28} {"size (bytes)":>12} {"avg (ms)":>10}')
+    for name, func in cases.items():
+        size = len(func())
+        # json5 太慢, 减少次数
+        n = max(1, number // 20) if name.startswith('json5') else number
+        avg = timeit.timeit(func, number=n) / n * 1000
+        print(f'{name:<28} {size:>12} {avg:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# coding: utf-8
+
+'''
+请求追踪 (span), 导出到本地的 jsonl 文件
+
+- 按 `env.trace.sample` 的比例采样请求 (请求头带有 W3C `traceparent` 时沿用其采样决定), 未采样的请求 / 未启用时 `span()` 只返回一个空的上下文管理器
+- 当前 span 保存在 contextvars 中 (每个线程 / 协程独立), 子 span 自动关联到父 span
+- 状态更改的追踪上下文随更改传递: SSE 序列化 (`data.publish_trace()`) / 跨节点广播 (`bus.py`) 中的 span 属于同一个 trace
+- 结束的 span 由后台线程 (`logger.AsyncLogger`) 批量写入文件, 每行为一个 OTLP/JSON 的 `{"resourceSpans": [...]}` (可由 OpenTelemetry Collector 的 otlpjsonfile receiver 读取), 按大小轮转
+'''
+
+import os
+import queue
+import random
+import socket
+from contextvars import ContextVar
+from functools import wraps
+from time import time_ns
+
+import utils as u
+import env as env
+import logger
+
+# span 类型 (OTLP SpanKind)
+INTERNAL = 1
+SERVER = 2
+CONSUMER = 5
+
+# 状态码 (OTLP StatusCode)
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+_current: ContextVar['Span | None'] = ContextVar('sleepy_span', default=None)
+_exporter: 'SpanExporter | None' = None
+_sample: float = 0.0
+
+
+class Span:
+    '''
+    一个 span (时间为纳秒级时间戳)
+    '''
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'status', 'message', '_token')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None = None, kind: int = INTERNAL, attributes: dict | None = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time_ns()
+        self.end = 0
+        self.attributes = attributes or {}
+        self.status = STATUS_UNSET
+        self.message = ''
+        self._token = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def fail(self, message: str):
+        self.status = STATUS_ERROR
+        self.message = message
+
+    @property
+    def context(self) -> tuple[str, str]:
+        '''
+        (trace id, span id), 用于在更改 / 消息中传递
+        '''
+        return self.trace_id, self.span_id
+
+    def to_otlp(self) -> dict:
+        '''
+        OTLP/JSON 格式的 span
+        '''
+        ret = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': _attributes(self.attributes)
+        }
+        if self.parent_id:
+            ret['parentSpanId'] = self.parent_id
+        if self.status != STATUS_UNSET:
+            ret['status'] = {'code': self.status, 'message': self.message}
+        return ret
+
+
+def _attributes(attributes: dict) -> list[dict]:
+    ret = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            v = {'boolValue': value}
+        elif isinstance(value, int):
+            v = {'intValue': str(value)}
+        elif isinstance(value, float):
+            v = {'doubleValue': value}
+        else:
+            v = {'stringValue': str(value)}
+        ret.append({'key': key, 'value': v})
+    return ret
+
+
+# --- Context managers
+
+class _Noop:
+    '''
+    未采样时的 span (不做任何事)
+    '''
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _Noop()
+
+
+class _SpanContext:
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, kind: int, attributes: dict | None):
+        self._args = (name, trace_id, parent_id, kind, attributes)
+        self._span: Span | None = None
+
+    def __enter__(self) -> Span:
+        span = self._span = Span(*self._args)
+        span._token = _current.set(span)
+        return span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self._span
+        if span is not None:
+            if exc is not None:
+                span.fail(f'{exc_type.__name__}: {exc}')
+            _finish(span)
+        return False
+
+
+def span(name: str, attributes: dict | None = None, kind: int = INTERNAL):
+    '''
+    在当前 span 下创建子 span (上下文管理器, 返回 Span; 当前没有 span 时返回 None)
+
+    ```
+    with tracing.span('data.write') as s:
+        ...
+    ```
+    '''
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return _SpanContext(name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+def resume(context, name: str, attributes: dict | None = None, kind: int = INTERNAL):
+    '''
+    在传递来的追踪上下文下创建 span (如 SSE 序列化 / 其他节点的更改), 上下文为 None 时不记录
+
+    :param context: `Span.context` (可为 list, 来自 json)
+    '''
+    if not context or _exporter is None:
+        return _NOOP
+    return _SpanContext(name, context[0], context[1], kind, attributes)
+
+
+def current_context() -> tuple[str, str] | None:
+    '''
+    当前 span 的追踪上下文 (没有时为 None)
+    '''
+    current = _current.get()
+    return current.context if current is not None else None
+
+
+# --- Root span (request)
+
+def begin(name: str, traceparent: str | None = None, attributes: dict | None = None, kind: int = SERVER) -> Span | None:
+    '''
+    开始一个请求的根 span (按采样比例, 未采样时返回 None), 需调用 `finish()` 结束
+
+    :param traceparent: 请求头 `traceparent` (W3C Trace Context), 有效时沿用其 trace id 和采样决定
+    '''
+    if _exporter is None:
+        return None
+    parent_id = None
+    trace_id = None
+    if traceparent:
+        parts = traceparent.strip().split('-')
+        if len(parts) >= 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            try:
+                sampled = int(parts[3][:2], 16) & 1
+            except ValueError:
+                sampled = None
+            if sampled is not None:
+                if not sampled:
+                    return None
+                trace_id, parent_id = parts[1].lower(), parts[2].lower()
+    if trace_id is None:
+        if random.random() >= _sample:
+            return None
+        trace_id = os.urandom(16).hex()
+    root = Span(name, trace_id, parent_id, kind, attributes)
+    root._token = _current.set(root)
+    return root
+
+
+def finish(root: Span | None):
+    '''
+    结束请求的根 span (并从当前上下文中移除)
+    '''
+    if root is not None:
+        _finish(root)
+
+
+def traceparent(s: Span) -> str:
+    return f'00-{s.trace_id}-{s.span_id}-01'
+
+
+def _finish(s: Span):
+    s.end = time_ns()
+    if s._token is not None:
+        try:
+            _current.reset(s._token)
+        except ValueError:
+            _current.set(None)  # 在其他上下文中结束 (如生成器被其他线程关闭)
+        s._token = None
+    if _exporter is not None:
+        _exporter.export(s)
+
+
+def traced(name: str, attributes: dict | None = None):
+    '''
+    修饰器: 在 span 中执行函数
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with span(name, attributes):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+# --- Export
+
+class SpanExporter(logger.AsyncLogger):
+    '''
+    将结束的 span 批量写入文件 (复用异步日志的队列 / 后台线程 / 文件轮转)
+
+    :param file: 文件路径
+    :param max_bytes: 轮转大小 (0 为不轮转)
+    :param backups: 保留的旧文件数量
+    '''
+
+    def __init__(self, file: str, max_bytes: int = 0, backups: int = 0):
+        super().__init__(level=logger.INFO, console='off', file=file, max_bytes=max_bytes, backups=backups)
+        self.exported = 0
+
+    def export(self, s: Span):
+        '''
+        span 入队 (队列已满时丢弃)
+        '''
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((s.end / 1e9, logger.INFO, (), s, False))
+        except queue.Full:
+            self._drop()
+
+    def _write(self, records: list):
+        spans = []
+        for record in records:
+            if isinstance(record[3], Span):
+                spans.append(record[3].to_otlp())
+            else:
+                u.warning(' '.join(map(str, record[2])).replace('[logger]', '[tracing]'))
+        if not spans:
+            return
+        line = u.dumps({'resourceSpans': [{
+            'resource': {'attributes': _attributes({
+                'service.name': 'sleepy',
+                'host.name': socket.gethostname(),
+                'process.pid': os.getpid()
+            })},
+            'scopeSpans': [{'scope': {'name': 'sleepy'}, 'spans': spans}]
+        }]})
+        self._write_file(line + b'\n')
+        self.exported += len(spans)
+
+
+def open_tracer() -> bool:
+    '''
+    按配置启用追踪
+
+    :return: 是否已启用 (采样比例为 0 时不启用, 所有 span 均为空操作)
+    '''
+    global _exporter, _sample
+    if env.trace.sample <= 0:
+        return False
+    _sample = min(env.trace.sample, 1.0)
+    _exporter = SpanExporter(u.get_path(env.trace.file), max_bytes=env.trace.max_bytes, backups=env.trace.backups)
+    u.info(f'[tracing] Tracing {_sample:.0%} of requests to {env.trace.file}.')
+    return True
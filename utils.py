@@ -1,47 +1,259 @@
 # coding: utf-8
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
-from flask import make_response, Response
+import time
+from flask import make_response, Response, request, has_request_context
 from pathlib import Path
+from typing import Any
 import os
+import pytz
+from werkzeug.exceptions import BadRequest
+
+try:
+    import orjson  # type: ignore - 可选依赖, 安装后自动使用
+except ImportError:
+    orjson = None
+
+JSON = 'application/json'
+# 可选的二进制编码 (mimetype -> (序列化, 反序列化)), 安装对应库后自动启用
+CODECS: dict[str, tuple] = {}
+try:
+    import msgpack  # type: ignore - 可选依赖
+    CODECS['application/msgpack'] = CODECS['application/x-msgpack'] = (
+        lambda obj: msgpack.packb(obj, use_bin_type=True),
+        lambda body: msgpack.unpackb(body, raw=False)
+    )
+except ImportError:
+    pass
+try:
+    import cbor2  # type: ignore - 可选依赖
+    CODECS['application/cbor'] = (cbor2.dumps, cbor2.loads)
+except ImportError:
+    pass
 
 from _utils import *
-from env import main as mainenv
+from env import main as mainenv, log as logenv
+import logger
+
+
+# 异步日志 (见 logger.py)
+_logger = logger.AsyncLogger(
+    level=logger.LEVELS.get(logenv.level.lower(), logger.INFO),
+    console=logenv.console,
+    file=get_path(logenv.file) if logenv.file else '',
+    max_bytes=logenv.max_bytes,
+    backups=logenv.backups,
+    batch=logenv.batch,
+    queue_size=logenv.queue_size,
+    sample=logger.parse_sample(logenv.sample),
+    buffered=logenv.buffered
+)
 
 
 def info(*log):
-    print(f"{datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')} ℹ️  [Info]", *log)
+    _logger.log(logger.INFO, log)
 
 
 def infon(*log):
-    print(f"\n{datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')} ℹ️  [Info]", *log)
+    _logger.log(logger.INFO, log, newline=True)
 
 
 def warning(*log):
-    print(f"{datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')} ⚠️  [Warning]", *log)
+    _logger.log(logger.WARNING, log)
 
 
 def error(*log):
-    print(f"{datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')} ❌  [Error]", *log)
+    _logger.log(logger.ERROR, log)
 
 
 def debug(*log):
+    _logger.log(logger.DEBUG, log)
+
+
+def debugging() -> bool:
+    '''
+    是否记录 debug 日志 (热路径中构造日志内容前判断, 避免在不记录时格式化字符串)
+    '''
+    return _logger.enabled(logger.DEBUG)
+
+
+def access(path: str, ip1: str | None, ip2: str | None = None):
+    '''
+    记录一次请求 (按 `sleepy_log_sample` 采样)
+
+    :param path: 路径
+    :param ip1: 客户端 ip
+    :param ip2: `X-Forwarded-For` 头 (如有)
+    '''
+    _logger.access(path, ip1, ip2)
+
+
+def flush_logs():
+    '''
+    等待已记录的日志全部写入 (退出进程前调用)
+    '''
+    _logger.flush()
+
+
+# 时区对象只创建一次
+_tz = pytz.timezone(mainenv.timezone)
+_nowstr_cache: tuple[int, str] = (0, '')
+
+
+def now() -> datetime:
+    '''
+    获取当前时间 (配置的时区)
+    '''
+    return datetime.now(_tz)
+
+
+def next_day() -> float:
+    '''
+    下一天开始 (0 点, 配置的时区) 的时间戳
+    '''
+    tomorrow = datetime.now(_tz).date() + timedelta(days=1)
+    return _tz.localize(datetime(tomorrow.year, tomorrow.month, tomorrow.day)).timestamp()
+
+
+def nowstr() -> str:
+    '''
+    获取当前时间文本 (`%Y-%m-%d %H:%M:%S`, 配置的时区, 每秒只格式化一次)
+    '''
+    global _nowstr_cache
+    sec = int(time.time())
+    if _nowstr_cache[0] != sec:
+        _nowstr_cache = (sec, datetime.fromtimestamp(sec, _tz).strftime('%Y-%m-%d %H:%M:%S'))
+    return _nowstr_cache[1]
+
+
+def dumps(dic, pretty: bool = False) -> bytes:
+    '''
+    字典 -> json 文本 (bytes)
+    * 已安装 orjson 时使用 orjson, 否则使用标准库 json
+    @param dic: 字典
+    @param pretty: 是否格式化 (缩进 2 空格), 否则为紧凑格式
+    '''
+    if orjson:
+        try:
+            return orjson.dumps(dic, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except TypeError:
+            # 键为 str 的子类 (如 markupsafe.Markup) 等情况
+            return orjson.dumps(dic, option=(orjson.OPT_INDENT_2 if pretty else 0) | orjson.OPT_NON_STR_KEYS)
+    if pretty:
+        return json.dumps(dic, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(dic, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def want_pretty() -> bool:
+    '''
+    当前请求是否需要格式化的 json (`?pretty=1` 或开启了调试模式)
+    '''
     if mainenv.debug:
-        print(f"{datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')} ⚙️  [Debug]", *log)
+        return True
+    return has_request_context() and bool(tobool(request.args.get('pretty', '0')))
+
+
+def negotiate() -> str:
+    '''
+    根据请求头 `Accept` 选择响应的编码 (mimetype)
+    * 未安装 msgpack / cbor2, 或客户端未明确要求时均为 json
+    '''
+    if not (CODECS and has_request_context()):
+        return JSON
+    return request.accept_mimetypes.best_match([JSON, *CODECS], default=JSON)
+
+
+def response_format() -> tuple[str, bool]:
+    '''
+    当前请求的响应格式
+
+    :return: (mimetype, 是否格式化 (仅 json))
+    '''
+    mimetype = negotiate()
+    return mimetype, mimetype == JSON and want_pretty()
+
+
+def format_tag(mimetype: str, pretty: bool) -> str:
+    '''
+    响应格式的简短标识 (用于 ETag)
+    '''
+    if mimetype == JSON:
+        return 'p' if pretty else 'c'
+    return mimetype.rsplit('/', 1)[-1].removeprefix('x-')
+
+
+def encode(obj, mimetype: str = JSON, pretty: bool = False) -> bytes:
+    '''
+    按 mimetype 序列化
+
+    :param obj: 对象
+    :param mimetype: `JSON` 或 `CODECS` 中的类型
+    :param pretty: 是否格式化 (仅 json)
+    '''
+    if mimetype == JSON:
+        return dumps(obj, pretty=pretty)
+    return CODECS[mimetype][0](obj)
+
+
+def request_body(silent: bool = False) -> Any:
+    '''
+    按 `Content-Type` 解析请求体 (msgpack / cbor, 其他按 json 处理)
+
+    :param silent: 解析失败时返回 None 而非抛出 400 错误 (同 `request.get_json()`)
+    '''
+    codec = CODECS.get(request.mimetype)
+    if codec is None:
+        return request.get_json(silent=silent)
+    try:
+        return codec[1](request.get_data())
+    except Exception as e:
+        if silent:
+            return None
+        raise BadRequest(f'Failed to decode {request.mimetype} body') from e
 
 
 def format_dict(dic) -> Response:
     '''
-    字典 -> Response (内容为格式化后的 json 文本)
+    字典 -> Response (默认为 json 文本, 是否格式化见 `want_pretty()`; 编码见 `negotiate()`)
     @param dic: 字典
     '''
-    response = make_response(
-        json.dumps(dic, indent=4, ensure_ascii=False, sort_keys=False, separators=(', ', ': '))
-    )
-    response.mimetype = 'application/json'
+    mimetype, pretty = response_format()
+    return json_response(encode(dic, mimetype, pretty), mimetype)
+
+
+def json_response(body: str | bytes, mimetype: str = JSON) -> Response:
+    '''
+    已序列化的 json (或 msgpack / cbor) 文本 -> Response
+    @param body: 响应体
+    @param mimetype: 响应体的编码
+    '''
+    response = make_response(body)
+    response.mimetype = mimetype
+    if CODECS:
+        # 响应内容取决于 Accept, 避免中间缓存混用
+        response.vary.add('Accept')
     return response
 
 
+# 预序列化时 `time` 字段的占位符
+TIME_PLACEHOLDER = '{{time}}'
+
+
+def prebuild(dic, pretty: bool = False, mimetype: str = JSON) -> tuple[bytes, bytes]:
+    '''
+    将包含 `TIME_PLACEHOLDER` 的字典预序列化, 并在占位符 (序列化后的整个字符串) 处切分
+    * 用于缓存响应: 每次请求只需拼接 `encode(nowstr(), mimetype)`, 无需重新序列化
+    * 二进制编码的字符串长度前缀也包含在占位符中, 因此同样适用于 msgpack / cbor
+
+    :param dic: 字典 (`TIME_PLACEHOLDER` 需要在其他用户内容之前出现)
+    :param pretty: 是否格式化 (仅 json)
+    :param mimetype: 编码
+    :return: (占位符前, 占位符后)
+    '''
+    head, tail = encode(dic, mimetype, pretty).split(encode(TIME_PLACEHOLDER, mimetype), 1)
+    return head, tail
+
+
 def reterr(code: int | str, message: str) -> Response:
     '''
     返回错误信息 Response